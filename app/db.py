@@ -0,0 +1,167 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+import metrics
+
+# Path of the SQLite database, relative paths are resolved against the working directory
+DATABASE = os.environ.get('DATABASE', 'inventory.db')
+# How long a connection waits for a lock held by another connection before giving up
+BUSY_TIMEOUT = float(os.environ.get('DATABASE_BUSY_TIMEOUT', 10))
+
+# Closed years moved out of the database by the archive command, one SQLite file per year. By default the directory
+# archive next to the database.
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+# The tables whose rows of a closed year go to its archive, everything else stays in the database
+ARCHIVE_TABLES = ('Invoices', 'InvoiceItems', 'PriceHistory')
+# SQLite attaches at most this many databases to a connection
+MAX_ATTACHED = 10
+
+# The read-only copy of the database the reports are served from, by default next to the database
+REPORT_DATABASE = os.environ.get('REPORT_DATABASE')
+
+# The write lock is taken in short attempts, so contention shows up as retries in the metrics
+LOCK_RETRY_TIMEOUT = 0.05
+
+# Also used for the read-only report snapshot
+CACHE_PRAGMAS = (
+    'PRAGMA cache_size=-20000',
+    'PRAGMA mmap_size=268435456',
+)
+# WAL lets readers carry on while an ingest is writing, NORMAL sync is safe with WAL and much cheaper than FULL
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}',
+) + CACHE_PRAGMAS
+
+local = threading.local()
+
+def configure(path):
+    global DATABASE
+    DATABASE = path
+    close_db()
+
+def connect(path=None):
+    # A new connection with the tuned pragmas, for code that needs a connection of its own
+    conn = sqlite3.connect(path or DATABASE, timeout=BUSY_TIMEOUT)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db():
+    # The connection of the current thread, reused across requests. A connection inherited through fork is never reused.
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid() or local.path != DATABASE:
+        local.conn = conn = connect()
+        local.pid = os.getpid()
+        local.path = DATABASE
+    return conn
+
+def close_db():
+    conn = getattr(local, 'conn', None)
+    if conn is not None and local.pid == os.getpid():
+        conn.close()
+    local.conn = None
+
+def report_path():
+    return REPORT_DATABASE or os.path.splitext(os.path.abspath(DATABASE))[0] + '-reports.db'
+
+def connect_report(path=None):
+    # A read-only connection to the report snapshot. A snapshot is never changed, a refresh replaces the file,
+    # so the connection needs no locks.
+    conn = sqlite3.connect(f'file:{quote(path or report_path())}?mode=ro&immutable=1', uri=True)
+    for pragma in CACHE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_report_db():
+    # The snapshot connection of the current thread, None before the first snapshot was made. After a refresh
+    # replaced the file the next call opens the new one.
+    path = report_path()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, stat.st_ino, stat.st_mtime_ns, os.getpid())
+    conn = getattr(local, 'report_conn', None)
+    if conn is None or local.report_key != key:
+        if conn is not None and local.report_key[3] == os.getpid():
+            conn.close()
+        local.report_conn = conn = connect_report(path)
+        local.report_key = key
+    return conn
+
+def begin_immediate(conn):
+    # BEGIN IMMEDIATE that waits up to BUSY_TIMEOUT for the write lock like the busy timeout does,
+    # but counts every attempt that found the lock taken and the time spent waiting
+    deadline = time.monotonic() + BUSY_TIMEOUT
+    with metrics.stage('db_lock_wait'):
+        conn.execute(f'PRAGMA busy_timeout={int(LOCK_RETRY_TIMEOUT * 1000)}')
+        try:
+            while True:
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    return
+                except sqlite3.OperationalError as e:
+                    if 'locked' not in str(e) or time.monotonic() >= deadline:
+                        raise
+                    metrics.DB_LOCK_RETRIES.inc()
+        finally:
+            conn.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}')
+
+def archive_dir():
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'archive')
+
+def archive_path(year):
+    return os.path.join(archive_dir(), f'inventory-{year}.db')
+
+def archived_years():
+    try:
+        names = os.listdir(archive_dir())
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(re.compile(r'inventory-(\d{4})\.db$').match, names) if match)
+
+def connect_history(years=None):
+    # A connection on which Invoices, InvoiceItems, PriceHistory and every view over them contain the rows of the
+    # database and of the archives of years (all archives if None). The archives are attached and the tables are shadowed
+    # by TEMP views of the same name, so the queries of the application run unchanged. Writes go to the database.
+    archived = archived_years()
+    years = archived if years is None else sorted(set(years) & set(archived))
+    if len(years) > MAX_ATTACHED:
+        raise ValueError(f"{len(years)} archived years requested, SQLite attaches at most {MAX_ATTACHED} databases")
+    conn = connect()
+    try:
+        for year in years:
+            conn.execute(f'ATTACH DATABASE ? AS archive_{year}', (archive_path(year),))
+        for table in ARCHIVE_TABLES:
+            # Columns are listed by name, an archive written before a column was added has NULL in it
+            columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+            selects = [f'SELECT {", ".join(columns)} FROM main.{table}']
+            for year in years:
+                archived_columns = {row[1] for row in conn.execute(f'PRAGMA archive_{year}.table_info({table})')}
+                selects.append('SELECT ' + ', '.join(column if column in archived_columns else f'NULL AS {column}'
+                                                     for column in columns) + f' FROM archive_{year}.{table}')
+            conn.execute(f'CREATE TEMP VIEW {table} AS ' + ' UNION ALL '.join(selects))
+
+        # A view of the database always reads the tables of the database, the views that read the archived tables
+        # (directly or through another view) are created again in TEMP where they see the union
+        views = conn.execute("SELECT name, sql FROM main.sqlite_master WHERE type = 'view' ORDER BY rowid").fetchall()
+        shadowed = set(ARCHIVE_TABLES)
+        changed = True
+        while changed:
+            changed = False
+            for name, sql in views:
+                if name not in shadowed and any(re.search(rf'\b{other}\b', sql, re.IGNORECASE) for other in shadowed):
+                    shadowed.add(name)
+                    changed = True
+        for name, sql in views:
+            if name in shadowed:
+                conn.execute(re.sub(r'^\s*CREATE\s+VIEW\s+(IF\s+NOT\s+EXISTS\s+)?', 'CREATE TEMP VIEW ', sql, flags=re.IGNORECASE))
+    except Exception:
+        conn.close()
+        raise
+    return conn
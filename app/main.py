@@ -1,488 +1,1301 @@
+import collections
+import csv
 import datetime
+import fcntl
+import functools
+import hashlib
+import io
+import json
+import math
 import re
 import os
-import pdfplumber
-from tabulate import tabulate
-from flask import Flask, render_template, request, redirect
-from flask import url_for
 import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+from contextlib import closing, nullcontext
+from decimal import Decimal, InvalidOperation
+from enum import Enum
+from urllib.parse import quote
+from flask import Flask, render_template, request, redirect
+from flask import url_for, jsonify, Response, stream_with_context, abort, g, make_response
 from werkzeug.utils import secure_filename
-import requests
+from markupsafe import escape
+import click
+# pdfminer, requests and multiprocessing are imported where they are
+# used, a worker that only serves the listings never loads them
+from db import ARCHIVE_TABLES, MAX_ATTACHED, archive_path, archived_years, begin_immediate, connect, connect_history, get_db
+from db import connect_report, get_report_db, report_path
+import metrics
+from migrations import INVENTORY_TOTALS_SQL, PRICE_STATS_SQL, SCHEMA_VERSION, SUPPLIER_STATS_SQL
+from migrations import migrate, rebuild_aggregates, rebuild_price_stats
 
 app = Flask(__name__)
 
-def match_company_street_city(text):
-    pattern = r'^(.*)\n(\w.*\s\d+)\n(.*?)$'
-    match = re.search(pattern, text, re.MULTILINE)
-    if match:
-        line1, line2, line3 = match.groups()
-        return line1, line2, line3
-    else:
-        return None
-
-def extract_data(text):
+class Unit(str, Enum):
+    KILOGRAM = 'kg'
+    PIECE = 'Stk'
+
+# Receipt line patterns, compiled once
+RECEIPT_DASHES_RE = re.compile(r'-{3,}')
+RECEIPT_TOTAL_RE = re.compile(r'\bTotal\b', re.IGNORECASE)
+STREET_RE = re.compile(r'\w.*\s\d+')
+DATE_RE = re.compile(r'\b(?:0[1-9]|[12]\d|3[01])\.(?:0[1-9]|1[0-2])\.\d{4}\b')
+UNIT_QUANTITY_RE = re.compile(r'(\d+(?:,\d+)?) (kg|Stk) x (\d+,\d+)')
+ITEM_RE = re.compile(r'(.*) (\d+,\d+)')
+MULTIPLE_RE = re.compile(r'x(\d+)\s+(\d+)')
+ITEM_NAME_SUFFIX_RE = re.compile(r'\s+x.*')
+
+def parse_decimal(value):
+    # Accepts German ('1,99') and English ('1.99') decimal separators
+    return Decimal(str(value).strip().replace(',', '.'))
+
+def iso_date(value):
+    # dd.mm.yyyy as printed on eBons -> yyyy-mm-dd as stored, anything else is returned unchanged
+    match = re.fullmatch(r'(\d{2})\.(\d{2})\.(\d{4})', value or '')
+    return f'{match.group(3)}-{match.group(2)}-{match.group(1)}' if match else value
+
+def parse_item_line(line, current_item, items):
+    # Applies one line of the item section and returns the item following lines refer to
+    if current_item is not None and ' x ' in line:
+        # "0,856 kg x 2,29 EUR/kg" or "2 Stk x 0,49" belongs to the item above
+        quantity_match = UNIT_QUANTITY_RE.search(line)
+        if quantity_match:
+            current_item['quantity'] = parse_decimal(quantity_match.group(1))
+            current_item['unit'] = Unit(quantity_match.group(2))
+            current_item['unit_price'] = parse_decimal(quantity_match.group(3))
+            return current_item
+
+    item_match = ITEM_RE.match(line) if ',' in line else None
+    if item_match:
+        name = item_match.group(1).strip()
+        total_price = parse_decimal(item_match.group(2))
+        current_item = {
+            'name': ITEM_NAME_SUFFIX_RE.sub('', name) if 'x' in name else name,
+            'total_price': total_price,
+            'quantity': Decimal(1),
+            'unit': Unit.PIECE,
+            'unit_price': total_price,
+        }
+        items.append(current_item)
+
+    if current_item is not None and 'x' in line:
+        # "MINERALWASSER x3 1,77" is a multi-buy of the current item
+        multiple_match = MULTIPLE_RE.search(line)
+        if multiple_match and int(multiple_match.group(1)):
+            quantity = int(multiple_match.group(1))
+            current_item['quantity'] = Decimal(quantity)
+            # Rounded on the float value, e.g. 7,63 / 2 gives 3,81 like it always did
+            current_item['unit_price'] = Decimal(str(round(float(current_item['total_price']) / quantity, 2)))
+            current_item['unit'] = Unit.PIECE
+    return current_item
+
+def is_receipt_end(line):
+    # The item section ends at a line of dashes or the total
+    return RECEIPT_DASHES_RE.fullmatch(line.strip()) is not None or RECEIPT_TOTAL_RE.search(line) is not None
+
+def parse_receipt(text):
+    # Single pass over the receipt lines collecting the market header, the items and the date
     lines = text.split('\n')
     items = []
     current_item = None
-    company_name = None
-    street = None
-    zip_code = ''
-    city = None
-
-    # Match company name, street, and city using match_company_street_city function
-    company_match = match_company_street_city(text)
-    date_match = re.search(r'\b(?:0[1-9]|[12]\d|3[01])\.(?:0[1-9]|1[0-2])\.\d{4}\b', text)
-
-    if date_match:
-        date = date_match.group()
-    if company_match:
-        company_name, street, city = company_match
-
-    # Split city into zip_code and city components
-    if city:
+    header = None
+    date = None
+    in_items = True
+
+    for i, line in enumerate(lines):
+        # The market header is the first street line ("Musterstr. 12") with a line before and after it
+        if header is None and 0 < i < len(lines) - 1 and STREET_RE.fullmatch(line):
+            header = (lines[i - 1], line, lines[i + 1])
+        if date is None and '.' in line:
+            date_match = DATE_RE.search(line)
+            if date_match:
+                date = date_match.group()
+
+        if in_items:
+            if is_receipt_end(line):
+                in_items = False
+            else:
+                current_item = parse_item_line(line, current_item, items)
+        elif header is not None and date is not None:
+            break
+
+    company_name, street, zip_code, city = None, None, '', None
+    if header:
+        company_name, street, city = header
+        # Split city into zip_code and city components
         city_parts = city.split(' ', 1)
         if len(city_parts) == 2:
             zip_code, city = city_parts
 
-    for line in lines:
-        if re.match(r'^-{3,}$', line.strip()) or re.search(r'\bTotal\b', line, re.IGNORECASE):
-            break
-        if current_item:
-            quantity_match = re.search(r'(\d+(?:,\d+)? (?:kg|Stk)) x (\d+,\d+)', line)
-            if quantity_match:
-                quantity_data = quantity_match.group(1).split()
-                current_item['quantity'] = quantity_data[0]
-                current_item['unit'] = quantity_data[1]
-                current_item['unit_price'] = quantity_match.group(2)
-                continue
-        item_match = re.match(r'(.*) (\d+,\d+)', line)
-        if item_match:
-            current_item = {'name': re.sub(r'\s+x.*', '', item_match.group(1).strip()), 'total_price': item_match.group(2)}
-            items.append(current_item)
-        quantity_match = re.search(r'x(\d+)\s+(\d+)', line)
-        if quantity_match:
-            current_item['quantity'] = quantity_match.group(1)
-            current_item['unit_price'] = str(round(float(current_item['total_price'].replace(',', '.')) / float(quantity_match.group(1).replace(',', '.')) , 2)).replace('.', ',')
-            current_item['unit'] = 'Stk'
+    return {'CompanyName': company_name, 'street': street, 'zip_code': zip_code, 'city': city}, items, date
 
+def extract_data(text):
+    with metrics.stage('parse'):
+        company_info, items, date = parse_receipt(text)
+    company_name = company_info['CompanyName']
+    street = company_info['street']
+    zip_code = company_info['zip_code']
+    city = company_info['city']
+
+    # Market lookup, served from the MarketCache table whenever possible
+    with metrics.stage('market_lookup'):
+        market = lookup_market(street, zip_code)
+    if market:
+        company_name = market.get('companyName', company_name)
+        city = market.get('contactCity', city)
+        street = market.get('contactStreet', street)
+        zip_code = market.get('contactZipCode', zip_code)
 
+    return {'CompanyName': company_name, 'street': street, 'zip_code': zip_code, 'city': city}, items, date
+
+# 'online' asks the market search API on a cache miss, 'offline' only ever uses the cache
+MARKET_LOOKUP = os.environ.get('MARKET_LOOKUP', 'online')
+# Point this at a local stand-in server to run without rewe.de
+MARKET_SEARCH_URL = os.environ.get('MARKET_SEARCH_URL', 'https://www.rewe.de/api/marketsearch')
+MARKET_SEARCH_TIMEOUT = float(os.environ.get('MARKET_SEARCH_TIMEOUT', 5))
+MARKET_CACHE_TTL = int(os.environ.get('MARKET_CACHE_TTL', 30 * 24 * 3600))
+MARKET_CACHE_NEGATIVE_TTL = int(os.environ.get('MARKET_CACHE_NEGATIVE_TTL', 24 * 3600))
+
+market_session = None
+market_session_pid = None
+
+def get_market_session():
+    # One pooled session per process, a session inherited through fork must not be reused
+    global market_session, market_session_pid
+    if market_session is None or market_session_pid != os.getpid():
+        import requests
+        market_session = requests.Session()
+        market_session_pid = os.getpid()
+    return market_session
+
+def market_cache_key(street, zip_code):
+    street = ' '.join(str(street or '').casefold().split())
+    street = re.sub(r'(strasse|straße|str\.)(?=\s|$)', 'str', street)
+    return f"{street}|{str(zip_code or '').strip()}"
+
+def lookup_market(street, zip_code):
+    # Returns the first market search result as a dict, or None if the market is unknown
+    key = market_cache_key(street, zip_code)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT response, fetched_at FROM MarketCache WHERE search_key=?', (key,))
+    cached = c.fetchone()
+
+    if cached:
+        response, fetched_at = cached
+        ttl = MARKET_CACHE_TTL if response is not None else MARKET_CACHE_NEGATIVE_TTL
+        if time.time() - fetched_at < ttl or MARKET_LOOKUP == 'offline':
+            metrics.MARKET_LOOKUPS.inc(result='hit')
+            return json.loads(response) if response is not None else None
+
+    metrics.MARKET_LOOKUPS.inc(result='miss')
+    if MARKET_LOOKUP == 'offline':
+        return None
 
-    # API Request
     try:
-        api_url = f"https://www.rewe.de/api/marketsearch?searchTerm={street} {zip_code}"
-        response = requests.get(api_url)
+        response = get_market_session().get(MARKET_SEARCH_URL, params={'searchTerm': f"{street} {zip_code}"},
+                                            timeout=MARKET_SEARCH_TIMEOUT)
         response.raise_for_status()  # Raise an exception for non-successful status codes
         json_data = response.json()
-        
-        # Extracting data from the API response
-        if json_data:
-            company_name = json_data[0].get('companyName', company_name)
-            city = json_data[0].get('contactCity', city)
-            street = json_data[0].get('contactStreet', street)
-            zip_code = json_data[0].get('contactZipCode', zip_code)
-        else:
-            company_name = company_name
-            city = city
-    
-    except requests.exceptions.RequestException:
-        company_name = company_name
-        city = city
-
-    except Exception as e:
-        # Handle any other exceptions here
-        company_name = company_name
-        city = city
-    
-    return {'CompanyName': company_name, 'street': street, 'zip_code': zip_code, 'city': city}, items, date
+        market = json_data[0] if json_data else None
+        if market is not None and not isinstance(market, dict):
+            raise ValueError('Unexpected market search response')
+    except Exception:
+        # Do not cache errors, fall back to a stale entry if there is one
+        metrics.MARKET_LOOKUPS.inc(result='error')
+        if cached and cached[0] is not None:
+            return json.loads(cached[0])
+        return None
 
-def create_table():
-    # Connect to the database or create a new one if it doesn't exist
-    conn = sqlite3.connect('inventory.db')
-    cursor = conn.cursor()
-
-    # Create the Invoices table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Invoices (
-            invoice_id INTEGER PRIMARY KEY,
-            date TEXT DEFAULT (datetime('now','localtime')),
-            supplier_id INTEGER,
-            total_amount REAL,
-            due_date TEXT,
-            currency TEXT,
-            payment_status TEXT DEFAULT 'Paid',
-            FOREIGN KEY (supplier_id) REFERENCES Suppliers (supplier_id)
-        )
-    ''')
-
-    # Create the Products table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Products (
-            product_id INTEGER PRIMARY KEY,
-            name TEXT UNIQUE,
-            description TEXT,
-            price REAL,
-            category_id INTEGER,
-            manufacturer TEXT,
-            weight REAL,
-            dimensions TEXT,
-            SKU TEXT,
-            unit_id INTEGER,
-            FOREIGN KEY (category_id) REFERENCES Categories (category_id),
-            FOREIGN KEY (unit_id) REFERENCES Units (unit_id)
-        )
-    ''')
-
-    # Create the InvoiceItems table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS InvoiceItems (
-            invoice_item_id INTEGER PRIMARY KEY,
-            invoice_id INTEGER,
-            product_id INTEGER,
-            quantity INTEGER,
-            unit_price REAL,
-            discount_percentage REAL,
-            tax_rate REAL,
-            FOREIGN KEY (invoice_id) REFERENCES Invoices (invoice_id),
-            FOREIGN KEY (product_id) REFERENCES Products (product_id)
-        )
-    ''')
-
-    # Create the Categories table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Categories (
-            category_id INTEGER PRIMARY KEY,
-            name TEXT,
-            description TEXT
-        )
-    ''')
-
-    # Create the Suppliers table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Suppliers (
-            supplier_id INTEGER PRIMARY KEY,
-            name TEXT,
-            address TEXT,
-            contact_number TEXT,
-            email TEXT,
-            preferred_payment_terms TEXT,
-            lead_time INTEGER,
-            CHECK (lead_time >= 0)
-        )
-    ''')
-
-    # Create the Units table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Units (
-            unit_id INTEGER PRIMARY KEY,
-            name TEXT,
-            abbreviation TEXT
-        )
-    ''')
-
-    # Check if Kilogramm exists in the Units table
-    cursor.execute("SELECT * FROM Units WHERE name='Kilogramm'")
-    result = cursor.fetchone()
-
-    # If Kilogramm doesn't exist, insert it into the Units table
-    if not result:
-        cursor.execute("INSERT INTO Units (name, abbreviation) VALUES ('Kilogramm', 'kg')")
-
-    # Check if Stück exists in the Units table
-    cursor.execute("SELECT * FROM Units WHERE name='Stück'")
-    result = cursor.fetchone()
-
-    # If Stück doesn't exist, insert it into the Units table
-    if not result:
-        cursor.execute("INSERT INTO Units (name, abbreviation) VALUES ('Stück', 'Stk')")
-
-    # Create the InventoryLevels table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS InventoryLevels (
-            inventory_id INTEGER PRIMARY KEY,
-            product_id INTEGER,
-            quantity REAL,
-            reorder_point INTEGER,
-            FOREIGN KEY (product_id) REFERENCES Products (product_id),
-            CHECK (quantity >= 0 AND reorder_point >= 0)
-        )
-    ''')
-
-    # Create the ProductAttributes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ProductAttributes (
-            attribute_id INTEGER PRIMARY KEY,
-            product_id INTEGER,
-            attribute_name TEXT,
-            attribute_value TEXT,
-            FOREIGN KEY (product_id) REFERENCES Products (product_id)
-        )
-    ''')
-
-    # Create the PriceHistory table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS PriceHistory (
-            price_id INTEGER PRIMARY KEY,
-            product_id INTEGER,
-            price REAL,
-            date_changed TEXT DEFAULT (datetime('now','localtime')),
-            FOREIGN KEY (product_id) REFERENCES Products (product_id)
-        )
-    ''')
-
-
-    #views ###############################################################################################################################
-
-    # View_SupplierList
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_SupplierList AS
-        SELECT supplier_id, name, address, contact_number, email, preferred_payment_terms, lead_time
-        FROM Suppliers
-    ''')
-
-    # View_CategoryList
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_CategoryList AS
-        SELECT category_id, name, description
-        FROM Categories
-    ''')
-
-    # View_UnitList
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_UnitList AS
-        SELECT unit_id, name, abbreviation
-        FROM Units
-    ''')
-
-    # View_InventoryLevels
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_InventoryLevels AS
-        SELECT inventory_id, product_id, quantity, reorder_point
-        FROM InventoryLevels
-    ''')
-
-# Create InvoiceDetails view
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS InvoiceDetails AS
-        SELECT Invoices.invoice_id, Invoices.date, Invoices.total_amount, Invoices.due_date, Invoices.currency, Invoices.payment_status,
-            Suppliers.name AS supplier_name, Suppliers.address AS supplier_address,
-            InvoiceItems.product_id, InvoiceItems.quantity, InvoiceItems.unit_price, InvoiceItems.discount_percentage, InvoiceItems.tax_rate,
-            Products.name AS product_name, Products.description AS product_description, Products.price AS product_price, Products.manufacturer,
-            Categories.name AS category_name, Units.name AS unit_name
-        FROM Invoices
-        INNER JOIN Suppliers ON Invoices.supplier_id = Suppliers.supplier_id
-        INNER JOIN InvoiceItems ON Invoices.invoice_id = InvoiceItems.invoice_id
-        INNER JOIN Products ON InvoiceItems.product_id = Products.product_id
-        LEFT JOIN Categories ON Products.category_id = Categories.category_id
-        INNER JOIN Units ON Products.unit_id = Units.unit_id;
-    ''')
-
-
-
-    # View_SupplierDetails
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_SupplierDetails AS
-        SELECT s.supplier_id, s.name, s.address, s.contact_number, s.email, s.preferred_payment_terms, s.lead_time,
-            i.invoice_id, i.date, i.total_amount, i.due_date, i.currency, i.payment_status
-        FROM Suppliers AS s
-        LEFT JOIN Invoices AS i ON s.supplier_id = i.supplier_id
-    ''')
-
-    # View_CategoryDetails
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_CategoryDetails AS
-        SELECT c.category_id, c.name, c.description, p.product_id, p.name, p.description, p.price
-        FROM Categories AS c
-        LEFT JOIN Products AS p ON c.category_id = p.category_id
-    ''')
-
-    # View_UnitDetails
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_UnitDetails AS
-        SELECT u.unit_id, u.name, u.abbreviation, p.product_id, p.name, p.description, p.price
-        FROM Units AS u
-        LEFT JOIN Products AS p ON u.unit_id = p.unit_id
-    ''')
-
-    # View_TotalInventoryValue
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_TotalInventoryValue AS
-        SELECT p.product_id, p.name, SUM(il.quantity * ii.unit_price) AS total_value
-        FROM Products AS p
-        INNER JOIN InventoryLevels AS il ON p.product_id = il.product_id
-        INNER JOIN InvoiceItems AS ii ON p.product_id = ii.product_id
-        GROUP BY p.product_id
-    ''')
-
-    # View_SuppliersWithMostInvoices
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_SuppliersWithMostInvoices AS
-        SELECT s.supplier_id, s.name, COUNT(i.invoice_id) AS invoice_count
-        FROM Suppliers AS s
-        LEFT JOIN Invoices AS i ON s.supplier_id = i.supplier_id
-        GROUP BY s.supplier_id
-        ORDER BY invoice_count DESC
-    ''')
-
-    # View_OutOfStockProducts
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_OutOfStockProducts AS
-        SELECT p.product_id, p.name, p.price
-        FROM Products AS p
-        LEFT JOIN InventoryLevels AS il ON p.product_id = il.product_id
-        WHERE il.quantity = 0
-    ''')
-
-    # View_TopSuppliersByRevenue
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_TopSuppliersByRevenue AS
-        SELECT s.supplier_id, s.name, SUM(i.total_amount) AS total_revenue
-        FROM Suppliers AS s
-        LEFT JOIN Invoices AS i ON s.supplier_id = i.supplier_id
-        GROUP BY s.supplier_id
-        ORDER BY total_revenue DESC
-    ''')
-
-    # Create the ProductPriceHistory view
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS View_ProductPriceHistory AS
-        SELECT p.product_id, p.name, ph.price, ph.date_changed
-        FROM Products AS p
-        INNER JOIN PriceHistory AS ph ON p.product_id = ph.product_id
-    ''')
-
-    # Create the ProductInventoryView view
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS ProductInventoryView AS
-        SELECT p.product_id, p.name, p.price, il.quantity, u.abbreviation, ROUND(p.price * il.quantity, 2) AS total_price
-        FROM Products p
-        JOIN InventoryLevels il ON p.product_id = il.product_id
-        JOIN Units u ON p.unit_id = u.unit_id
-        WHERE il.quantity > 0
-    ''')
-
-    # Create the InvoiceView view
-    cursor.execute('''
-        CREATE VIEW IF NOT EXISTS InvoiceView AS
-        SELECT i.invoice_id, i.date, s.name AS supplier_name, s.address AS supplier_address, i.total_amount, i.due_date, i.currency, i.payment_status
-        FROM Invoices i
-        JOIN Suppliers s ON i.supplier_id = s.supplier_id
-    ''')
-
-    # Commit the changes and close the connection
+    # An empty result is cached as well (negative caching), with its own TTL
+    c.execute('''INSERT INTO MarketCache (search_key, response, fetched_at) VALUES (?, ?, ?)
+                 ON CONFLICT (search_key) DO UPDATE SET response=excluded.response, fetched_at=excluded.fetched_at''',
+              (key, json.dumps(market) if market is not None else None, time.time()))
     conn.commit()
-    conn.close()
+    return market
+
+# Aggregates ###############################################################################################################################
+
+# Money sums are rounded to cents, the inventory value is a sum of products and may drift by float rounding
+AGGREGATE_TOLERANCE = 0.005
 
+def verify_aggregates(c):
+    # Returns a description of every difference between the summary tables and a recomputation from scratch
+    differences = []
 
-def write_to_database(data, pdf_file, company_info, date):
-    print (data, pdf_file, company_info)
-    conn = sqlite3.connect('inventory.db')
+    c.execute(INVENTORY_TOTALS_SQL)
+    expected = c.fetchone()
+    c.execute('SELECT id, total_value, products_in_stock FROM InventoryTotals WHERE id = 1')
+    stored = c.fetchone()
+    if stored is None:
+        differences.append('InventoryTotals: row missing')
+    else:
+        if abs(stored[1] - expected[1]) > AGGREGATE_TOLERANCE:
+            differences.append(f'InventoryTotals.total_value: {stored[1]} != {expected[1]}')
+        if stored[2] != expected[2]:
+            differences.append(f'InventoryTotals.products_in_stock: {stored[2]} != {expected[2]}')
+
+    c.execute(SUPPLIER_STATS_SQL)
+    expected = {row[0]: row[1:] for row in c.fetchall()}
+    c.execute('SELECT supplier_id, invoice_count, total_revenue FROM SupplierStats')
+    stored = {row[0]: row[1:] for row in c.fetchall()}
+    for supplier_id in sorted(expected.keys() | stored.keys()):
+        if supplier_id not in stored:
+            differences.append(f'SupplierStats {supplier_id}: row missing')
+        elif supplier_id not in expected:
+            differences.append(f'SupplierStats {supplier_id}: row of a deleted supplier')
+        elif (stored[supplier_id][0] != expected[supplier_id][0]
+              or abs(stored[supplier_id][1] - expected[supplier_id][1]) > AGGREGATE_TOLERANCE):
+            differences.append(f'SupplierStats {supplier_id}: {tuple(stored[supplier_id])} != {tuple(expected[supplier_id])}')
+
+    c.execute(PRICE_STATS_SQL.format(where='WHERE price IS NOT NULL'))
+    expected = {row[0]: row[1:] for row in c.fetchall()}
+    c.execute('''SELECT product_id, min_price, max_price, first_price, first_date, last_price, last_date, price_count, price_sum
+                 FROM PriceStats''')
+    stored = {row[0]: row[1:] for row in c.fetchall()}
+    for product_id in sorted(expected.keys() | stored.keys()):
+        if product_id not in stored:
+            differences.append(f'PriceStats {product_id}: row missing')
+        elif product_id not in expected:
+            differences.append(f'PriceStats {product_id}: row without price history')
+        elif (stored[product_id][:-1] != expected[product_id][:-1]
+              or abs(stored[product_id][-1] - expected[product_id][-1]) > AGGREGATE_TOLERANCE):
+            differences.append(f'PriceStats {product_id}: {tuple(stored[product_id])} != {tuple(expected[product_id])}')
+    return differences
+
+@app.cli.command('verify-aggregates')
+@click.option('--rebuild', is_flag=True, help='Recompute the summary tables if they differ.')
+def verify_aggregates_command(rebuild):
+    """Recompute the inventory value, supplier and price statistics from scratch and compare them with the summary tables."""
+    # The summary tables count the archived years as well
+    conn = connect_history() if archived_years() else get_db()
+    with conn:
+        begin_immediate(conn)
+        c = conn.cursor()
+        differences = verify_aggregates(c)
+        for difference in differences:
+            click.echo(difference)
+        if differences and rebuild:
+            rebuild_aggregates(c)
+            rebuild_price_stats(c)
+            click.echo(f"Rebuilt summary tables, {len(differences)} differences fixed")
+    if differences and not rebuild:
+        raise SystemExit(1)
+    if not differences:
+        click.echo("Summary tables OK")
+
+
+# Query plans ##############################################################################################################################
+
+# (name, query, parameters) of every view and hot query, queried the way the application queries it. None of them may
+# scan a table or an index, they read the rows they return and no others. Queries that read a whole table on purpose
+# (the exports, the price overview, the first page of a listing) are timed by benchmarks/queries.py instead.
+QUERY_PLAN_CHECKS = [
+    ('View_SupplierList', 'SELECT * FROM View_SupplierList WHERE supplier_id = ?', (1,)),
+    ('View_CategoryList', 'SELECT * FROM View_CategoryList WHERE category_id = ?', (1,)),
+    ('View_UnitList', 'SELECT * FROM View_UnitList WHERE unit_id = ?', (1,)),
+    ('View_InventoryLevels', 'SELECT * FROM View_InventoryLevels WHERE product_id = ?', (1,)),
+    ('InvoiceDetails', 'SELECT * FROM InvoiceDetails WHERE invoice_id = ?', (1,)),
+    ('View_SupplierDetails', 'SELECT * FROM View_SupplierDetails WHERE supplier_id = ?', (1,)),
+    ('View_CategoryDetails', 'SELECT * FROM View_CategoryDetails WHERE category_id = ?', (1,)),
+    ('View_UnitDetails', 'SELECT * FROM View_UnitDetails WHERE unit_id = ?', (1,)),
+    ('View_TotalInventoryValue', 'SELECT * FROM View_TotalInventoryValue WHERE product_id = ?', (1,)),
+    ('View_SuppliersWithMostInvoices', 'SELECT * FROM View_SuppliersWithMostInvoices WHERE supplier_id = ?', (1,)),
+    ('View_OutOfStockProducts', 'SELECT * FROM View_OutOfStockProducts WHERE product_id = ?', (1,)),
+    ('View_TopSuppliersByRevenue', 'SELECT * FROM View_TopSuppliersByRevenue WHERE supplier_id = ?', (1,)),
+    ('View_ProductPriceHistory', 'SELECT * FROM View_ProductPriceHistory WHERE product_id = ?', (1,)),
+    ('ProductInventoryView', 'SELECT * FROM ProductInventoryView WHERE product_id = ?', (1,)),
+    ('InvoiceView', 'SELECT * FROM InvoiceView WHERE invoice_id = ?', (1,)),
+    ('supplier by address', 'SELECT supplier_id FROM Suppliers WHERE address = ?', ('',)),
+    ('product by name', 'SELECT product_id FROM Products WHERE name = ?', ('',)),
+    ('inventory of product', 'SELECT quantity FROM InventoryLevels WHERE product_id = ?', (1,)),
+    ('invoice items of product', 'SELECT * FROM InvoiceItems WHERE product_id = ?', (1,)),
+    ('items by name prefix', '''SELECT * FROM ProductInventoryView WHERE name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE
+                                ORDER BY product_id LIMIT 51''', ('a', 'a\U0010ffff')),
+    ('invoices of supplier', '''SELECT * FROM Invoices i JOIN Suppliers s ON i.supplier_id = s.supplier_id
+                                WHERE i.supplier_id = ? ORDER BY i.invoice_id DESC LIMIT 51''', (1,)),
+    ('invoices in date range', '''SELECT * FROM Invoices i JOIN Suppliers s ON i.supplier_id = s.supplier_id
+                                  WHERE i.date >= ? AND i.date < ? ORDER BY i.invoice_id DESC LIMIT 51''', ('2023-01-01', '2023-02-01')),
+    ('spend per month', '''SELECT substr(i.date, 1, 7) AS period, count(*), sum(i.total_amount) FROM Invoices i
+                           WHERE i.date >= ? AND i.date < ? AND i.supplier_id = ? GROUP BY period''', ('2023-01-01', '2024-01-01', 1)),
+    ('spend per supplier', '''SELECT i.supplier_id, s.name, count(*), sum(i.total_amount) FROM Invoices i
+                              JOIN Suppliers s ON i.supplier_id = s.supplier_id
+                              WHERE i.date >= ? AND i.date < ? GROUP BY i.supplier_id''', ('2023-01-01', '2024-01-01')),
+    ('price series', '''SELECT date_changed, price FROM PriceHistory WHERE product_id = ? AND price IS NOT NULL
+                        AND date_changed >= ? AND date_changed < ? ORDER BY date_changed, price_id''', (1, '2023-01-01', '2024-01-01')),
+    ('receipt fingerprint', 'SELECT invoice_id FROM ReceiptFingerprints WHERE fingerprint IN (?, ?) LIMIT 1', ('', '')),
+    ('inventory totals', 'SELECT total_value, products_in_stock FROM InventoryTotals WHERE id = 1', ()),
+    ('cached market', 'SELECT response, fetched_at FROM MarketCache WHERE search_key = ?', ('',)),
+    ('next job', '''SELECT job_id FROM Jobs
+                     WHERE status='queued' OR (status='running' AND started_at < datetime('now','localtime', ?))
+                     ORDER BY job_id LIMIT 1''', ('-600 seconds',)),
+]
+
+def explain_query(c, query, params=()):
+    # Returns the query plan lines and the table (or index) scans among them
+    c.execute('EXPLAIN QUERY PLAN ' + query, params)
+    details = [row[3] for row in c.fetchall()]
+    # Scanning the result of a subquery or view that is computed once is not a table scan
+    subqueries = {detail.split(' ', 1)[1] for detail in details if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    scans = [detail for detail in details if detail.startswith('SCAN ') and detail.split()[1] not in subqueries]
+    return details, scans
+
+def check_query_plans(conn):
+    # Returns (name, plan, scans) for every query that scans a table or an index
     c = conn.cursor()
+    failures = []
+    for name, query, params in QUERY_PLAN_CHECKS:
+        details, scans = explain_query(c, query, params)
+        if scans:
+            failures.append((name, details, scans))
+    return failures
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a view or hot query scans a table or an index instead of searching it."""
+    failures = check_query_plans(get_db())
+    for name, details, scans in failures:
+        click.echo(f"{name}: scan ({', '.join(scans)})")
+        for detail in details:
+            click.echo(f"    {detail}")
+    if failures:
+        raise SystemExit(1)
+    click.echo(f"{len(QUERY_PLAN_CHECKS)} query plans OK")
+
+# Unit ids by abbreviation, the Units table is only changed by migrations
+unit_ids = {}
+
+# Rows per multi-row INSERT, keeps the number of bound variables far below SQLite's limit
+PRODUCT_UPSERT_CHUNK = 300
+
+def get_unit_id(c, abbreviation):
+    if abbreviation not in unit_ids:
+        c.execute('SELECT abbreviation, unit_id FROM Units')
+        unit_ids.update(c.fetchall())
+        if abbreviation not in unit_ids:
+            raise ValueError(f"Unknown unit {abbreviation}")
+    return unit_ids[abbreviation]
+
+class DuplicateReceipt(Exception):
+    def __init__(self, invoice_id):
+        super().__init__(f"Duplicate of invoice {invoice_id}")
+        self.invoice_id = invoice_id
+
+def pdf_fingerprint(pdf_bytes):
+    return 'pdf:' + hashlib.sha256(pdf_bytes).hexdigest()
+
+def receipt_fingerprint(company_info, items, date):
+    # Catches the same receipt exported to a new PDF: date, market, total and item lines, independent of formatting
+    lines = [iso_date(date or ''), market_cache_key(company_info['street'], company_info['zip_code']),
+             f"{sum(Decimal(str(item['total_price'])) for item in items):.2f}"]
+    for item in items:
+        lines.append(f"{item['name']}|{Decimal(str(item['quantity'])):.3f}|{Unit(item['unit']).value}|"
+                     f"{Decimal(str(item['total_price'])):.2f}")
+    return 'receipt:' + hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+def find_duplicate(c, fingerprints):
+    # Returns the invoice_id an already ingested fingerprint belongs to, or None
+    if not fingerprints:
+        return None
+    c.execute(f"SELECT invoice_id FROM ReceiptFingerprints WHERE fingerprint IN ({', '.join('?' * len(fingerprints))}) LIMIT 1",
+              list(fingerprints))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def write_to_database(data, pdf_file, company_info, date, fingerprints=None):
+    # fingerprints (e.g. the PDF hash) mark an ingested eBon, the receipt fingerprint is added to them.
+    # Without fingerprints (manually added receipts) nothing is checked for duplicates.
+    conn = get_db()
+    duplicate = None
+    with metrics.stage('db_write'), conn:
+        # Take the write lock up front, the whole receipt is one transaction
+        begin_immediate(conn)
+        try:
+            invoice_id = write_invoice(conn.cursor(), data, company_info, date, fingerprints)
+        except DuplicateReceipt as e:
+            # Still commit, write_invoice remembered the new fingerprints of the known receipt
+            duplicate = e
+    if duplicate is not None:
+        raise duplicate
+    metrics.RECEIPTS_INGESTED.inc()
+    return invoice_id
+
+def write_invoice(c, data, company_info, date, fingerprints=None):
+    # Writes one receipt with a fixed number of statements, no matter how many items it has.
+    # The caller is responsible for the transaction.
+    if fingerprints is not None:
+        fingerprints = list(fingerprints) + [receipt_fingerprint(company_info, data, date)]
+        duplicate = find_duplicate(c, fingerprints)
+        if duplicate is not None:
+            # A re-exported PDF of a known receipt is recognized by its bytes the next time
+            c.executemany('INSERT OR IGNORE INTO ReceiptFingerprints (fingerprint, invoice_id) VALUES (?, ?)',
+                          [(fingerprint, duplicate) for fingerprint in fingerprints])
+            raise DuplicateReceipt(duplicate)
+
     company_address_str = f"{company_info['street']}, {company_info['zip_code']} {company_info['city']}"  # Concatenate the company information
-    c.execute('SELECT * FROM Suppliers WHERE address=?', (company_address_str,))
+    c.execute('SELECT supplier_id FROM Suppliers WHERE address=?', (company_address_str,))
     existing_Supplier = c.fetchone()
-    if not existing_Supplier:
+    if existing_Supplier:
+        supplier_id = existing_Supplier[0]
+    else:
         c.execute('INSERT INTO Suppliers (name, address) VALUES (?, ?)',
                   (company_info['CompanyName'], company_address_str))
-    
-    c.execute('SELECT * FROM Suppliers WHERE address=?', (company_address_str,))
-    existing_Supplier = c.fetchone()
-    supplier_id = existing_Supplier[0]
-    c.execute('INSERT INTO Invoices (date, supplier_id) VALUES (?, ?)',
-                      (date, supplier_id))
+        supplier_id = c.lastrowid
+
+    total_amount = round(sum(float(item['total_price']) for item in data), 2)
+    c.execute('INSERT INTO Invoices (date, supplier_id, total_amount) VALUES (?, ?, ?)',
+              (iso_date(date), supplier_id, total_amount))
     invoice_id = c.lastrowid
 
-    total_amount = 0
-    for item in data:
-        total_amount += float(item['total_price'].replace(',', '.'))
-        c.execute('SELECT * FROM Products WHERE name=?', (item['name'],))
-        existing_item = c.fetchone()
-        c.execute('SELECT unit_id FROM Units WHERE abbreviation=?', (item['unit'],))
-        unit_id = c.fetchone()
-        unit_id = unit_id[0]
+    rows = [(item['name'], float(item['quantity']), float(item['unit_price']), get_unit_id(c, item['unit']))
+            for item in data]
+
+    # Insert new products and update the price of known ones, RETURNING resolves all product ids at once
+    product_ids = {}
+    for start in range(0, len(rows), PRODUCT_UPSERT_CHUNK):
+        chunk = rows[start:start + PRODUCT_UPSERT_CHUNK]
+        c.execute(f'''
+            INSERT INTO Products (name, price, unit_id) VALUES {', '.join(['(?, ?, ?)'] * len(chunk))}
+            ON CONFLICT (name) DO UPDATE SET price=excluded.price
+            RETURNING name, product_id
+        ''', [value for name, quantity, price, unit_id in chunk for value in (name, price, unit_id)])
+        product_ids.update(c.fetchall())
+
+    c.executemany('''
+        INSERT INTO InventoryLevels (product_id, quantity) VALUES (?, ?)
+        ON CONFLICT (product_id) DO UPDATE SET quantity=round(quantity + excluded.quantity, 3)
+    ''', [(product_ids[name], quantity) for name, quantity, price, unit_id in rows])
+    # Price points are dated by the receipt, a receipt without a date by when it was written
+    c.executemany('''
+        INSERT INTO PriceHistory (product_id, price, date_changed) VALUES (?, ?, coalesce(?, datetime('now','localtime')))
+    ''', [(product_ids[name], price, iso_date(date) or None) for name, quantity, price, unit_id in rows])
+    c.executemany('INSERT INTO InvoiceItems (invoice_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)',
+                  [(invoice_id, product_ids[name], quantity, price) for name, quantity, price, unit_id in rows])
+    if fingerprints:
+        c.executemany('INSERT OR IGNORE INTO ReceiptFingerprints (fingerprint, invoice_id) VALUES (?, ?)',
+                      [(fingerprint, invoice_id) for fingerprint in fingerprints])
+    return invoice_id
+
+
+
+
+@app.teardown_request
+def rollback_db(exception):
+    # The connection outlives the request, never hand it to the next request with a transaction open
+    conn = get_db()
+    if conn.in_transaction:
+        conn.rollback()
 
-        if existing_item:
+@app.route('/')
+def index():
+    return redirect('/items')
 
-            product_id = existing_item[0]
-            c.execute('SELECT * FROM InventoryLevels WHERE product_id=?', (product_id,))
-            existing_quantity = c.fetchone()
-            existing_quantity = existing_quantity[2]
+# Page cache ###############################################################################################################################
+
+# Rendered listing pages kept per process, the least recently used page goes first
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 64))
+
+def app_version():
+    # Part of every ETag, a browser must not keep a page of the previous code or template after an update
+    digest = hashlib.sha1()
+    for path in (__file__, os.path.join(app.root_path, app.template_folder, 'index.html')):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+APP_VERSION = app_version()
+
+page_cache = collections.OrderedDict()
+page_cache_generation = None
+page_cache_lock = threading.Lock()
+
+def write_generation(c):
+    # Bumped by triggers on every change to the tables behind the listings
+    c.execute('SELECT generation FROM WriteGeneration WHERE id = 1')
+    return c.fetchone()[0]
+
+def cached_page(view):
+    # For read only views that render the same page for the same URL until the database changes. The page is
+    # answered with 304 if the browser has it already, and from the page cache if another client asked for it.
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        global page_cache_generation
+        generation = write_generation(get_db().cursor())
+        key = request.full_path
+        etag = hashlib.sha1(f'{APP_VERSION}|{generation}|{key}'.encode()).hexdigest()[:20]
+
+        if request.if_none_match.contains_weak(etag):
+            metrics.PAGE_CACHE.inc(result='not_modified')
+            response = Response(status=304)
+        else:
+            with page_cache_lock:
+                if page_cache_generation != generation:
+                    # Written to since, none of the pages is current any more
+                    page_cache.clear()
+                    page_cache_generation = generation
+                cached = page_cache.get(key)
+                if cached is not None:
+                    page_cache.move_to_end(key)
+            if cached is not None:
+                metrics.PAGE_CACHE.inc(result='hit')
+                response = Response(cached[0], content_type=cached[1])
+            else:
+                metrics.PAGE_CACHE.inc(result='miss')
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    with page_cache_lock:
+                        if page_cache_generation == generation:
+                            page_cache[key] = (response.get_data(), response.content_type)
+                            while len(page_cache) > PAGE_CACHE_SIZE:
+                                page_cache.popitem(last=False)
+
+        response.set_etag(etag)
+        # The browser may keep the page, but has to ask whether it is still current every time
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return cached_view
+
+# Pagination ###############################################################################################################################
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Sortable columns per listing: url name -> (SQL expression, column index in the row, converts the row value to the sort value).
+# Every column has an index in (column, id) order, see migration_11_sort_indexes. The quantity and total price of an item
+# and the supplier name of an invoice are not sortable, no single index has the rows in their order.
+ITEM_SORT_COLUMNS = {
+    'product_id': ('product_id', 0, int),
+    'name': ('name', 1, str),
+    'unit_price': ('price', 2, float),
+}
+INVOICE_SORT_COLUMNS = {
+    'invoice_id': ('i.invoice_id', 0, int),
+    'date': ('i.date', 1, str),
+    'total_amount': ('i.total_amount', 4, float),
+}
+
+ITEM_LIST_QUERY = 'SELECT * FROM ProductInventoryView'
+# Same columns as InvoiceView, but with the supplier id at hand for filtering
+INVOICE_LIST_QUERY = '''
+    SELECT i.invoice_id, i.date, s.name AS supplier_name, s.address AS supplier_address, i.total_amount, i.due_date, i.currency, i.payment_status
+    FROM Invoices i
+    JOIN Suppliers s ON i.supplier_id = s.supplier_id
+'''
+
+def page_args(sort_columns, default_sort, default_direction='asc'):
+    # Returns (sort, direction, limit) from the query string, falling back to the defaults for anything invalid
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns:
+        sort = default_sort
+    direction = request.args.get('dir', default_direction)
+    if direction not in ('asc', 'desc'):
+        direction = default_direction
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    return sort, direction, limit
+
+def page_query(query, where, params, sort_columns, sort, direction, limit, id_sql, after=None):
+    # Returns (query, params) of a page, after is the (sort value, id) of the last row of the previous page
+    sort_sql = sort_columns[sort][0]
+    where = list(where)
+    params = list(params)
+    if after is not None:
+        where.append(f"({sort_sql}, {id_sql}) {'<' if direction == 'desc' else '>'} (?, ?)")
+        params += after
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += f' ORDER BY {sort_sql} {direction}, {id_sql} {direction} LIMIT ?'
+    return query, params + [limit + 1]
+
+def fetch_page(c, query, where, params, sort_columns, sort, direction, limit, id_sql):
+    # Keyset pagination: the page starts after the (sort value, id) of the last row of the previous page,
+    # so SQLite seeks to it instead of skipping rows and the cost of a page does not grow with the table
+    sort_index, sort_key = sort_columns[sort][1:]
+    after = None
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None and 'after' in request.args:
+        try:
+            after = (sort_key(request.args['after']), after_id)
+        except ValueError:
+            after = None
+    c.execute(*page_query(query, where, params, sort_columns, sort, direction, limit, id_sql, after))
+    data = c.fetchall()
 
-            new_quantity = float(item['quantity'].replace(',', '.'))
-            new_unit_price = float(item['unit_price'].replace(',', '.'))
+    # One row more than shown tells whether there is a next page
+    next_url = None
+    if len(data) > limit:
+        data = data[:limit]
+        args = request.args.to_dict()
+        args.update(after=data[-1][sort_index], after_id=data[-1][0])
+        next_url = url_for(request.endpoint, **args)
+    return data, next_url
+
+# Every page after the first of every sort of the listings has to seek, checked with the query fetch_page runs
+QUERY_PLAN_CHECKS += [
+    (f'{listing} page by {sort} {direction}',
+     *page_query(query, [], [], sort_columns, sort, direction, PAGE_SIZE, id_sql, (after, after)))
+    for listing, query, sort_columns, id_sql, after in (('items', ITEM_LIST_QUERY, ITEM_SORT_COLUMNS, 'product_id', 0),
+                                                       ('invoices', INVOICE_LIST_QUERY, INVOICE_SORT_COLUMNS, 'i.invoice_id', 100))
+    for sort in sort_columns
+    for direction in ('asc', 'desc')
+]
+
+def sort_links(columns, sort, direction):
+    # The link of every sortable column header, clicking the current sort column flips the direction
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('after_id', None)
+    links = []
+    for column in columns:
+        if column is None:
+            links.append(None)
+            continue
+        flipped = 'desc' if column == sort and direction == 'asc' else 'asc'
+        links.append(url_for(request.endpoint, **dict(args, sort=column, dir=flipped)))
+    return links
+
+def first_page_url():
+    args = request.args.to_dict()
+    if 'after' not in args and 'after_id' not in args:
+        return None
+    args.pop('after', None)
+    args.pop('after_id', None)
+    return url_for(request.endpoint, **args)
 
-            merged_quantity = round(float(existing_quantity) + float(new_quantity), 3)
+def parse_date_arg(name):
+    value = request.args.get(name, '')
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        abort(400, f"Invalid date {name}={value}, expected yyyy-mm-dd")
+
+def date_range_filter(column, where, params):
+    # Adds the date_from and date_to (both inclusive) query arguments to where and params and returns them.
+    # Dates are stored as ISO yyyy-mm-dd, some with a time, so the range is compared as strings and can use an index.
+    date_from = parse_date_arg('date_from')
+    if date_from:
+        where.append(f'{column} >= ?')
+        params.append(date_from.isoformat())
+    date_to = parse_date_arg('date_to')
+    if date_to:
+        where.append(f'{column} < ?')
+        params.append((date_to + datetime.timedelta(days=1)).isoformat())
+    return request.args.get('date_from', ''), request.args.get('date_to', '')
+
+def name_prefix_range(prefix):
+    # Bounds for a case insensitive prefix search that can use the index on Products.name
+    return prefix, prefix + '\U0010ffff'
 
+@app.route('/items')
+@cached_page
+def display_items():
+    conn = get_db()
+    c = conn.cursor()
+    sort, direction, limit = page_args(ITEM_SORT_COLUMNS, 'product_id')
 
-            c.execute('UPDATE Products SET price=? WHERE product_id=?',
-                      (new_unit_price, product_id))
-            c.execute('INSERT INTO PriceHistory (product_id, price) VALUES (?, ?)',
-                      (product_id, new_unit_price))
-            c.execute('UPDATE InventoryLevels SET quantity=? WHERE product_id=?',
-                      (merged_quantity, product_id))
+    where = []
+    params = []
+    name = request.args.get('name', '').strip()
+    if name:
+        where.append('name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE')
+        params += name_prefix_range(name)
 
-        else:
-            quantity = float(item['quantity'].replace(',', '.'))
-            price = float(item['unit_price'].replace(',', '.'))
-            c.execute('INSERT INTO Products (name, price, unit_id) VALUES (?, ?, ?)',
-                      (item['name'], price, unit_id))
-            c.execute('SELECT product_id FROM Products WHERE name=?', (item['name'],))
-            product_id = c.fetchone()
-            product_id = product_id[0]
-            c.execute('INSERT INTO PriceHistory (product_id, price) VALUES (?, ?)',
-                      (product_id, price))
-            c.execute('INSERT INTO InventoryLevels (product_id, quantity) VALUES (?, ?)',
-                      (product_id, quantity))
-
-        quantity = float(item['quantity'].replace(',', '.'))
-        price = float(item['unit_price'].replace(',', '.'))
-        c.execute('INSERT INTO InvoiceItems (invoice_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)',
-                    (invoice_id, product_id, quantity, price))
-
-    c.execute('UPDATE Invoices SET total_amount=? WHERE invoice_id=?',
-                      (round(total_amount, 2), invoice_id))
-    conn.commit()
-    conn.close()
+    data, next_url = fetch_page(c, ITEM_LIST_QUERY, where, params, ITEM_SORT_COLUMNS, sort, direction, limit, 'product_id')
+    # One row maintained by triggers, no matter how many products there are
+    c.execute('SELECT total_value, products_in_stock FROM InventoryTotals WHERE id = 1')
+    totals = c.fetchone()
 
+    headers = ['product_id', 'name', 'unit_price', 'quantity', 'unit', 'total_price']
+    links = sort_links(['product_id', 'name', 'unit_price', None, None, None], sort, direction)
+    return render_template('index.html', view='items', headers=headers, data=data, sort_links=links,
+                           next_url=next_url, first_url=first_page_url(), filters={'name': name}, totals=totals)
 
+@app.route('/invoices')
+@cached_page
+def display_invoices():
+    # A date range in archived years lists the invoices of their archives too
+    conn = history_db() if request.args.get('date_from') or request.args.get('date_to') else get_db()
+    c = conn.cursor()
+    sort, direction, limit = page_args(INVOICE_SORT_COLUMNS, 'invoice_id', 'desc')
 
+    where = []
+    params = []
+    supplier_id = request.args.get('supplier_id', type=int)
+    if supplier_id is not None:
+        where.append('i.supplier_id = ?')
+        params.append(supplier_id)
+    date_from, date_to = date_range_filter('i.date', where, params)
 
-@app.route('/')
-def index():
-    return redirect('/items')
+    data, next_url = fetch_page(c, INVOICE_LIST_QUERY, where, params, INVOICE_SORT_COLUMNS, sort, direction, limit, 'i.invoice_id')
 
-@app.route('/items')
-def display_items():
-    conn = sqlite3.connect('inventory.db')
+    c.execute('SELECT supplier_id, name, address FROM Suppliers ORDER BY name, address')
+    suppliers = c.fetchall()
+
+    headers = ['InvoiceID', 'Date', 'Supplier Name', 'Supplier Address', 'TotalAmount', 'DueDate', 'Currency', 'PaymentStatus']
+    links = sort_links(['invoice_id', 'date', None, None, 'total_amount', None, None, None], sort, direction)
+
+    return render_template('index.html', view='invoices', headers=headers, data=data, sort_links=links,
+                           next_url=next_url, first_url=first_page_url(), suppliers=suppliers,
+                           filters={'supplier_id': supplier_id, 'date_from': date_from, 'date_to': date_to})
+
+# Export ###################################################################################################################################
+
+EXPORT_BATCH_SIZE = 1000
+
+# dataset -> (query, date column or None, supplier filter or None, order)
+EXPORTS = {
+    'invoice_details': ('SELECT * FROM InvoiceDetails', 'date',
+                        'invoice_id IN (SELECT invoice_id FROM Invoices WHERE supplier_id = ?)', 'invoice_id, product_id'),
+    'items': ('SELECT * FROM ProductInventoryView', None, None, 'product_id'),
+    'price_history': ('SELECT * FROM View_ProductPriceHistory', 'date_changed', None, 'product_id, date_changed'),
+}
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+def export_rows(query, params, fmt, open_db=connect):
+    # Generator for the response body, rows go from the cursor to the client in batches and are never all in memory.
+    # open_db returns the connection of its own the rows are read from.
+    conn = open_db()
+    try:
+        c = conn.cursor()
+        c.execute(query, params)
+        columns = [column[0] for column in c.description]
+
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+        elif fmt == 'json':
+            yield '['
+
+        first = True
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if fmt == 'csv':
+                writer.writerows(rows)
+                chunk = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            elif fmt == 'json':
+                chunk = ','.join(json.dumps(dict(zip(columns, row))) for row in rows)
+                if not first:
+                    chunk = ',' + chunk
+            else:
+                chunk = ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            first = False
+            yield chunk
+
+        if fmt == 'csv' and first:
+            yield buffer.getvalue()
+        elif fmt == 'json':
+            yield ']'
+    finally:
+        conn.close()
+
+@app.route('/export/<dataset>.<fmt>')
+def export(dataset, fmt):
+    if dataset not in EXPORTS or fmt not in EXPORT_MIMETYPES:
+        abort(404)
+    # The snapshot has the archived years in it, the database needs the archives of the date range attached
+    if report_db() is not None:
+        query, date_sql, supplier_sql, order = REPORT_EXPORTS[dataset]
+        open_db = connect_report
+    else:
+        query, date_sql, supplier_sql, order = EXPORTS[dataset]
+        open_db = connect
+
+    where = []
+    params = []
+    if date_sql:
+        date_range_filter(date_sql, where, params)
+        years = history_years() if open_db is connect else []
+        if len(years) > MAX_ATTACHED:
+            abort(400, f"The date range covers {len(years)} archived years, at most {MAX_ATTACHED} can be read at once")
+        if years:
+            open_db = functools.partial(connect_history, years)
+    supplier_id = request.args.get('supplier_id', type=int)
+    if supplier_sql and supplier_id is not None:
+        where.append(supplier_sql)
+        params.append(supplier_id)
+
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY ' + order
+
+    filename = f"{dataset}_{datetime.date.today().isoformat()}.{fmt}"
+    return Response(stream_with_context(export_rows(query, params, fmt, open_db)), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# Report snapshot ##########################################################################################################################
+
+# Reports and exports are served from a read-only copy of the database refreshed every this many seconds, they never
+# hold a read transaction on the database the ingest writes to. Unset or 0 serves them from the database itself.
+REPORT_SNAPSHOT_INTERVAL = float(os.environ.get('REPORT_SNAPSHOT_INTERVAL') or 0)
+
+# Denormalized tables built in every snapshot, the reports read them without joins
+REPORT_TABLES = [
+    # One row per invoice with its supplier, for the spend report. supplier_id is NULL for an invoice of an unknown supplier.
+    '''CREATE TABLE ReportInvoices AS
+       SELECT i.invoice_id, i.date, s.supplier_id, s.name AS supplier_name, s.address AS supplier_address, i.total_amount
+       FROM Invoices i
+       LEFT JOIN Suppliers s ON i.supplier_id = s.supplier_id
+       ORDER BY i.invoice_id''',
+    'CREATE UNIQUE INDEX idx_reportinvoices_invoice_id ON ReportInvoices (invoice_id)',
+    'CREATE INDEX idx_reportinvoices_date ON ReportInvoices (date, supplier_id, total_amount)',
+    'CREATE INDEX idx_reportinvoices_supplier_id ON ReportInvoices (supplier_id, date, total_amount)',
+    # InvoiceDetails, for the export
+    'CREATE TABLE ReportInvoiceLines AS SELECT * FROM InvoiceDetails ORDER BY invoice_id, product_id',
+    'CREATE INDEX idx_reportinvoicelines_invoice_id ON ReportInvoiceLines (invoice_id, product_id)',
+    'CREATE INDEX idx_reportinvoicelines_date ON ReportInvoiceLines (date)',
+    # View_ProductPriceHistory, for the export
+    'CREATE TABLE ReportPriceHistory AS SELECT * FROM View_ProductPriceHistory ORDER BY product_id, date_changed',
+    'CREATE INDEX idx_reportpricehistory_product_id_date ON ReportPriceHistory (product_id, date_changed)',
+    'CREATE INDEX idx_reportpricehistory_date ON ReportPriceHistory (date_changed)',
+    # When the snapshot was taken and the write generation of the database at that moment
+    'CREATE TABLE ReportSnapshot (id INTEGER PRIMARY KEY CHECK (id = 1), created REAL NOT NULL, generation INTEGER NOT NULL)',
+]
+
+# EXPORTS as they are read from the snapshot
+REPORT_EXPORTS = {
+    'invoice_details': ('SELECT * FROM ReportInvoiceLines', 'date',
+                        'invoice_id IN (SELECT invoice_id FROM ReportInvoices WHERE supplier_id = ?)', 'invoice_id, product_id'),
+    'items': ('SELECT * FROM ProductInventoryView', None, None, 'product_id'),
+    'price_history': ('SELECT * FROM ReportPriceHistory', 'date_changed', None, 'product_id, date_changed'),
+}
+
+report_refresher = None
+report_refresher_lock = threading.Lock()
+
+def refresh_report_snapshot():
+    # Makes a new snapshot now, after a refresh running in another process finished: two at once would both write the
+    # temporary file
+    path = report_path()
+    with open(f'{path}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return make_report_snapshot(path)
+
+def make_report_snapshot(path):
+    # Copies the database with the backup API into a new file, adds the archived years, builds the report tables and
+    # puts the new snapshot in place of the old one. Requests still reading the old one finish on it.
+    # The caller holds the lock on {path}.lock.
+    temp_path = f'{path}.tmp'
+    with metrics.stage('report_snapshot'):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        with closing(connect()) as source, closing(sqlite3.connect(temp_path, isolation_level=None)) as snapshot:
+            # The generation is read in the transaction the copy is made in, a write in between can not be mistaken for
+            # being in the snapshot. The ingest carries on writing meanwhile, WAL readers do not block it.
+            source.execute('BEGIN')
+            try:
+                generation = write_generation(source.cursor())
+                created = time.time()
+                source.backup(snapshot)
+            finally:
+                source.rollback()
+
+            c = snapshot.cursor()
+            # A snapshot is written once and then only read: no WAL, no journal and none of the triggers
+            c.execute('PRAGMA journal_mode=DELETE')
+            c.execute('PRAGMA journal_mode=OFF')
+            c.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+            for name, in c.fetchall():
+                c.execute(f'DROP TRIGGER {name}')
+            for year in archived_years():
+                c.execute('ATTACH DATABASE ? AS archive', (archive_path(year),))
+                c.execute('BEGIN')
+                for table in ARCHIVE_TABLES:
+                    c.execute(f'PRAGMA archive.table_info({table})')
+                    archived_columns = {row[1] for row in c.fetchall()}
+                    c.execute(f'PRAGMA main.table_info({table})')
+                    columns = [row[1] for row in c.fetchall() if row[1] in archived_columns]
+                    names = ', '.join(columns)
+                    key = ARCHIVE_KEYS[table]
+                    # Rows of an interrupted archive run are in both databases and the same in both, an id that is in
+                    # both with other values is two rows the reports would silently lose one of
+                    c.execute(f'''SELECT a.{key} FROM archive.{table} AS a INNER JOIN main.{table} AS m ON m.{key} = a.{key}
+                                  WHERE ({', '.join(f'a.{column}' for column in columns)}) IS NOT
+                                        ({', '.join(f'm.{column}' for column in columns)})
+                                  LIMIT 1''')
+                    conflict = c.fetchone()
+                    if conflict is not None:
+                        raise RuntimeError(f"{table} {key} {conflict[0]} is in {archive_path(year)} and in the database "
+                                           f"with other values")
+                    c.execute(f'INSERT INTO main.{table} ({names}) SELECT {names} FROM archive.{table} '
+                              f'WHERE {key} NOT IN (SELECT {key} FROM main.{table})')
+                c.execute('COMMIT')
+                c.execute('DETACH DATABASE archive')
+
+            c.execute('BEGIN')
+            for sql in REPORT_TABLES:
+                c.execute(sql)
+            c.execute('INSERT INTO ReportSnapshot (id, created, generation) VALUES (1, ?, ?)', (created, generation))
+            c.execute('COMMIT')
+            c.execute('ANALYZE')
+        os.replace(temp_path, path)
+    return path
+
+def report_snapshot_age(path):
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def refresh_report_snapshot_if_due():
+    # Refreshes the snapshot once it is older than the interval and returns the seconds until the next refresh is due.
+    # All worker processes share the snapshot, the one that gets the lock refreshes it.
+    path = report_path()
+    with open(f'{path}.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return REPORT_SNAPSHOT_INTERVAL
+        age = report_snapshot_age(path)
+        if age is not None and age < REPORT_SNAPSHOT_INTERVAL:
+            return REPORT_SNAPSHOT_INTERVAL - age
+        make_report_snapshot(path)
+        return REPORT_SNAPSHOT_INTERVAL
+
+def run_report_refresher():
+    while True:
+        try:
+            wait = refresh_report_snapshot_if_due()
+        except Exception:
+            app.logger.exception('Refreshing the report snapshot failed')
+            wait = REPORT_SNAPSHOT_INTERVAL
+        metrics.flush()
+        time.sleep(wait)
+
+def start_report_refresher():
+    # Like the job worker, a background thread per process unless REPORT_REFRESHER=0
+    global report_refresher
+    if not REPORT_SNAPSHOT_INTERVAL or os.environ.get('REPORT_REFRESHER', '1') == '0':
+        return
+    with report_refresher_lock:
+        if report_refresher is None or not report_refresher.is_alive():
+            report_refresher = threading.Thread(target=run_report_refresher, name='report-refresher', daemon=True)
+            report_refresher.start()
+
+@app.before_request
+def ensure_report_refresher():
+    start_report_refresher()
+
+def report_db():
+    # The snapshot connection the reports read, None if they read the database: the snapshot is off or not made yet
+    if not REPORT_SNAPSHOT_INTERVAL:
+        return None
+    conn = get_report_db()
+    if conn is not None:
+        g.report_snapshot = snapshot_info(conn)
+    return conn
+
+def snapshot_info(conn):
+    # The staleness of the snapshot, current is false once the database changed after the snapshot was taken
+    created, generation = conn.execute('SELECT created, generation FROM ReportSnapshot WHERE id = 1').fetchone()
+    return {
+        'created': datetime.datetime.fromtimestamp(created).isoformat(timespec='seconds'),
+        'age_seconds': round(time.time() - created, 1),
+        'current': generation == write_generation(get_db().cursor()),
+    }
+
+@app.after_request
+def add_snapshot_header(response):
+    snapshot = g.get('report_snapshot')
+    if snapshot is not None:
+        response.headers['X-Report-Snapshot'] = (f"created={snapshot['created']}; age={snapshot['age_seconds']}; "
+                                                 f"current={'yes' if snapshot['current'] else 'no'}")
+    return response
+
+@app.cli.command('refresh-reports')
+@click.option('--loop', is_flag=True, help='Keep refreshing every REPORT_SNAPSHOT_INTERVAL seconds.')
+def refresh_reports_command(loop):
+    """Make a new report snapshot, with --loop for web workers started with REPORT_REFRESHER=0."""
+    if loop:
+        if not REPORT_SNAPSHOT_INTERVAL:
+            raise click.UsageError("REPORT_SNAPSHOT_INTERVAL is not set")
+        click.echo(f"Refreshing {report_path()} every {REPORT_SNAPSHOT_INTERVAL:g}s")
+        run_report_refresher()
+        return
+    started = time.perf_counter()
+    path = refresh_report_snapshot()
+    click.echo(f"Report snapshot {path} ({os.path.getsize(path) / 1e6:.1f} MB) made in {time.perf_counter() - started:.1f}s")
+
+# Reports ##################################################################################################################################
+
+# group -> SQL expression of the period an invoice date belongs to, weeks start on Monday
+SPEND_PERIODS = {
+    'day': 'substr(i.date, 1, 10)',
+    'week': "date(i.date, '-' || ((strftime('%w', i.date) + 6) % 7) || ' days')",
+    'month': 'substr(i.date, 1, 7)',
+}
+
+@app.route('/reports/spend')
+def spend_report():
+    # Spend per day, week, month or supplier. The date range is a range over the index on Invoices (date, supplier_id).
+    group = request.args.get('group', 'month')
+    if group not in SPEND_PERIODS and group != 'supplier':
+        abort(400, f"Invalid group {group}, expected day, week, month or supplier")
+
+    where = []
+    params = []
+    date_from, date_to = date_range_filter('i.date', where, params)
+    supplier_id = request.args.get('supplier_id', type=int)
+    if supplier_id is not None:
+        where.append('i.supplier_id = ?')
+        params.append(supplier_id)
+
+    snapshot = report_db()
+    conn = snapshot or history_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM ProductInventoryView')
+    if group == 'supplier':
+        if snapshot:
+            # ReportInvoices has the supplier in the invoice row
+            source, supplier_columns = 'ReportInvoices i', 'i.supplier_name, i.supplier_address'
+            where.append('i.supplier_id IS NOT NULL')
+        else:
+            source, supplier_columns = 'Invoices i JOIN Suppliers s ON i.supplier_id = s.supplier_id', 's.name, s.address'
+        c.execute(f'''
+            SELECT i.supplier_id, {supplier_columns}, count(*) AS invoice_count, round(sum(i.total_amount), 2) AS total
+            FROM {source}
+            {' WHERE ' + ' AND '.join(where) if where else ''}
+            GROUP BY i.supplier_id
+            ORDER BY total DESC
+        ''', params)
+        columns = ['supplier_id', 'supplier_name', 'supplier_address', 'invoice_count', 'total']
+    else:
+        c.execute(f'''
+            SELECT {SPEND_PERIODS[group]} AS period, count(*) AS invoice_count, round(sum(i.total_amount), 2) AS total
+            FROM {'ReportInvoices' if snapshot else 'Invoices'} i
+            {' WHERE ' + ' AND '.join(where) if where else ''}
+            GROUP BY period
+            ORDER BY period
+        ''', params)
+        columns = ['period', 'invoice_count', 'total']
     data = c.fetchall()
-    conn.close()
-    headers = ['product_id', 'name', 'unit_price', 'quantity', 'unit', 'total_price']
-    return render_template('index.html', view='items', headers=headers, data=data)
 
-@app.route('/invoices')
-def display_invoices():
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        c.execute('SELECT supplier_id, name, address FROM Suppliers ORDER BY name, address')
+        return render_template('index.html', view='spend_report', headers=columns, data=data, suppliers=c.fetchall(),
+                               filters={'group': group, 'supplier_id': supplier_id, 'date_from': date_from, 'date_to': date_to},
+                               snapshot=g.get('report_snapshot'))
+    return jsonify(group=group, date_from=date_from or None, date_to=date_to or None, supplier_id=supplier_id,
+                   rows=[dict(zip(columns, row)) for row in data], snapshot=g.get('report_snapshot'))
+
+# Prices ###################################################################################################################################
+
+# Columns of the price overview, from PriceStats or from PRICE_STATS_SQL over a date range
+PRICE_OVERVIEW_COLUMNS = '''
+    ps.product_id, p.name, ps.min_price, ps.max_price, round(ps.price_sum / ps.price_count, 2) AS avg_price,
+    ps.first_price, ps.last_price,
+    CASE WHEN ps.first_price > 0 THEN round((ps.last_price - ps.first_price) * 100.0 / ps.first_price, 1) END AS change_percent,
+    ps.price_count, ps.first_date, ps.last_date
+'''
+
+# bucket -> SQL expression of the period a price point belongs to, weeks start on Monday
+PRICE_BUCKETS = {
+    'day': 'substr(date_changed, 1, 10)',
+    'week': "date(date_changed, '-' || ((strftime('%w', date_changed) + 6) % 7) || ' days')",
+    'month': 'substr(date_changed, 1, 7)',
+}
+
+@app.route('/prices')
+def price_overview():
+    # Min, max, average, first and last price and the change in percent of every product.
+    # Over the whole history this reads the PriceStats rollup, one row per product. A date range is computed
+    # with window functions over the points in the range.
+    where = []
+    params = []
+    date_from, date_to = date_range_filter('date_changed', where, params)
+    if where:
+        source = '(' + PRICE_STATS_SQL.format(where='WHERE price IS NOT NULL AND ' + ' AND '.join(where)) + ')'
+    else:
+        source = 'PriceStats'
 
-    c.execute('SELECT * FROM InvoiceView')
+    query = f'SELECT {PRICE_OVERVIEW_COLUMNS} FROM {source} AS ps JOIN Products p ON p.product_id = ps.product_id'
+    name = request.args.get('name', '').strip()
+    if name:
+        query += ' WHERE p.name >= ? COLLATE NOCASE AND p.name < ? COLLATE NOCASE'
+        params += name_prefix_range(name)
+    query += ' ORDER BY p.name COLLATE NOCASE'
 
+    # PriceStats covers the archived years as well, only a date range reads them
+    conn = report_db() or (history_db() if source != 'PriceStats' else get_db())
+    c = conn.cursor()
+    c.execute(query, params)
+    columns = [column[0] for column in c.description]
     data = c.fetchall()
-    conn.close()
 
-    headers = ['InvoiceID', 'Date', 'Supplier Name', 'Supplier Address', 'TotalAmount', 'DueDate', 'Currency', 'PaymentStatus']
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return render_template('index.html', view='prices', headers=columns, data=data,
+                               filters={'name': name, 'date_from': date_from, 'date_to': date_to}, snapshot=g.get('report_snapshot'))
+    return jsonify(date_from=date_from or None, date_to=date_to or None, products=[dict(zip(columns, row)) for row in data],
+                   snapshot=g.get('report_snapshot'))
+
+@app.route('/prices/<int:product_id>')
+def price_series(product_id):
+    # The price history of one product downsampled to one point per day, week or month (min, max, average and
+    # the last price of the period), bucket=raw returns every price point
+    bucket = request.args.get('bucket', 'raw')
+    if bucket not in PRICE_BUCKETS and bucket != 'raw':
+        abort(400, f"Invalid bucket {bucket}, expected raw, day, week or month")
+
+    where = ['product_id = ?', 'price IS NOT NULL']
+    params = [product_id]
+    date_from, date_to = date_range_filter('date_changed', where, params)
+
+    conn = report_db() or history_db()
+    c = conn.cursor()
+    c.execute('SELECT name FROM Products WHERE product_id = ?', (product_id,))
+    product = c.fetchone()
+    if product is None:
+        return jsonify(error='Product not found'), 404
+
+    if bucket == 'raw':
+        c.execute(f'''
+            SELECT date_changed AS period, price AS min_price, price AS max_price, price AS avg_price, price AS last_price, 1 AS price_count
+            FROM PriceHistory
+            WHERE {' AND '.join(where)}
+            ORDER BY date_changed, price_id
+        ''', params)
+    else:
+        c.execute(f'''
+            SELECT period, min(price) AS min_price, max(price) AS max_price, round(avg(price), 2) AS avg_price, last_price,
+                   count(*) AS price_count
+            FROM (
+                SELECT {PRICE_BUCKETS[bucket]} AS period, price,
+                       last_value(price) OVER (PARTITION BY {PRICE_BUCKETS[bucket]} ORDER BY date_changed, price_id
+                                               ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS last_price
+                FROM PriceHistory
+                WHERE {' AND '.join(where)}
+            )
+            GROUP BY period
+            ORDER BY period
+        ''', params)
+    columns = [column[0] for column in c.description]
+    data = c.fetchall()
+
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return render_template('index.html', view='price_series', headers=columns, data=data, product_id=product_id,
+                               product_name=product[0], filters={'bucket': bucket, 'date_from': date_from, 'date_to': date_to},
+                               snapshot=g.get('report_snapshot'))
+    return jsonify(product_id=product_id, name=product[0], bucket=bucket, date_from=date_from or None, date_to=date_to or None,
+                   series=[dict(zip(columns, row)) for row in data], snapshot=g.get('report_snapshot'))
+
+# Search ###################################################################################################################################
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+# Matches ranked per query, keeps a search in the low milliseconds no matter how many products match
+SEARCH_RANK_CANDIDATES = 500
 
-    return render_template('index.html', view='invoices', headers=headers, data=data)
+# highlight() marks matches with control characters, the text is HTML escaped before they become <mark> tags
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+def search_terms(text):
+    # Words of the search text, quoted so that FTS5 operators and punctuation in the input are matched literally
+    return re.findall(r'\w+', text)
+
+def strip_highlight(text):
+    return (text or '').replace(HIGHLIGHT_START, '').replace(HIGHLIGHT_END, '')
+
+def highlight_html(text):
+    if text is None:
+        return None
+    return str(escape(text)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+def ranked_matches(c, table, match, limit):
+    # (rowid, highlighted text of the first column) of the best matches. bm25 has to score every row it is asked to
+    # order, a common word or short prefix matches thousands of products, so only the newest matches are ranked.
+    c.execute(f'''
+        SELECT rowid, highlighted FROM (
+            SELECT rowid, rank, highlight({table}, 0, ?, ?) AS highlighted
+            FROM {table}
+            WHERE {table} MATCH ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        )
+        ORDER BY rank
+        LIMIT ?
+    ''', (HIGHLIGHT_START, HIGHLIGHT_END, match, SEARCH_RANK_CANDIDATES, limit))
+    return c.fetchall()
+
+def search_products(c, terms, limit):
+    # Every word as a prefix, ranked by bm25. If no name has words starting like that, words of three or more characters
+    # are matched anywhere in the name through the trigram index.
+    matches = ranked_matches(c, 'ProductSearch', ' '.join(f'"{term}"*' for term in terms), limit)
+    trigram_terms = [term for term in terms if len(term) >= 3]
+    if not matches and trigram_terms:
+        matches = ranked_matches(c, 'ProductSearchTrigram', ' '.join(f'"{term}"' for term in trigram_terms), limit)
+    if not matches:
+        return []
+
+    # Price and stock of the matches only, in the order of the ranking
+    c.execute(f'''
+        SELECT p.product_id, p.price, il.quantity
+        FROM Products p
+        LEFT JOIN InventoryLevels il ON il.product_id = p.product_id
+        WHERE p.product_id IN ({', '.join('?' * len(matches))})
+    ''', [product_id for product_id, highlighted in matches])
+    details = {product_id: (price, quantity) for product_id, price, quantity in c.fetchall()}
+    return [{'product_id': product_id, 'name': strip_highlight(highlighted),
+             'highlight': highlight_html(highlighted), 'price': details[product_id][0], 'quantity': details[product_id][1]}
+            for product_id, highlighted in matches if product_id in details]
+
+def search_suppliers(c, terms, limit):
+    c.execute('''
+        SELECT s.rowid, highlight(SupplierSearch, 0, ?, ?), highlight(SupplierSearch, 1, ?, ?), ss.invoice_count
+        FROM SupplierSearch s
+        LEFT JOIN SupplierStats ss ON ss.supplier_id = s.rowid
+        WHERE SupplierSearch MATCH ?
+        ORDER BY s.rank
+        LIMIT ?
+    ''', (HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END, ' '.join(f'"{term}"*' for term in terms), limit))
+    return [{'supplier_id': supplier_id, 'name': strip_highlight(name), 'address': strip_highlight(address),
+             'name_highlight': highlight_html(name), 'address_highlight': highlight_html(address), 'invoice_count': invoice_count}
+            for supplier_id, name, address, invoice_count in c.fetchall()]
+
+@app.route('/search')
+def search():
+    # Products by name and suppliers (markets) by name or address, best matches first
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), MAX_SEARCH_LIMIT)
+    terms = search_terms(query)
+
+    products = []
+    suppliers = []
+    if terms:
+        c = get_db().cursor()
+        products = search_products(c, terms, limit)
+        suppliers = search_suppliers(c, terms, limit)
+
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return render_template('index.html', view='search', query=query, products=products, suppliers=suppliers)
+    return jsonify(query=query, products=products, suppliers=suppliers)
 
 @app.route('/invoice_details/<int:invoice_id>')
+@cached_page
 def display_invoice_details(invoice_id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
     c.execute('SELECT * FROM InvoiceDetails WHERE invoice_id = ?', (invoice_id,))
 
     data = c.fetchall()
-    conn.close()
+    if not data and archived_years():
+        # An invoice of an archived year, its year is not known before it is found
+        c = history_db(archived_years()[-MAX_ATTACHED:]).cursor()
+        c.execute('SELECT * FROM InvoiceDetails WHERE invoice_id = ?', (invoice_id,))
+        data = c.fetchall()
 
     headers = ['InvoiceID', 'Date', 'TotalAmount', 'DueDate', 'Currency', 'PaymentStatus', 
                'Supplier Name', 'Supplier Address', 'Product ID', 'Quantity', 'Unit Price', 
@@ -497,13 +1310,124 @@ def display_invoice_details(invoice_id):
 def upload_file():
     file = request.files['pdf_file']
     if file:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        process_pdf_file(file_path)
-        os.remove(file_path)  # Delete the uploaded file after processing
+        # Only enqueue here, the job worker parses the PDF and writes it to the database
+        job_id, status = enqueue_job(secure_filename(file.filename), file.read())
+        start_job_worker()
+        if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+            # A PDF that was ingested before is done already, only a queued job is still to be processed
+            return (jsonify(job_id=job_id, status=status), 202 if status == 'queued' else 200,
+                    {'Location': url_for('job_status', job_id=job_id)})
+        return redirect(url_for('job_status', job_id=job_id))
     return redirect('/')
 
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''SELECT job_id, filename, status, invoice_id, error, created_at, started_at, finished_at
+                 FROM Jobs WHERE job_id = ?''', (job_id,))
+    row = c.fetchone()
+    if row is None:
+        return jsonify(error='Job not found'), 404
+
+    job = dict(zip(['job_id', 'filename', 'status', 'invoice_id', 'error', 'created_at', 'started_at', 'finished_at'], row))
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        headers = ['JobID', 'File', 'Status', 'InvoiceID', 'Error', 'Created', 'Started', 'Finished']
+        return render_template('index.html', view='job', headers=headers, data=[row], job=job)
+    return jsonify(job)
+
+@app.route('/upload_bulk', methods=['POST'])
+def upload_bulk():
+    # Every PDF becomes a job like a single upload, the job workers parse and write them. The request only stores the
+    # PDFs, so a web worker is not busy for the whole batch and never forks a process pool.
+    results = []
+    seen = {}
+    for name, pdf_bytes, error in collect_uploads(request.files.getlist('pdf_files')):
+        if error is not None:
+            results.append({'file': name, 'status': 'failed', 'job_id': None, 'invoice_id': None, 'error': error})
+            continue
+        # A PDF that appears twice in this upload is queued once
+        fingerprint = pdf_fingerprint(pdf_bytes)
+        if fingerprint in seen:
+            first = seen[fingerprint]
+            results.append({'file': name, 'status': 'duplicate', 'job_id': first['job_id'], 'invoice_id': None,
+                            'error': f"Duplicate of {first['file']}"})
+            continue
+        job_id, status = enqueue_job(name, pdf_bytes)
+        seen[fingerprint] = {'file': name, 'status': status, 'job_id': job_id, 'invoice_id': None, 'error': None}
+        results.append(seen[fingerprint])
+    start_job_worker()
+
+    # PDFs that were ingested before are done already, their jobs name the invoice
+    c = get_db().cursor()
+    for result in results:
+        if result['status'] == 'done':
+            c.execute('SELECT invoice_id, error FROM Jobs WHERE job_id = ?', (result['job_id'],))
+            result['invoice_id'], result['error'] = c.fetchone()
+
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        queued = any(result['status'] == 'queued' for result in results)
+        return jsonify(results=results), 202 if queued else 200
+    headers = ['File', 'Status', 'JobID', 'InvoiceID', 'Error']
+    data = [(r['file'], r['status'], r['job_id'], r['invoice_id'], r['error']) for r in results]
+    return render_template('index.html', view='upload_results', headers=headers, data=data)
+
+# ZIP uploads are unpacked in memory, so the PDFs in one archive and their sizes are limited
+ZIP_MAX_MEMBERS = int(os.environ.get('ZIP_MAX_MEMBERS', 1000))
+ZIP_MAX_MEMBER_SIZE = int(os.environ.get('ZIP_MAX_MEMBER_SIZE', 20 * 1024 * 1024))
+ZIP_MAX_TOTAL_SIZE = int(os.environ.get('ZIP_MAX_TOTAL_SIZE', 200 * 1024 * 1024))
+# What reading a broken archive or member raises: a bad header, a bad checksum, bad deflate data, an unsupported
+# compression method or an encrypted member
+ZIP_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError)
+
+def collect_uploads(files):
+    # Returns a list of (filename, pdf bytes, error), ZIP archives are unpacked into their PDFs. An archive that can not be
+    # read and a PDF over the limits get an error and no bytes, the other files of the upload are processed.
+    uploads = []
+    for file in files:
+        if not file or not file.filename:
+            continue
+        filename = secure_filename(file.filename)
+        if filename.lower().endswith('.zip'):
+            try:
+                uploads += unpack_zip_upload(file.stream, filename)
+            except ZIP_ERRORS as e:
+                uploads.append((filename, None, f"Not a readable ZIP archive: {e}"))
+        else:
+            uploads.append((filename, file.read(), None))
+    return uploads
+
+def unpack_zip_upload(stream, filename):
+    uploads = []
+    total_size = 0
+    with zipfile.ZipFile(stream) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir() and info.filename.lower().endswith('.pdf')]
+        if len(members) > ZIP_MAX_MEMBERS:
+            return [(filename, None, f"{len(members)} PDFs in the archive, at most {ZIP_MAX_MEMBERS} are accepted")]
+        for info in members:
+            name = secure_filename(os.path.basename(info.filename))
+            # file_size is what the archive claims, the read stops one byte over the limit whatever it claims
+            if info.file_size > ZIP_MAX_MEMBER_SIZE or total_size + info.file_size > ZIP_MAX_TOTAL_SIZE:
+                uploads.append((name, None, oversize_error(info.file_size, total_size)))
+                continue
+            try:
+                with archive.open(info) as member:
+                    pdf_bytes = member.read(ZIP_MAX_MEMBER_SIZE + 1)
+            except ZIP_ERRORS as e:
+                uploads.append((name, None, f"Can not be read from {filename}: {e}"))
+                continue
+            if len(pdf_bytes) > ZIP_MAX_MEMBER_SIZE or total_size + len(pdf_bytes) > ZIP_MAX_TOTAL_SIZE:
+                uploads.append((name, None, oversize_error(len(pdf_bytes), total_size)))
+                continue
+            total_size += len(pdf_bytes)
+            uploads.append((name, pdf_bytes, None))
+    return uploads
+
+def oversize_error(size, total_size):
+    if size > ZIP_MAX_MEMBER_SIZE:
+        return f"Larger than {ZIP_MAX_MEMBER_SIZE} bytes unpacked"
+    return f"The archive unpacks to more than {ZIP_MAX_TOTAL_SIZE} bytes"
+
 @app.route('/add_receipt', methods=['GET', 'POST'])
 def add_receipt():
     if request.method == 'POST':
@@ -514,17 +1438,20 @@ def add_receipt():
         unit_prices = request.form.getlist('unit_price[]')
 
         for i in range(len(item_names)):
-            item_name = item_names[i]
-            quantity = quantities[i]
-            unit = units[i]
-            unit_price = unit_prices[i]
+            try:
+                quantity = parse_decimal(quantities[i])
+                unit_price = parse_decimal(unit_prices[i])
+                unit = Unit(units[i].strip())
+            except (InvalidOperation, ValueError):
+                # Handle invalid input, such as non-numeric characters or an unknown unit
+                return "Invalid quantity, unit price or unit"
 
             item = {
-                'name': item_name,
+                'name': item_names[i],
                 'quantity': quantity,
                 'unit': unit,
                 'unit_price': unit_price,
-                'total_price': str(float(quantity.replace(',', '.')) * float(unit_price.replace(',', '.')))
+                'total_price': quantity * unit_price
             }
             items.append(item)
 
@@ -534,7 +1461,7 @@ def add_receipt():
             'zip_code': request.form.get('zip_code'),
             'city': request.form.get('city')
         }
-        date = datetime.datetime.now().strftime("%d.%m.%Y")
+        date = datetime.date.today().isoformat()
 
         write_to_database(items, '', company_info, date)
 
@@ -544,33 +1471,109 @@ def add_receipt():
 
 
 
+# Consumption ##############################################################################################################################
+
+# Products per consumption request, keeps the IN lists far below SQLite's variable limit
+MAX_CONSUME_ITEMS = 1000
+
+class UnknownProducts(Exception):
+    def __init__(self, product_ids):
+        super().__init__(f"Unknown products {', '.join(map(str, product_ids))}")
+        self.product_ids = product_ids
+
+def parse_amount(value):
+    # A positive, finite amount from a number or a string with a comma or dot separator
+    amount = float(str(value).replace(',', '.'))
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError(f"Invalid amount {value}")
+    return amount
+
+def consume_stock(c, consumption, source):
+    # consumption is a list of (product_id, amount), an amount of None consumes everything in stock.
+    # The caller holds the write lock (BEGIN IMMEDIATE), so the stock read here cannot change until the commit,
+    # and every update is a single relative statement, so concurrent consumptions never overwrite each other.
+    amounts = {}
+    for product_id, amount in consumption:
+        # The same product twice in one request is one consumption of the sum
+        if amount is None or amounts.get(product_id, 0) is None:
+            amounts[product_id] = None
+        else:
+            amounts[product_id] = amounts.get(product_id, 0) + amount
+    product_ids = list(amounts)
+    placeholders = ', '.join('?' * len(product_ids))
+
+    c.execute(f'SELECT product_id, quantity FROM InventoryLevels WHERE product_id IN ({placeholders})', product_ids)
+    before = dict(c.fetchall())
+    unknown = [product_id for product_id in product_ids if product_id not in before]
+    if unknown:
+        raise UnknownProducts(unknown)
+    for product_id, amount in amounts.items():
+        if amount is None:
+            amounts[product_id] = before[product_id]
+
+    c.executemany('UPDATE InventoryLevels SET quantity = max(round(quantity - ?, 3), 0) WHERE product_id = ?',
+                  [(amount, product_id) for product_id, amount in amounts.items()])
+    c.execute(f'SELECT product_id, quantity FROM InventoryLevels WHERE product_id IN ({placeholders})', product_ids)
+    after = dict(c.fetchall())
+
+    result = [{'product_id': product_id, 'requested': amount, 'consumed': round(before[product_id] - after[product_id], 3),
+               'quantity': after[product_id]}
+              for product_id, amount in amounts.items()]
+    c.executemany('INSERT INTO ConsumptionLog (product_id, requested, consumed, quantity_after, source) VALUES (?, ?, ?, ?, ?)',
+                  [(row['product_id'], row['requested'], row['consumed'], row['quantity'], source) for row in result])
+    return result
+
+def consume(consumption, source):
+    conn = get_db()
+    with conn:
+        begin_immediate(conn)
+        return consume_stock(conn.cursor(), consumption, source)
+
+@app.route('/consume', methods=['POST'])
+def consume_products():
+    # Body: a list of {"product_id": 1, "amount": 0.5} (or [1, 0.5] pairs), or an object with such a list under "items"
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('items')
+    if not isinstance(body, list) or not body:
+        return jsonify(error='Expected a list of product_id and amount'), 400
+    if len(body) > MAX_CONSUME_ITEMS:
+        return jsonify(error=f'At most {MAX_CONSUME_ITEMS} items per request'), 400
+
+    consumption = []
+    try:
+        for item in body:
+            if isinstance(item, dict):
+                product_id, amount = item['product_id'], item['amount']
+            else:
+                product_id, amount = item
+            if isinstance(product_id, bool) or not isinstance(product_id, int):
+                raise ValueError(f"Invalid product_id {product_id}")
+            consumption.append((product_id, parse_amount(amount)))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error=f'Invalid item: {e}'), 400
+
+    try:
+        result = consume(consumption, 'consume')
+    except UnknownProducts as e:
+        return jsonify(error=str(e), product_ids=e.product_ids), 404
+    return jsonify(items=result)
+
 @app.route('/reduce', methods=['POST'])
 def reduce_quantity():
     product_id = request.form['product_id']
-    reduce_amount = request.form['reduce_amount'].replace('.', ',')
 
     try:
-        reduce_amount = float(reduce_amount.replace(',', '.'))
+        product_id = int(product_id)
+        reduce_amount = parse_amount(request.form['reduce_amount'])
     except ValueError:
         # Handle invalid input, such as non-numeric characters
         return "Invalid reduce amount"
 
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('SELECT quantity FROM InventoryLevels WHERE product_id=?', (product_id,))
-    result = c.fetchone()
-    quantity = result[0]
-
-    new_quantity = round(float(quantity) - reduce_amount, 3)
-
-    if new_quantity <= 0:
-        c.execute('UPDATE InventoryLevels SET quantity=? WHERE product_id=?', (0, product_id))
-    else:
-
-        c.execute('UPDATE InventoryLevels SET quantity=? WHERE product_id=?', (new_quantity, product_id))
-
-    conn.commit()
-    conn.close()
+    try:
+        consume([(product_id, reduce_amount)], 'reduce')
+    except UnknownProducts:
+        return "Unknown product", 404
     return redirect('/')
 
 
@@ -578,40 +1581,565 @@ def reduce_quantity():
 
 @app.route('/delete', methods=['POST'])
 def delete_item():
-    product_id = request.form['product_id']
+    try:
+        product_id = int(request.form['product_id'])
+    except ValueError:
+        return "Unknown product", 404
 
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('UPDATE InventoryLevels SET quantity=? WHERE product_id=?', (0, product_id))
-    conn.commit()
-    conn.close()
+    try:
+        consume([(product_id, None)], 'deplete')
+    except UnknownProducts:
+        return "Unknown product", 404
     return redirect('/')
 
 
 
-def process_pdf_file(file_path):
-    with pdfplumber.open(file_path) as pdf:
-        text = ""
-        for page in pdf.pages:
-            text += page.extract_text()
-        company_info, items, date = extract_data(text)
-        for item in items:
-            if 'quantity' not in item:
-                item['quantity'] = '1'
-                item['unit'] = 'Stk'
-                item['unit_price'] = item['total_price']
-        data = items
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        filename = os.path.basename(file_path)
-        pdf_file = f"{filename} ({timestamp})"
-        write_to_database(data, pdf_file, company_info, date)
-
+# Characters closer than this (in points) are on the same line, further apart than this within a line a space goes
+# between them. pdfplumber's defaults, the eBons were read with them before.
+PDF_X_TOLERANCE = 3
+PDF_Y_TOLERANCE = 3
+
+def pdf_layout_chars(item):
+    # The characters of a pdfminer layout item, also those inside figures (form XObjects)
+    from pdfminer.layout import LTChar, LTContainer
+    if isinstance(item, LTChar):
+        yield item
+    elif isinstance(item, LTContainer):
+        for child in item:
+            yield from pdf_layout_chars(child)
+
+def page_text(layout):
+    # The text of a page line by line from top to bottom, like pdfplumber's extract_text_simple. Without
+    # pdfplumber's objects for every character this takes a third of the time.
+    chars = sorted(pdf_layout_chars(layout), key=lambda char: -char.y1)
+    lines = []
+    line = []
+    for char in chars:
+        if line and line[-1].y1 - char.y1 > PDF_Y_TOLERANCE:
+            lines.append(line)
+            line = []
+        line.append(char)
+    if line:
+        lines.append(line)
+
+    texts = []
+    for line in lines:
+        text = ''
+        last_x1 = None
+        for char in sorted(line, key=lambda char: char.x0):
+            if last_x1 is not None and char.x0 > last_x1 + PDF_X_TOLERANCE:
+                text += ' '
+            last_x1 = char.x1
+            text += char.get_text()
+        texts.append(text)
+    return '\n'.join(texts)
+
+def extract_pdf_text(pdf_source):
+    # pdf_source is a file path or a binary file-like object, e.g. a BytesIO of the upload. The pages are read with
+    # pdfminer without layout analysis, an eBon is a single column of text.
+    from pdfminer.converter import PDFPageAggregator
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    pages = []
+    receipt_end_seen = False
+    date_seen = False
+    with metrics.stage('pdf_extract'), open(pdf_source, 'rb') if isinstance(pdf_source, str) else nullcontext(pdf_source) as f:
+        resources = PDFResourceManager()
+        device = PDFPageAggregator(resources, laparams=None)
+        interpreter = PDFPageInterpreter(resources, device)
+        for page in PDFPage.get_pages(f):
+            interpreter.process_page(page)
+            text = page_text(device.get_result())
+            pages.append(text)
+            # Everything after the totals is ignored by parse_receipt, only the date may still be missing
+            receipt_end_seen = receipt_end_seen or any(is_receipt_end(line) for line in text.split('\n'))
+            date_seen = date_seen or DATE_RE.search(text) is not None
+            if receipt_end_seen and date_seen:
+                break
+    return '\n'.join(pages)
+
+def parse_pdf(pdf_source):
+    try:
+        company_info, items, date = extract_data(extract_pdf_text(pdf_source))
+    except Exception:
+        metrics.PARSE_FAILURES.inc()
+        raise
+    metrics.ITEMS_PARSED.inc(len(items))
+    return company_info, items, date
+
+def parse_pdf_bytes(pdf_bytes):
+    # Entry point for the process pool, only bytes and plain dicts cross the process boundary.
+    # Returns (parsed receipt or None, error, metrics), the parent adds the metrics of the worker to its own.
+    try:
+        return parse_pdf(io.BytesIO(pdf_bytes)), None, metrics.take()
+    except Exception as e:
+        return None, str(e), metrics.take()
+
+def pool_result(future):
+    # (parsed receipt or None, error) of a parse_pdf_bytes future
+    parsed, error, worker_metrics = future.result()
+    metrics.merge(worker_metrics)
+    return parsed, error
+
+def process_pdf_file(pdf_source, filename=None):
+    # pdf_source is the PDF as bytes, a binary file-like object or a file path
+    if isinstance(pdf_source, (bytes, bytearray)):
+        pdf_bytes = pdf_source
+    elif hasattr(pdf_source, 'read'):
+        pdf_bytes = pdf_source.read()
+    else:
+        with open(pdf_source, 'rb') as f:
+            pdf_bytes = f.read()
+        filename = filename or os.path.basename(pdf_source)
+
+    # A byte-identical PDF is rejected before pdfminer ever sees it
+    fingerprint = pdf_fingerprint(pdf_bytes)
+    duplicate = find_duplicate(get_db().cursor(), [fingerprint])
+    if duplicate is not None:
+        raise DuplicateReceipt(duplicate)
+
+    company_info, items, date = parse_pdf(io.BytesIO(pdf_bytes))
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    pdf_file = f"{filename} ({timestamp})"
+    return write_to_database(items, pdf_file, company_info, date, [fingerprint])
+
+
+
+# Import ###################################################################################################################################
+
+# Receipts written per transaction by import-ebons, one commit per batch instead of one per receipt
+IMPORT_BATCH_SIZE = 50
+
+def iter_ebons(path):
+    # Yields (entry, pdf bytes) for every PDF in a directory tree or a ZIP archive, ZIP archives inside a directory
+    # included. The entry is the path relative to the source and identifies the file in the import checkpoints.
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                entry = os.path.relpath(full_path, path)
+                if name.lower().endswith('.pdf'):
+                    with open(full_path, 'rb') as f:
+                        yield entry, f.read()
+                elif name.lower().endswith('.zip'):
+                    for inner, pdf_bytes in iter_zip_ebons(full_path):
+                        yield f'{entry}/{inner}', pdf_bytes
+    else:
+        yield from iter_zip_ebons(path)
+
+def iter_zip_ebons(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in sorted(archive.infolist(), key=lambda info: info.filename):
+            if not info.is_dir() and info.filename.lower().endswith('.pdf'):
+                yield info.filename, archive.read(info)
+
+def write_import_batch(conn, source, batch):
+    # batch is a list of (entry, fingerprint, parsed receipt or None, error). The receipts and their checkpoints are
+    # committed together, an interrupted import never has a receipt without its checkpoint or the other way round.
+    statuses = []
+    with metrics.stage('db_write'), conn:
+        begin_immediate(conn)
+        c = conn.cursor()
+        for entry, fingerprint, parsed, error in batch:
+            invoice_id = None
+            if parsed is None and error is None:
+                # Not parsed because the PDF was imported before, or earlier in this import
+                invoice_id = find_duplicate(c, [fingerprint])
+                if invoice_id is not None:
+                    status, error = 'duplicate', f"Duplicate of invoice {invoice_id}"
+                else:
+                    status, error = 'failed', "Duplicate of a file that could not be imported"
+            elif parsed is None:
+                status = 'failed'
+            else:
+                company_info, items, date = parsed
+                # A receipt that fails half way is rolled back without losing the rest of the batch
+                c.execute('SAVEPOINT receipt')
+                try:
+                    invoice_id = write_invoice(c, items, company_info, date, [fingerprint])
+                    status = 'done'
+                except DuplicateReceipt as e:
+                    status, invoice_id, error = 'duplicate', e.invoice_id, str(e)
+                except Exception as e:
+                    c.execute('ROLLBACK TO receipt')
+                    status, error = 'failed', str(e)
+                c.execute('RELEASE receipt')
+            c.execute('''INSERT OR REPLACE INTO ImportCheckpoints (source, entry, status, invoice_id, error)
+                         VALUES (?, ?, ?, ?, ?)''', (source, entry, status, invoice_id, error))
+            statuses.append(status)
+    metrics.RECEIPTS_INGESTED.inc(statuses.count('done'))
+    return statuses
+
+@app.cli.command('import-ebons')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True, help='Parallel PDF parsers.')
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, show_default=True, help='Receipts per transaction.')
+@click.option('--market-lookup', type=click.Choice(['offline', 'online']), default='offline', show_default=True,
+              help='offline only uses markets already in the market cache.')
+@click.option('--retry-failed', is_flag=True, help='Parse files again that failed in an earlier run.')
+def import_ebons_command(path, workers, batch_size, market_lookup, retry_failed):
+    """Import all eBon PDFs of a directory or ZIP archive. An interrupted import continues where it stopped."""
+    global MARKET_LOOKUP
+    # The parser processes inherit the setting
+    MARKET_LOOKUP = os.environ['MARKET_LOOKUP'] = market_lookup
+    source = os.path.abspath(path)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT entry, status FROM ImportCheckpoints WHERE source = ?', (source,))
+    checkpoints = dict(c.fetchall())
+
+    counts = {'done': 0, 'duplicate': 0, 'failed': 0, 'skipped': 0}
+    started = time.perf_counter()
+    batch = []
+
+    def report():
+        processed = counts['done'] + counts['duplicate'] + counts['failed']
+        elapsed = time.perf_counter() - started
+        click.echo(f"{processed} receipts in {elapsed:.1f}s ({processed / elapsed:.1f} receipts/s): {counts['done']} imported, "
+                   f"{counts['duplicate']} duplicates, {counts['failed']} failed, {counts['skipped']} already imported")
+
+    def flush():
+        for status in write_import_batch(conn, source, batch):
+            counts[status] += 1
+        batch.clear()
+        report()
+
+    # At most a few PDFs per parser are in flight, an archive of any size is never loaded at once
+    from concurrent.futures import ProcessPoolExecutor
+    pending = collections.deque()
+    seen = set()
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+        try:
+            for entry, pdf_bytes in iter_ebons(path):
+                status = checkpoints.get(entry)
+                if status in ('done', 'duplicate') or (status == 'failed' and not retry_failed):
+                    counts['skipped'] += 1
+                    continue
+                fingerprint = pdf_fingerprint(pdf_bytes)
+                if fingerprint in seen or find_duplicate(c, [fingerprint]) is not None:
+                    # Known PDF, write_invoice records it as a duplicate without parsing it again
+                    pending.append((entry, fingerprint, None))
+                else:
+                    seen.add(fingerprint)
+                    pending.append((entry, fingerprint, pool.submit(parse_pdf_bytes, pdf_bytes)))
+
+                while pending and (len(pending) > workers * 4 or pending[0][2] is None or pending[0][2].done()):
+                    batch.append(import_result(*pending.popleft()))
+                    if len(batch) >= batch_size:
+                        flush()
+            while pending:
+                batch.append(import_result(*pending.popleft()))
+                if len(batch) >= batch_size:
+                    flush()
+            if batch:
+                flush()
+            else:
+                report()
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
+
+def import_result(entry, fingerprint, future):
+    # (entry, fingerprint, parsed receipt or None, error) for write_import_batch
+    if future is None:
+        return entry, fingerprint, None, None
+    try:
+        return (entry, fingerprint) + pool_result(future)
+    except Exception as e:
+        return entry, fingerprint, None, str(e)
+
+
+# Archive ##################################################################################################################################
+
+# Invoices of a year go to its archive with their items, price points by their date_changed, the date of their receipt
+ARCHIVE_FILTERS = {
+    'Invoices': 'date >= :start AND date < :end',
+    'InvoiceItems': 'invoice_id IN (SELECT invoice_id FROM main.Invoices WHERE date >= :start AND date < :end)',
+    'PriceHistory': 'date_changed >= :start AND date_changed < :end',
+}
+ARCHIVE_KEYS = {'Invoices': 'invoice_id', 'InvoiceItems': 'invoice_item_id', 'PriceHistory': 'price_id'}
+# Summary triggers that are dropped while archived rows are deleted, the summaries keep counting the archived history
+ARCHIVE_KEPT_TRIGGERS = ('trg_invoices_delete_stats', 'trg_pricehistory_delete_stats')
+
+def history_years():
+    # The archived years the date range of the request reaches into, all of them without a range
+    date_from = parse_date_arg('date_from')
+    date_to = parse_date_arg('date_to')
+    return [year for year in archived_years()
+            if (date_from is None or year >= date_from.year) and (date_to is None or year <= date_to.year)]
+
+def history_db(years=None):
+    # The connection for a query over the history: the database itself, or if archived years are needed (by default
+    # those of the request's date range) a connection with their archives attached that is closed after the request
+    years = history_years() if years is None else years
+    if not years:
+        return get_db()
+    if len(years) > MAX_ATTACHED:
+        abort(400, f"The date range covers {len(years)} archived years, at most {MAX_ATTACHED} can be read at once")
+    conn = connect_history(years)
+    g.setdefault('history_connections', []).append(conn)
+    return conn
+
+@app.teardown_request
+def close_history_db(exception):
+    for conn in g.pop('history_connections', []):
+        conn.close()
+
+def archive_year(conn, year):
+    # Moves the invoices, invoice items and price history of year to its archive and returns the rows moved per table.
+    # The copy is committed before anything is deleted, and only rows found in the archive are deleted: interrupted
+    # in between the rows are in both files until the next run, and a receipt of that year written in between stays.
+    path = archive_path(year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    bounds = {'start': f'{year:04d}-01-01', 'end': f'{year + 1:04d}-01-01'}
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    try:
+        with conn:
+            begin_immediate(conn)
+            c = conn.cursor()
+            # The archive has the tables and indexes of the database, columns added since it was created are added
+            c.execute(f'''SELECT sql FROM main.sqlite_master
+                         WHERE tbl_name IN ({', '.join('?' * len(ARCHIVE_TABLES))}) AND type IN ('table', 'index') AND sql IS NOT NULL
+                         ORDER BY type = 'index'
+                      ''', ARCHIVE_TABLES)
+            for sql, in c.fetchall():
+                c.execute(re.sub(r'^\s*CREATE\s+(TABLE|(?:UNIQUE\s+)?INDEX)\s+(?:IF\s+NOT\s+EXISTS\s+)?',
+                                 r'CREATE \1 IF NOT EXISTS archive.', sql, flags=re.IGNORECASE))
+            for table in ARCHIVE_TABLES:
+                c.execute(f'PRAGMA main.table_info({table})')
+                columns = [(row[1], row[2]) for row in c.fetchall()]
+                c.execute(f'PRAGMA archive.table_info({table})')
+                archived_columns = {row[1] for row in c.fetchall()}
+                for name, column_type in columns:
+                    if name not in archived_columns:
+                        c.execute(f'ALTER TABLE archive.{table} ADD COLUMN {name} {column_type}')
+                names = ', '.join(name for name, column_type in columns)
+                c.execute(f'INSERT OR REPLACE INTO archive.{table} ({names}) SELECT {names} FROM main.{table} '
+                          f'WHERE {ARCHIVE_FILTERS[table]}', bounds)
+
+        counts = {}
+        with conn:
+            begin_immediate(conn)
+            c = conn.cursor()
+            c.execute("SELECT sql FROM main.sqlite_master WHERE type = 'trigger' AND name IN (?, ?)", ARCHIVE_KEPT_TRIGGERS)
+            kept_triggers = [row[0] for row in c.fetchall()]
+            for name in ARCHIVE_KEPT_TRIGGERS:
+                c.execute(f'DROP TRIGGER IF EXISTS main.{name}')
+            # Items first, they are found through their invoices
+            for table in ('InvoiceItems', 'Invoices', 'PriceHistory'):
+                key = ARCHIVE_KEYS[table]
+                c.execute(f'DELETE FROM main.{table} WHERE {ARCHIVE_FILTERS[table]} AND {key} IN (SELECT {key} FROM archive.{table})',
+                          bounds)
+                counts[table] = c.rowcount
+            for sql in kept_triggers:
+                c.execute(sql)
+        return counts
+    finally:
+        conn.execute('DETACH DATABASE archive')
+
+def archive_id_problems(conn):
+    # The ids an archive holds above the largest id the database has handed out, the database would hand them out again
+    # and the history would have two rows with one id
+    c = conn.cursor()
+    c.execute('SELECT name, seq FROM sqlite_sequence')
+    handed_out = dict(c.fetchall())
+    problems = []
+    for year in archived_years():
+        with closing(sqlite3.connect(f'file:{quote(archive_path(year))}?mode=ro', uri=True)) as archive:
+            for table in ARCHIVE_TABLES:
+                key = ARCHIVE_KEYS[table]
+                archived_max, = archive.execute(f'SELECT max({key}) FROM {table}').fetchone()
+                if archived_max is not None and archived_max > handed_out.get(table, 0):
+                    problems.append(f"{archive_path(year)}: {table} has {key} {archived_max}, "
+                                    f"the database has only handed out up to {handed_out.get(table, 0)}")
+    return problems
+
+@app.cli.command('archive')
+@click.option('--before', 'before_year', type=int, default=lambda: datetime.date.today().year,
+              help='Archive the years before this one, by default the current year.')
+@click.option('--vacuum', is_flag=True, help='Give the space of the archived rows back to the file system.')
+def archive_command(before_year, vacuum):
+    """Move the invoices and price history of closed years into one database file per year."""
+    conn = get_db()
+    problems = archive_id_problems(conn)
+    if problems:
+        raise click.ClickException('Ids of the archives would be handed out again:\n' + '\n'.join(problems))
+    c = conn.cursor()
+    # Dates that are no ISO date (there should be none) are never archived
+    c.execute('''SELECT substr(date, 1, 4) FROM Invoices WHERE date < ? AND date GLOB '[0-9][0-9][0-9][0-9]-*'
+                 UNION
+                 SELECT substr(date_changed, 1, 4) FROM PriceHistory WHERE date_changed < ? AND date_changed GLOB '[0-9][0-9][0-9][0-9]-*'
+              ''', (f'{before_year:04d}-01-01',) * 2)
+    years = sorted(int(row[0]) for row in c.fetchall())
+    for year in years:
+        started = time.perf_counter()
+        counts = archive_year(conn, year)
+        click.echo(f"{year}: {counts['Invoices']} invoices, {counts['InvoiceItems']} items and {counts['PriceHistory']} prices "
+                   f"moved to {archive_path(year)} in {time.perf_counter() - started:.1f}s")
+    if not years:
+        click.echo(f"Nothing to archive before {before_year}")
+    if len(archived_years()) > MAX_ATTACHED:
+        click.echo(f"{len(archived_years())} archived years, reports can read at most {MAX_ATTACHED} of them at once")
+    if vacuum:
+        conn.execute('VACUUM')
+        click.echo(f"Database vacuumed, {os.path.getsize(conn.execute('PRAGMA database_list').fetchone()[2]) / 1e6:.1f} MB")
+
+
+# Job queue ##############################################################################################################################
+
+# A running job whose worker died (e.g. the uWSGI worker was restarted) is picked up again after the lease expired
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 600))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))
+
+job_wakeup = threading.Event()
+job_worker = None
+job_worker_lock = threading.Lock()
+
+def enqueue_job(filename, payload):
+    # Returns the job id and the status the job was created with
+    conn = get_db()
+    c = conn.cursor()
+    duplicate = find_duplicate(c, [pdf_fingerprint(payload)])
+    if duplicate is not None:
+        # Nothing to do for a PDF that was ingested before, the job is done right away
+        c.execute('''INSERT INTO Jobs (filename, status, invoice_id, error, finished_at)
+                     VALUES (?, 'done', ?, ?, datetime('now','localtime'))''',
+                  (filename, duplicate, str(DuplicateReceipt(duplicate))))
+        job_id = c.lastrowid
+        conn.commit()
+        return job_id, 'done'
+
+    c.execute('INSERT INTO Jobs (filename, payload) VALUES (?, ?)', (filename, payload))
+    job_id = c.lastrowid
+    conn.commit()
+    job_wakeup.set()
+    return job_id, 'queued'
 
+def claim_job(conn):
+    # Atomically move the oldest queued (or abandoned) job to running, so several workers never pick the same job
+    c = conn.cursor()
+    c.execute('''
+        UPDATE Jobs SET status='running', started_at=datetime('now','localtime')
+        WHERE job_id = (
+            SELECT job_id FROM Jobs
+            WHERE status='queued'
+               OR (status='running' AND started_at < datetime('now','localtime', ?))
+            ORDER BY job_id
+            LIMIT 1
+        )
+        RETURNING job_id, filename, payload
+    ''', (f'-{JOB_LEASE_SECONDS} seconds',))
+    job = c.fetchone()
+    conn.commit()
+    return job
 
+def finish_job(conn, job_id, status, invoice_id=None, error=None):
+    # The PDF is not needed anymore once the job has finished
+    conn.execute('''UPDATE Jobs SET status=?, invoice_id=?, error=?, payload=NULL, finished_at=datetime('now','localtime')
+                    WHERE job_id=?''', (status, invoice_id, error, job_id))
+    conn.commit()
 
-UPLOAD_FOLDER = './upload_folder'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-create_table()
+def run_job_worker():
+    conn = get_db()
+    while True:
+        job = claim_job(conn)
+        if job is None:
+            job_wakeup.wait(JOB_POLL_INTERVAL)
+            job_wakeup.clear()
+            continue
+
+        job_id, filename, payload = job
+        started = time.perf_counter()
+        metrics.start_trace()
+        try:
+            invoice_id = process_pdf_file(payload, filename)
+        except DuplicateReceipt as e:
+            # The receipt is in the database already, the job is done without adding it twice
+            finish_job(conn, job_id, 'done', invoice_id=e.invoice_id, error=str(e))
+        except Exception as e:
+            app.logger.exception('Job %s (%s) failed', job_id, filename)
+            finish_job(conn, job_id, 'failed', error=str(e))
+        else:
+            finish_job(conn, job_id, 'done', invoice_id=invoice_id)
+        log_if_slow(f'Job {job_id} ({filename})', time.perf_counter() - started, metrics.end_trace())
+        metrics.flush()
+
+def start_job_worker():
+    # With JOB_WORKER=1 starts a background worker in this process once, threads do not survive a fork so this is checked
+    # per process. By default the jobs are processed by flask job-worker: parsing holds the GIL and would load pdfminer
+    # and requests into every web worker.
+    global job_worker
+    if os.environ.get('JOB_WORKER', '0') != '1':
+        return
+    with job_worker_lock:
+        if job_worker is None or not job_worker.is_alive():
+            job_worker = threading.Thread(target=run_job_worker, name='job-worker', daemon=True)
+            job_worker.start()
+
+@app.before_request
+def ensure_job_worker():
+    # Drains jobs left over from before a restart without waiting for the next upload
+    start_job_worker()
+
+@app.cli.command('job-worker')
+def job_worker_command():
+    """Process upload jobs in this process, the web workers only queue them."""
+    # The web workers never load the PDF and HTTP libraries, only this process does. Several of them can run at once,
+    # a job is claimed by one of them.
+    click.echo(f"Processing upload jobs of {get_db().execute('PRAGMA database_list').fetchone()[2]}")
+    run_job_worker()
+
+
+# Metrics ##################################################################################################################################
+
+# Requests and upload jobs slower than this many seconds are logged with the time per stage, unset turns the log off
+SLOW_REQUEST_SECONDS = float(os.environ['SLOW_REQUEST_SECONDS']) if os.environ.get('SLOW_REQUEST_SECONDS') else None
+
+def log_if_slow(what, elapsed, trace):
+    if SLOW_REQUEST_SECONDS is not None and elapsed >= SLOW_REQUEST_SECONDS:
+        app.logger.warning('Slow: %s took %.1fms (%s)', what, elapsed * 1000, metrics.format_trace(trace) or 'no stages')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.start_trace()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    log_if_slow(f'{request.method} {request.full_path.rstrip("?")} {response.status_code}', elapsed, metrics.end_trace())
+    return response
+
+@app.teardown_request
+def flush_metrics(exception):
+    metrics.flush()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format, summed over all worker processes
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def migrate_database():
+    with closing(connect()) as conn:
+        return migrate(conn)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = migrate_database()
+    click.echo(f"Applied migrations {', '.join(map(str, applied))}" if applied else "Schema is up to date")
+    click.echo(f"Schema version {SCHEMA_VERSION}")
+
+# Apply pending schema migrations, for an up to date database this is a single version check
+migrate_database()
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=80)
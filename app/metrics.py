@@ -0,0 +1,311 @@
+# Counters and histograms in the Prometheus text format.
+# uWSGI runs several worker processes and every one of them only sees its own requests. Each process therefore writes
+# its values to a file of its own in METRICS_DIR and /metrics adds up the files of all processes. The files of processes
+# that exited are added to one totals file and removed, so the totals never go down when a worker is restarted and the
+# directory does not grow with every restart.
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'inventory-metrics'))
+# A process writes its file at most this often (and when it exits), /metrics always sees its own process up to date
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# The values of the processes that exited, and the lock that is held exclusively while files are added to it
+TOTALS_FILE = 'totals.json'
+TOTALS_LOCK = 'totals.lock'
+
+# Seconds, from a cache hit to a slow PDF
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = {}
+state = threading.local()
+process = {'pid': None}
+
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry[name] = self
+
+    def key(self, labels):
+        # Label values in the order of self.labels, as a JSON string so it can be a key in the metrics files
+        return json.dumps([str(labels[label]) for label in self.labels])
+
+    def values(self):
+        return current()['values'].setdefault(self.name, {})
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with lock():
+            values = self.values()
+            key = self.key(labels)
+            values[key] = values.get(key, 0) + amount
+
+    def merge(self, values, other):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values):
+        if not values and not self.labels:
+            values = {self.key({}): 0}
+        lines = []
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, key)} {format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        with lock():
+            values = self.values()
+            key = self.key(labels)
+            # Count per bucket (not cumulative), the last one is +Inf, then the sum and the number of observations
+            sample = values.get(key)
+            if sample is None:
+                sample = values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, values, other):
+        for key, (counts, total, count) in other.items():
+            sample = values.get(key)
+            if sample is None or len(sample[0]) != len(counts):
+                values[key] = [list(counts), total, count]
+            else:
+                sample[0] = [a + b for a, b in zip(sample[0], counts)]
+                sample[1] += total
+                sample[2] += count
+
+    def render(self, values):
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = bound if bound == '+Inf' else format_value(bound)
+                lines.append(f'{self.name}_bucket{format_labels(self.labels + ("le",), key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+
+def format_labels(names, key, *extra):
+    values = json.loads(key) + list(extra)
+    if not values:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def current():
+    # The values of this process. A child created by fork starts empty, the parent reports what it inherited.
+    if process['pid'] != os.getpid():
+        process.update(pid=os.getpid(), lock=threading.Lock(), values={}, flushed=0,
+                       file=os.path.join(METRICS_DIR, f'{os.getpid()}-{time.time_ns()}.json'))
+    return process
+
+def lock():
+    return current()['lock']
+
+def take():
+    # Returns the values of this process and starts over, a process pool worker hands them to its parent this way
+    with lock():
+        values = process['values']
+        process['values'] = {}
+    return values
+
+def merge(values, into=None):
+    # Adds values of another process, e.g. those returned by take() in a pool worker
+    if into is None:
+        with lock():
+            merge(values, current()['values'])
+            trace = getattr(state, 'trace', None)
+            if trace is not None:
+                for key, (counts, total, count) in values.get(STAGE_SECONDS.name, {}).items():
+                    stage = json.loads(key)[0]
+                    trace[stage] = trace.get(stage, 0) + total
+        return
+    for name, other in values.items():
+        if name in registry:
+            registry[name].merge(into.setdefault(name, {}), other)
+
+def flush(force=False):
+    # Writes the values of this process to its file in METRICS_DIR, atomically so a reader never sees half a file
+    process = current()
+    if not force and time.monotonic() - process['flushed'] < FLUSH_INTERVAL:
+        return
+    with lock():
+        if not process['values'] and not os.path.exists(process['file']):
+            return
+        data = json.dumps(process['values'])
+        process['flushed'] = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    temp_file = f"{process['file']}.tmp"
+    with open(temp_file, 'w') as f:
+        f.write(data)
+    os.replace(temp_file, process['file'])
+
+atexit.register(flush, True)
+
+def process_exited(name):
+    # Whether the process that wrote the file name ({pid}-{start}.json) is gone. A process of another user is alive,
+    # a new process with a reused pid writes another file.
+    try:
+        pid = int(name.split('-', 1)[0])
+    except ValueError:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+def read_totals():
+    # {'values': the values of the exited processes, 'folded': the files already added to them}
+    try:
+        with open(os.path.join(METRICS_DIR, TOTALS_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'values': {}, 'folded': []}
+
+def fold(names):
+    # Adds the files of exited processes to the totals file and removes them, the caller holds the exclusive lock.
+    # The totals name the files they contain until the files are gone, a file is never added twice even if the
+    # process doing this dies between writing the totals and removing the files.
+    totals = read_totals()
+    folded = set(totals['folded']) & set(os.listdir(METRICS_DIR))
+    for name in names:
+        if name in folded:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                merge(json.load(f), totals['values'])
+        except (OSError, ValueError):
+            # Vanished or unreadable, collect() skips it as well
+            continue
+        folded.add(name)
+    totals['folded'] = sorted(folded)
+    temp_file = os.path.join(METRICS_DIR, f'{TOTALS_FILE}.{os.getpid()}.tmp')
+    with open(temp_file, 'w') as f:
+        json.dump(totals, f)
+    os.replace(temp_file, os.path.join(METRICS_DIR, TOTALS_FILE))
+    for name in folded:
+        try:
+            os.remove(os.path.join(METRICS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+def collect():
+    # The values of all processes that ever wrote to METRICS_DIR, the own process taken from memory. The files of
+    # exited processes are added to the totals first, the files are read under the shared lock so none is seen twice
+    # or not at all while that happens.
+    own = current()
+    with lock():
+        total = json.loads(json.dumps(own['values']))
+    try:
+        lock_file = open(os.path.join(METRICS_DIR, TOTALS_LOCK), 'a')
+    except FileNotFoundError:
+        return total
+    with lock_file:
+        exited = [name for name in os.listdir(METRICS_DIR)
+                  if name.endswith('.json') and name != TOTALS_FILE and process_exited(name)]
+        if exited:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            fold(exited)
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        totals = read_totals()
+        merge(totals['values'], total)
+        folded = set(totals['folded'])
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if not name.endswith('.json') or name == TOTALS_FILE or name in folded or path == own['file']:
+                continue
+            try:
+                with open(path) as f:
+                    merge(json.load(f), total)
+            except (OSError, ValueError):
+                # Vanished or unreadable, e.g. removed while the directory was cleaned up
+                continue
+    return total
+
+def render(values=None):
+    values = collect() if values is None else values
+    lines = []
+    for name, metric in registry.items():
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        lines.extend(metric.render(values.get(name, {})))
+    return '\n'.join(lines) + '\n'
+
+
+# Per request breakdown ##################################################################################################################
+
+def start_trace():
+    # Collects the time per stage of the current thread until end_trace(), for the slow request log
+    state.trace = {}
+
+def end_trace():
+    trace = getattr(state, 'trace', None)
+    state.trace = None
+    return trace or {}
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        trace = getattr(state, 'trace', None)
+        if trace is not None:
+            trace[name] = trace.get(name, 0) + elapsed
+
+def format_trace(trace):
+    return ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in sorted(trace.items(), key=lambda item: -item[1]))
+
+
+# The metrics of the application #########################################################################################################
+
+STAGE_SECONDS = Histogram('inventory_stage_duration_seconds',
+                          'Time spent per processing stage (pdf_extract, parse, market_lookup, db_lock_wait, db_write, report_snapshot).',
+                          ('stage',))
+REQUEST_SECONDS = Histogram('inventory_request_duration_seconds', 'Time spent per route handler.', ('endpoint',))
+REQUESTS = Counter('inventory_requests_total', 'Requests per route handler and status code.', ('endpoint', 'status'))
+RECEIPTS_INGESTED = Counter('inventory_receipts_ingested_total', 'Receipts written to the database.')
+ITEMS_PARSED = Counter('inventory_items_parsed_total', 'Items parsed from receipts.')
+PARSE_FAILURES = Counter('inventory_parse_failures_total', 'Receipts that could not be parsed.')
+DB_LOCK_RETRIES = Counter('inventory_db_lock_retries_total', 'Attempts to take the database write lock that found it taken.')
+MARKET_LOOKUPS = Counter('inventory_market_lookups_total', 'Market lookups by result (hit, miss, error).', ('result',))
+PAGE_CACHE = Counter('inventory_page_cache_total', 'Listing pages by result (hit, miss, not_modified).', ('result',))
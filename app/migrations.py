@@ -0,0 +1,820 @@
+# Schema migrations. The schema version is stored in PRAGMA user_version, migration n brings the database from version n - 1
+# to version n. Released migrations are never changed, schema changes are new migrations appended to MIGRATIONS.
+# Steps that may run against a database created before versioning use IF NOT EXISTS.
+import re
+import sqlite3
+from contextlib import closing
+from urllib.parse import quote
+
+from db import archive_path, archived_years
+
+# From-scratch definitions of the summary tables, used to fill, verify and rebuild them
+INVENTORY_TOTALS_SQL = '''
+    SELECT 1,
+           (SELECT coalesce(sum(coalesce(il.quantity, 0) * coalesce(p.price, 0)), 0)
+            FROM InventoryLevels AS il
+            INNER JOIN Products AS p ON p.product_id = il.product_id),
+           (SELECT count(*) FROM InventoryLevels WHERE quantity > 0)
+'''
+SUPPLIER_STATS_SQL = '''
+    SELECT s.supplier_id, count(i.invoice_id), round(coalesce(sum(i.total_amount), 0), 2)
+    FROM Suppliers AS s
+    LEFT JOIN Invoices AS i ON s.supplier_id = i.supplier_id
+    GROUP BY s.supplier_id
+'''
+
+AGGREGATE_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_inventorylevels_insert_totals AFTER INSERT ON InventoryLevels
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value + coalesce(NEW.quantity, 0) * coalesce((SELECT price FROM Products WHERE product_id = NEW.product_id), 0),
+            products_in_stock = products_in_stock + (coalesce(NEW.quantity, 0) > 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_inventorylevels_update_totals AFTER UPDATE OF quantity, product_id ON InventoryLevels
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value
+                + coalesce(NEW.quantity, 0) * coalesce((SELECT price FROM Products WHERE product_id = NEW.product_id), 0)
+                - coalesce(OLD.quantity, 0) * coalesce((SELECT price FROM Products WHERE product_id = OLD.product_id), 0),
+            products_in_stock = products_in_stock + (coalesce(NEW.quantity, 0) > 0) - (coalesce(OLD.quantity, 0) > 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_inventorylevels_delete_totals AFTER DELETE ON InventoryLevels
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value - coalesce(OLD.quantity, 0) * coalesce((SELECT price FROM Products WHERE product_id = OLD.product_id), 0),
+            products_in_stock = products_in_stock - (coalesce(OLD.quantity, 0) > 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_products_insert_totals AFTER INSERT ON Products
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value + coalesce(NEW.price, 0) * coalesce((SELECT quantity FROM InventoryLevels WHERE product_id = NEW.product_id), 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_products_update_totals AFTER UPDATE OF price ON Products
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value
+                + (coalesce(NEW.price, 0) - coalesce(OLD.price, 0))
+                  * coalesce((SELECT quantity FROM InventoryLevels WHERE product_id = NEW.product_id), 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_products_delete_totals AFTER DELETE ON Products
+    BEGIN
+        UPDATE InventoryTotals SET
+            total_value = total_value - coalesce(OLD.price, 0) * coalesce((SELECT quantity FROM InventoryLevels WHERE product_id = OLD.product_id), 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_suppliers_insert_stats AFTER INSERT ON Suppliers
+    BEGIN
+        INSERT OR REPLACE INTO SupplierStats (supplier_id, invoice_count, total_revenue)
+        SELECT NEW.supplier_id, count(*), round(coalesce(sum(total_amount), 0), 2) FROM Invoices WHERE supplier_id = NEW.supplier_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_suppliers_delete_stats AFTER DELETE ON Suppliers
+    BEGIN
+        DELETE FROM SupplierStats WHERE supplier_id = OLD.supplier_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_invoices_insert_stats AFTER INSERT ON Invoices
+    BEGIN
+        UPDATE SupplierStats SET
+            invoice_count = invoice_count + 1,
+            total_revenue = round(total_revenue + coalesce(NEW.total_amount, 0), 2)
+        WHERE supplier_id = NEW.supplier_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_invoices_update_stats AFTER UPDATE OF supplier_id, total_amount ON Invoices
+    BEGIN
+        UPDATE SupplierStats SET
+            invoice_count = invoice_count - 1,
+            total_revenue = round(total_revenue - coalesce(OLD.total_amount, 0), 2)
+        WHERE supplier_id = OLD.supplier_id;
+        UPDATE SupplierStats SET
+            invoice_count = invoice_count + 1,
+            total_revenue = round(total_revenue + coalesce(NEW.total_amount, 0), 2)
+        WHERE supplier_id = NEW.supplier_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_invoices_delete_stats AFTER DELETE ON Invoices
+    BEGIN
+        UPDATE SupplierStats SET
+            invoice_count = invoice_count - 1,
+            total_revenue = round(total_revenue - coalesce(OLD.total_amount, 0), 2)
+        WHERE supplier_id = OLD.supplier_id;
+    END
+    ''',
+]
+
+def rebuild_aggregates(c):
+    # Recomputes the summary tables from the base tables, the caller is responsible for the transaction
+    c.execute('DELETE FROM InventoryTotals')
+    c.execute('INSERT INTO InventoryTotals (id, total_value, products_in_stock) ' + INVENTORY_TOTALS_SQL)
+    c.execute('DELETE FROM SupplierStats')
+    c.execute('INSERT INTO SupplierStats (supplier_id, invoice_count, total_revenue) ' + SUPPLIER_STATS_SQL)
+
+# Price statistics per product, {where} restricts the price points (e.g. to a date range or one product).
+# The window runs over (product_id, date_changed) in the order of the index on PriceHistory.
+PRICE_STATS_SQL = '''
+    SELECT product_id, min(price) AS min_price, max(price) AS max_price,
+           first_price, min(date_changed) AS first_date, last_price, max(date_changed) AS last_date,
+           count(*) AS price_count, sum(price) AS price_sum
+    FROM (
+        SELECT product_id, price, date_changed,
+               first_value(price) OVER w AS first_price,
+               last_value(price) OVER w AS last_price
+        FROM PriceHistory
+        {where}
+        WINDOW w AS (PARTITION BY product_id ORDER BY date_changed, price_id ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+    )
+    GROUP BY product_id
+'''
+
+PRICE_STATS_TRIGGERS = [
+    # A new price point is folded into the product's row, purchases only ever append
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_pricehistory_insert_stats AFTER INSERT ON PriceHistory WHEN NEW.price IS NOT NULL
+    BEGIN
+        INSERT INTO PriceStats (product_id, min_price, max_price, first_price, first_date, last_price, last_date, price_count, price_sum)
+        VALUES (NEW.product_id, NEW.price, NEW.price, NEW.price, NEW.date_changed, NEW.price, NEW.date_changed, 1, NEW.price)
+        ON CONFLICT (product_id) DO UPDATE SET
+            min_price = min(min_price, excluded.min_price),
+            max_price = max(max_price, excluded.max_price),
+            first_price = CASE WHEN excluded.first_date < first_date THEN excluded.first_price ELSE first_price END,
+            first_date = min(first_date, excluded.first_date),
+            last_price = CASE WHEN excluded.last_date >= last_date THEN excluded.last_price ELSE last_price END,
+            last_date = max(last_date, excluded.last_date),
+            price_count = price_count + 1,
+            price_sum = price_sum + excluded.price_sum;
+    END
+    ''',
+    # Changed or removed price points recompute the product's row from its own points in the index
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_pricehistory_update_stats AFTER UPDATE OF product_id, price, date_changed ON PriceHistory
+    BEGIN
+        DELETE FROM PriceStats WHERE product_id IN (OLD.product_id, NEW.product_id);
+        INSERT INTO PriceStats (product_id, min_price, max_price, first_price, first_date, last_price, last_date, price_count, price_sum)
+    ''' + PRICE_STATS_SQL.format(where='WHERE product_id IN (OLD.product_id, NEW.product_id) AND price IS NOT NULL') + ''';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_pricehistory_delete_stats AFTER DELETE ON PriceHistory
+    BEGIN
+        DELETE FROM PriceStats WHERE product_id = OLD.product_id;
+        INSERT INTO PriceStats (product_id, min_price, max_price, first_price, first_date, last_price, last_date, price_count, price_sum)
+    ''' + PRICE_STATS_SQL.format(where='WHERE product_id = OLD.product_id AND price IS NOT NULL') + ''';
+    END
+    ''',
+]
+
+def rebuild_price_stats(c):
+    c.execute('DELETE FROM PriceStats')
+    c.execute('INSERT INTO PriceStats (product_id, min_price, max_price, first_price, first_date, last_price, last_date, price_count, price_sum) '
+              + PRICE_STATS_SQL.format(where='WHERE price IS NOT NULL'))
+
+
+def migration_1_tables(c):
+    # Create the Invoices table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Invoices (
+            invoice_id INTEGER PRIMARY KEY,
+            date TEXT DEFAULT (datetime('now','localtime')),
+            supplier_id INTEGER,
+            total_amount REAL,
+            due_date TEXT,
+            currency TEXT,
+            payment_status TEXT DEFAULT 'Paid',
+            FOREIGN KEY (supplier_id) REFERENCES Suppliers (supplier_id)
+        )
+    ''')
+
+    # Create the Products table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Products (
+            product_id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE,
+            description TEXT,
+            price REAL,
+            category_id INTEGER,
+            manufacturer TEXT,
+            weight REAL,
+            dimensions TEXT,
+            SKU TEXT,
+            unit_id INTEGER,
+            FOREIGN KEY (category_id) REFERENCES Categories (category_id),
+            FOREIGN KEY (unit_id) REFERENCES Units (unit_id)
+        )
+    ''')
+
+    # Create the InvoiceItems table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS InvoiceItems (
+            invoice_item_id INTEGER PRIMARY KEY,
+            invoice_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER,
+            unit_price REAL,
+            discount_percentage REAL,
+            tax_rate REAL,
+            FOREIGN KEY (invoice_id) REFERENCES Invoices (invoice_id),
+            FOREIGN KEY (product_id) REFERENCES Products (product_id)
+        )
+    ''')
+
+    # Create the Categories table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Categories (
+            category_id INTEGER PRIMARY KEY,
+            name TEXT,
+            description TEXT
+        )
+    ''')
+
+    # Create the Suppliers table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Suppliers (
+            supplier_id INTEGER PRIMARY KEY,
+            name TEXT,
+            address TEXT,
+            contact_number TEXT,
+            email TEXT,
+            preferred_payment_terms TEXT,
+            lead_time INTEGER,
+            CHECK (lead_time >= 0)
+        )
+    ''')
+
+    # Create the Units table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Units (
+            unit_id INTEGER PRIMARY KEY,
+            name TEXT,
+            abbreviation TEXT
+        )
+    ''')
+
+    # Check if Kilogramm exists in the Units table
+    c.execute("SELECT * FROM Units WHERE name='Kilogramm'")
+    result = c.fetchone()
+
+    # If Kilogramm doesn't exist, insert it into the Units table
+    if not result:
+        c.execute("INSERT INTO Units (name, abbreviation) VALUES ('Kilogramm', 'kg')")
+
+    # Check if Stück exists in the Units table
+    c.execute("SELECT * FROM Units WHERE name='Stück'")
+    result = c.fetchone()
+
+    # If Stück doesn't exist, insert it into the Units table
+    if not result:
+        c.execute("INSERT INTO Units (name, abbreviation) VALUES ('Stück', 'Stk')")
+
+    # Create the InventoryLevels table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS InventoryLevels (
+            inventory_id INTEGER PRIMARY KEY,
+            product_id INTEGER,
+            quantity REAL,
+            reorder_point INTEGER,
+            FOREIGN KEY (product_id) REFERENCES Products (product_id),
+            CHECK (quantity >= 0 AND reorder_point >= 0)
+        )
+    ''')
+
+    # Create the ProductAttributes table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ProductAttributes (
+            attribute_id INTEGER PRIMARY KEY,
+            product_id INTEGER,
+            attribute_name TEXT,
+            attribute_value TEXT,
+            FOREIGN KEY (product_id) REFERENCES Products (product_id)
+        )
+    ''')
+
+    # Create the PriceHistory table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS PriceHistory (
+            price_id INTEGER PRIMARY KEY,
+            product_id INTEGER,
+            price REAL,
+            date_changed TEXT DEFAULT (datetime('now','localtime')),
+            FOREIGN KEY (product_id) REFERENCES Products (product_id)
+        )
+    ''')
+
+
+    # Create the Jobs table, the queue for asynchronous PDF ingestion
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Jobs (
+            job_id INTEGER PRIMARY KEY,
+            filename TEXT,
+            payload BLOB,
+            status TEXT DEFAULT 'queued',
+            invoice_id INTEGER,
+            error TEXT,
+            created_at TEXT DEFAULT (datetime('now','localtime')),
+            started_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY (invoice_id) REFERENCES Invoices (invoice_id),
+            CHECK (status IN ('queued', 'running', 'done', 'failed'))
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON Jobs (status, job_id)')
+
+
+    # Create the MarketCache table, cached market search results keyed by normalized street and zip code
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS MarketCache (
+            search_key TEXT PRIMARY KEY,
+            response TEXT,
+            fetched_at REAL
+        )
+    ''')
+
+    # Create the ReceiptFingerprints table, hashes of ingested PDFs and receipts to skip duplicates
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ReceiptFingerprints (
+            fingerprint TEXT PRIMARY KEY,
+            invoice_id INTEGER,
+            created_at TEXT DEFAULT (datetime('now','localtime')),
+            FOREIGN KEY (invoice_id) REFERENCES Invoices (invoice_id)
+        )
+    ''')
+
+def migration_2_indexes(c):
+    # One inventory row per product, write_invoice upserts on it
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_inventorylevels_product_id ON InventoryLevels (product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_suppliers_address ON Suppliers (address)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_supplier_id ON Invoices (supplier_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoiceitems_invoice_id ON InvoiceItems (invoice_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoiceitems_product_id ON InvoiceItems (product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_pricehistory_product_id_date ON PriceHistory (product_id, date_changed)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_name_nocase ON Products (name COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_unit_id ON Products (unit_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_category_id ON Products (category_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_productattributes_product_id ON ProductAttributes (product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_receiptfingerprints_invoice_id ON ReceiptFingerprints (invoice_id)')
+
+def migration_3_views(c):
+    # View_SupplierList
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_SupplierList AS
+        SELECT supplier_id, name, address, contact_number, email, preferred_payment_terms, lead_time
+        FROM Suppliers
+    ''')
+
+    # View_CategoryList
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_CategoryList AS
+        SELECT category_id, name, description
+        FROM Categories
+    ''')
+
+    # View_UnitList
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_UnitList AS
+        SELECT unit_id, name, abbreviation
+        FROM Units
+    ''')
+
+    # View_InventoryLevels
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_InventoryLevels AS
+        SELECT inventory_id, product_id, quantity, reorder_point
+        FROM InventoryLevels
+    ''')
+
+# Create InvoiceDetails view
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS InvoiceDetails AS
+        SELECT Invoices.invoice_id, Invoices.date, Invoices.total_amount, Invoices.due_date, Invoices.currency, Invoices.payment_status,
+            Suppliers.name AS supplier_name, Suppliers.address AS supplier_address,
+            InvoiceItems.product_id, InvoiceItems.quantity, InvoiceItems.unit_price, InvoiceItems.discount_percentage, InvoiceItems.tax_rate,
+            Products.name AS product_name, Products.description AS product_description, Products.price AS product_price, Products.manufacturer,
+            Categories.name AS category_name, Units.name AS unit_name
+        FROM Invoices
+        INNER JOIN Suppliers ON Invoices.supplier_id = Suppliers.supplier_id
+        INNER JOIN InvoiceItems ON Invoices.invoice_id = InvoiceItems.invoice_id
+        INNER JOIN Products ON InvoiceItems.product_id = Products.product_id
+        LEFT JOIN Categories ON Products.category_id = Categories.category_id
+        INNER JOIN Units ON Products.unit_id = Units.unit_id;
+    ''')
+
+
+
+    # View_SupplierDetails
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_SupplierDetails AS
+        SELECT s.supplier_id, s.name, s.address, s.contact_number, s.email, s.preferred_payment_terms, s.lead_time,
+            i.invoice_id, i.date, i.total_amount, i.due_date, i.currency, i.payment_status
+        FROM Suppliers AS s
+        LEFT JOIN Invoices AS i ON s.supplier_id = i.supplier_id
+    ''')
+
+    # View_CategoryDetails
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_CategoryDetails AS
+        SELECT c.category_id, c.name, c.description, p.product_id, p.name, p.description, p.price
+        FROM Categories AS c
+        LEFT JOIN Products AS p ON c.category_id = p.category_id
+    ''')
+
+    # View_UnitDetails
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_UnitDetails AS
+        SELECT u.unit_id, u.name, u.abbreviation, p.product_id, p.name, p.description, p.price
+        FROM Units AS u
+        LEFT JOIN Products AS p ON u.unit_id = p.unit_id
+    ''')
+
+    # View_OutOfStockProducts
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_OutOfStockProducts AS
+        SELECT p.product_id, p.name, p.price
+        FROM Products AS p
+        LEFT JOIN InventoryLevels AS il ON p.product_id = il.product_id
+        WHERE il.quantity = 0
+    ''')
+
+    # Create the ProductPriceHistory view
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS View_ProductPriceHistory AS
+        SELECT p.product_id, p.name, ph.price, ph.date_changed
+        FROM Products AS p
+        INNER JOIN PriceHistory AS ph ON p.product_id = ph.product_id
+    ''')
+
+    # Create the ProductInventoryView view
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS ProductInventoryView AS
+        SELECT p.product_id, p.name, p.price, il.quantity, u.abbreviation, ROUND(p.price * il.quantity, 2) AS total_price
+        FROM Products p
+        JOIN InventoryLevels il ON p.product_id = il.product_id
+        JOIN Units u ON p.unit_id = u.unit_id
+        WHERE il.quantity > 0
+    ''')
+
+    # Create the InvoiceView view
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS InvoiceView AS
+        SELECT i.invoice_id, i.date, s.name AS supplier_name, s.address AS supplier_address, i.total_amount, i.due_date, i.currency, i.payment_status
+        FROM Invoices i
+        JOIN Suppliers s ON i.supplier_id = s.supplier_id
+    ''')
+
+def migration_4_aggregates(c):
+    # Create the summary tables behind the inventory value and supplier ranking views, kept up to date by the triggers below
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS InventoryTotals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_value REAL NOT NULL DEFAULT 0,
+            products_in_stock INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS SupplierStats (
+            supplier_id INTEGER PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            total_revenue REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (supplier_id) REFERENCES Suppliers (supplier_id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_supplierstats_total_revenue ON SupplierStats (total_revenue)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_supplierstats_invoice_count ON SupplierStats (invoice_count)')
+
+    # Every trigger touches one summary row, so maintenance does not depend on the amount of history
+    for trigger in AGGREGATE_TRIGGERS:
+        c.execute(trigger)
+    # Fill the summary tables from the data already in the database
+    rebuild_aggregates(c)
+
+    # View_TotalInventoryValue, the value of the current stock at the current price of every product
+    c.execute('DROP VIEW IF EXISTS View_TotalInventoryValue')
+    c.execute('''
+        CREATE VIEW View_TotalInventoryValue AS
+        SELECT p.product_id, p.name, il.quantity * p.price AS total_value
+        FROM Products AS p
+        INNER JOIN InventoryLevels AS il ON p.product_id = il.product_id
+    ''')
+
+    # View_SuppliersWithMostInvoices
+    c.execute('DROP VIEW IF EXISTS View_SuppliersWithMostInvoices')
+    c.execute('''
+        CREATE VIEW View_SuppliersWithMostInvoices AS
+        SELECT s.supplier_id, s.name, ss.invoice_count
+        FROM SupplierStats AS ss
+        INNER JOIN Suppliers AS s ON ss.supplier_id = s.supplier_id
+        ORDER BY ss.invoice_count DESC
+    ''')
+
+    # View_TopSuppliersByRevenue
+    c.execute('DROP VIEW IF EXISTS View_TopSuppliersByRevenue')
+    c.execute('''
+        CREATE VIEW View_TopSuppliersByRevenue AS
+        SELECT s.supplier_id, s.name, ss.total_revenue
+        FROM SupplierStats AS ss
+        INNER JOIN Suppliers AS s ON ss.supplier_id = s.supplier_id
+        ORDER BY ss.total_revenue DESC
+    ''')
+
+def migration_5_consumption_log(c):
+    # Create the ConsumptionLog table, every change of stock made by consuming, reducing or depleting products
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ConsumptionLog (
+            log_id INTEGER PRIMARY KEY,
+            product_id INTEGER,
+            requested REAL,
+            consumed REAL,
+            quantity_after REAL,
+            source TEXT,
+            created_at TEXT DEFAULT (datetime('now','localtime')),
+            FOREIGN KEY (product_id) REFERENCES Products (product_id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_consumptionlog_product_id ON ConsumptionLog (product_id)')
+
+def migration_6_iso_dates(c):
+    # Invoice dates were stored as printed on the eBon (dd.mm.yyyy), store them as sortable ISO yyyy-mm-dd
+    c.execute('''
+        UPDATE Invoices SET date = substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)
+        WHERE date GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date_supplier_id ON Invoices (date, supplier_id)')
+
+def migration_7_price_stats(c):
+    # Create the PriceStats table, min, max, first, last and sum of the prices of every product
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS PriceStats (
+            product_id INTEGER PRIMARY KEY,
+            min_price REAL,
+            max_price REAL,
+            first_price REAL,
+            first_date TEXT,
+            last_price REAL,
+            last_date TEXT,
+            price_count INTEGER NOT NULL DEFAULT 0,
+            price_sum REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (product_id) REFERENCES Products (product_id)
+        )
+    ''')
+    for trigger in PRICE_STATS_TRIGGERS:
+        c.execute(trigger)
+    rebuild_price_stats(c)
+
+def migration_8_search(c):
+    # Full text indexes over product names and supplier names and addresses. They are external content tables, the text is
+    # only stored once in Products and Suppliers. The word index answers word and prefix queries, the trigram index
+    # matches inside words of the abbreviated eBon names ("MILCH" finds "BIO VOLLMILCH 3,8").
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ProductSearch USING fts5 (
+            name, content='Products', content_rowid='product_id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ProductSearchTrigram USING fts5 (
+            name, content='Products', content_rowid='product_id', tokenize='trigram'
+        )
+    ''')
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS SupplierSearch USING fts5 (
+            name, address, content='Suppliers', content_rowid='supplier_id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+
+    # Keep the indexes in sync with their content tables
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_products_insert_search AFTER INSERT ON Products
+        BEGIN
+            INSERT INTO ProductSearch (rowid, name) VALUES (NEW.product_id, NEW.name);
+            INSERT INTO ProductSearchTrigram (rowid, name) VALUES (NEW.product_id, NEW.name);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_products_update_search AFTER UPDATE OF name ON Products
+        BEGIN
+            INSERT INTO ProductSearch (ProductSearch, rowid, name) VALUES ('delete', OLD.product_id, OLD.name);
+            INSERT INTO ProductSearchTrigram (ProductSearchTrigram, rowid, name) VALUES ('delete', OLD.product_id, OLD.name);
+            INSERT INTO ProductSearch (rowid, name) VALUES (NEW.product_id, NEW.name);
+            INSERT INTO ProductSearchTrigram (rowid, name) VALUES (NEW.product_id, NEW.name);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_products_delete_search AFTER DELETE ON Products
+        BEGIN
+            INSERT INTO ProductSearch (ProductSearch, rowid, name) VALUES ('delete', OLD.product_id, OLD.name);
+            INSERT INTO ProductSearchTrigram (ProductSearchTrigram, rowid, name) VALUES ('delete', OLD.product_id, OLD.name);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_suppliers_insert_search AFTER INSERT ON Suppliers
+        BEGIN
+            INSERT INTO SupplierSearch (rowid, name, address) VALUES (NEW.supplier_id, NEW.name, NEW.address);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_suppliers_update_search AFTER UPDATE OF name, address ON Suppliers
+        BEGIN
+            INSERT INTO SupplierSearch (SupplierSearch, rowid, name, address) VALUES ('delete', OLD.supplier_id, OLD.name, OLD.address);
+            INSERT INTO SupplierSearch (rowid, name, address) VALUES (NEW.supplier_id, NEW.name, NEW.address);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_suppliers_delete_search AFTER DELETE ON Suppliers
+        BEGIN
+            INSERT INTO SupplierSearch (SupplierSearch, rowid, name, address) VALUES ('delete', OLD.supplier_id, OLD.name, OLD.address);
+        END
+    ''')
+
+    # Index the existing products and suppliers
+    for table in ('ProductSearch', 'ProductSearchTrigram', 'SupplierSearch'):
+        c.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+
+def migration_9_import_checkpoints(c):
+    # Create the ImportCheckpoints table, the files of an archive the import-ebons command has processed
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ImportCheckpoints (
+            source TEXT,
+            entry TEXT,
+            status TEXT,
+            invoice_id INTEGER,
+            error TEXT,
+            imported_at TEXT DEFAULT (datetime('now','localtime')),
+            PRIMARY KEY (source, entry),
+            FOREIGN KEY (invoice_id) REFERENCES Invoices (invoice_id),
+            CHECK (status IN ('done', 'duplicate', 'failed'))
+        )
+    ''')
+
+# Tables behind the listings (/items, /invoices, /invoice_details), every change to them starts a new write generation
+WRITE_GENERATION_TABLES = ('Invoices', 'InvoiceItems', 'Products', 'Suppliers', 'Categories', 'Units', 'InventoryLevels')
+
+def migration_10_write_generation(c):
+    # Create the WriteGeneration row. Pages rendered at an older generation are out of date, so the generation
+    # is part of their ETag and of the key of the page cache.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS WriteGeneration (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('INSERT OR IGNORE INTO WriteGeneration (id) VALUES (1)')
+    for table in WRITE_GENERATION_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_{event.lower()}_generation AFTER {event} ON {table}
+                BEGIN
+                    UPDATE WriteGeneration SET generation = generation + 1 WHERE id = 1;
+                END
+            ''')
+
+def migration_11_sort_indexes(c):
+    # Indexes in the order of the sortable listing columns, with the id as the tie breaker of the keyset, so a page
+    # seeks to the last row of the previous page and reads the rows it shows in order, without sorting anything
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date_invoice_id ON Invoices (date, invoice_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_total_amount_invoice_id ON Invoices (total_amount, invoice_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_price_product_id ON Products (price, product_id)')
+
+def migration_12_price_dates(c):
+    # Price points were dated when the receipt was written, date them by the receipt like write_invoice does now.
+    # Every receipt wrote one price point and one invoice item per item in the same order, so the n-th last price point
+    # of a product and price belongs to the n-th last invoice item of that product and price. Counted from the last one,
+    # because archiving moved the items of old years and left their price points, those keep the date they have.
+    # The statistics are rebuilt once instead of by the update trigger for every row.
+    c.execute('DROP TRIGGER IF EXISTS trg_pricehistory_update_stats')
+    c.execute('''
+        WITH prices AS (
+            SELECT price_id, product_id, price,
+                   row_number() OVER (PARTITION BY product_id, price ORDER BY price_id DESC) AS n
+            FROM PriceHistory
+        ), items AS (
+            SELECT ii.product_id, ii.unit_price, i.date,
+                   row_number() OVER (PARTITION BY ii.product_id, ii.unit_price ORDER BY ii.invoice_item_id DESC) AS n
+            FROM InvoiceItems AS ii
+            INNER JOIN Invoices AS i ON i.invoice_id = ii.invoice_id
+        )
+        UPDATE PriceHistory SET date_changed = items.date
+        FROM prices
+        INNER JOIN items ON items.product_id = prices.product_id AND items.unit_price = prices.price AND items.n = prices.n
+        WHERE PriceHistory.price_id = prices.price_id AND items.date IS NOT NULL
+    ''')
+    c.execute(PRICE_STATS_TRIGGERS[1])
+    rebuild_price_stats(c)
+
+# The tables whose ids must never be handed out twice, with their key
+AUTOINCREMENT_KEYS = {'Invoices': 'invoice_id', 'InvoiceItems': 'invoice_item_id', 'PriceHistory': 'price_id'}
+
+def migration_13_autoincrement_ids(c):
+    # A new row gets the largest id + 1, so once archiving moved the newest rows out of the database their ids were
+    # handed out again and the history had two rows with one id. With AUTOINCREMENT an id is never used twice.
+    # The tables are rebuilt as in https://sqlite.org/lang_altertable.html#otheralter: the views and triggers that
+    # read them (directly or through another view) are dropped first and created again afterwards, their indexes and
+    # own triggers go with them.
+    c.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger', 'view') AND sql IS NOT NULL ORDER BY rowid")
+    schema = c.fetchall()
+    dependent = set(AUTOINCREMENT_KEYS)
+    changed = True
+    while changed:
+        changed = False
+        for object_type, name, sql in schema:
+            if name not in dependent and any(re.search(rf'\b{other}\b', sql, re.IGNORECASE) for other in dependent):
+                dependent.add(name)
+                changed = True
+    recreated = [(object_type, name, sql) for object_type, name, sql in schema if name in dependent]
+    for object_type, name, sql in recreated:
+        if object_type != 'index':
+            c.execute(f'DROP {object_type.upper()} IF EXISTS {name}')
+
+    for table, key in AUTOINCREMENT_KEYS.items():
+        c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        sql, = c.fetchone()
+        sql, renamed = re.subn(rf'^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?"?{table}"?', f'CREATE TABLE {table}_new', sql,
+                               flags=re.IGNORECASE)
+        sql, keyed = re.subn(rf'\b{key}\s+INTEGER\s+PRIMARY\s+KEY\b', f'{key} INTEGER PRIMARY KEY AUTOINCREMENT', sql,
+                             flags=re.IGNORECASE)
+        if not renamed or not keyed:
+            raise RuntimeError(f"Unexpected definition of {table}, {key} is not its INTEGER PRIMARY KEY")
+        c.execute(sql)
+        c.execute(f'PRAGMA table_info({table})')
+        columns = ', '.join(row[1] for row in c.fetchall())
+        # The copy sets the table's sequence to its largest id
+        c.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}')
+        c.execute(f'DROP TABLE {table}')
+        c.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    for object_type, name, sql in recreated:
+        c.execute(sql)
+
+    # Ids that were archived already are not handed out again either
+    for year in archived_years():
+        with closing(sqlite3.connect(f'file:{quote(archive_path(year))}?mode=ro', uri=True)) as archive:
+            for table, key in AUTOINCREMENT_KEYS.items():
+                archived_max, = archive.execute(f'SELECT max({key}) FROM {table}').fetchone()
+                if archived_max is not None:
+                    c.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                              (table, table))
+                    c.execute('UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?', (archived_max, table))
+
+MIGRATIONS = [
+    migration_1_tables,
+    migration_2_indexes,
+    migration_3_views,
+    migration_4_aggregates,
+    migration_5_consumption_log,
+    migration_6_iso_dates,
+    migration_7_price_stats,
+    migration_8_search,
+    migration_9_import_checkpoints,
+    migration_10_write_generation,
+    migration_11_sort_indexes,
+    migration_12_price_dates,
+    migration_13_autoincrement_ids,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    # Brings the database up to SCHEMA_VERSION and returns the versions that were applied.
+    # An up to date database costs a single PRAGMA, so every worker can call this at startup.
+    if schema_version(conn) == SCHEMA_VERSION:
+        return []
+    applied = []
+    while True:
+        # The exclusive lock makes concurrently starting workers wait, the first one applies the step and the others
+        # see the new version once they get the lock
+        conn.execute('BEGIN EXCLUSIVE')
+        try:
+            version = schema_version(conn)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"Database schema version {version} is newer than this application ({SCHEMA_VERSION})")
+            if version == SCHEMA_VERSION:
+                conn.rollback()
+                return applied
+            MIGRATIONS[version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied.append(version + 1)
@@ -0,0 +1,84 @@
+# Cold start of a web worker: the time from starting a fresh interpreter until the first request is answered, split
+# into the interpreter start, the import of main and the first request, measured over several fresh interpreters.
+#   python benchmarks/coldstart.py --budget-ms 500 --output coldstart.json
+# Fails if the median cold start takes longer than the budget or the first request is not answered with 200.
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+from fixtures import APP_DIR, fixture, load_app, working_copy
+from imports import worker_environment
+from run import environment, summary
+
+# Run in the worker process, prints the times since its start as soon as the first response is complete
+WORKER_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+response = main.app.test_client().get(sys.argv[1], headers={'Accept': 'text/html'})
+response.get_data()
+answered = time.perf_counter()
+print(json.dumps({'import': imported - started, 'first_request': answered - imported, 'status': response.status_code}), flush=True)
+'''
+
+def cold_start(env, path):
+    # (seconds until the first response, the worker's own times), the process is started and waited for here
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, path], cwd=APP_DIR, env=env, stdout=subprocess.PIPE,
+                               text=True)
+    line = process.stdout.readline()
+    total = time.perf_counter() - started
+    process.stdout.read()
+    if process.wait() != 0 or not line:
+        raise RuntimeError(f'The worker for {path} exited with status {process.returncode}')
+    return total, json.loads(line)
+
+@click.command()
+@click.option('--runs', type=int, default=5, show_default=True, help='Fresh interpreters to measure.')
+@click.option('--invoices', type=int, default=1000, show_default=True, help='Invoices in the fixture database.')
+@click.option('--path', default='/items', show_default=True, help='The first request.')
+@click.option('--budget-ms', type=float, default=500, show_default=True,
+              help='Allowed median time from starting the interpreter to the first response.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+def main_command(runs, invoices, path, budget_ms, output):
+    """Measure the cold start of a worker up to its first response and check it against the budget."""
+    main, db = load_app()
+    # A database that is migrated already, like the one a restarted worker finds
+    database = working_copy(fixture(invoices), 'coldstart.db')
+    db.configure(database)
+    main.migrate_database()
+    db.close_db()
+    env = dict(worker_environment(), DATABASE=database)
+
+    samples = [cold_start(env, path) for _ in range(runs)]
+    failed_requests = [worker['status'] for total, worker in samples if worker['status'] != 200]
+    results = [
+        {'name': 'cold_start', 'size': invoices, **summary([total for total, worker in samples])},
+        {'name': 'interpreter_start', 'size': invoices,
+         **summary([total - worker['import'] - worker['first_request'] for total, worker in samples])},
+        {'name': 'import_main', 'size': invoices, **summary([worker['import'] for total, worker in samples])},
+        {'name': 'first_request', 'size': invoices, **summary([worker['first_request'] for total, worker in samples])},
+    ]
+    json.dump({**environment(), 'sizes': [invoices], 'options': {'runs': runs, 'path': path}, 'results': results},
+              output, indent=2)
+    output.write('\n')
+
+    for result in results:
+        click.echo(f"{result['name']:18} median {result['median'] * 1000:7.1f}ms  max {result['max'] * 1000:7.1f}ms", err=True)
+    failed = False
+    if failed_requests:
+        click.echo(f"GET {path} answered with {', '.join(map(str, failed_requests))}", err=True)
+        failed = True
+    if results[0]['median'] * 1000 > budget_ms:
+        click.echo(f"Cold start over budget ({budget_ms:.0f}ms)", err=True)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,131 @@
+# Stress test of /consume for lost updates: several processes, like uWSGI workers, consume the same few products at
+# the same time. Afterwards every amount the responses report as consumed has to be gone from the stock, once.
+#   python benchmarks/consume.py --processes 4 --requests 200 --products 3
+# Fails if a request is not answered with 200, if the stock of a product went down by another amount than the
+# responses consumed, or if the ConsumptionLog of a product does not chain (each quantity_after is the one before
+# minus what was consumed), which is what a lost update looks like.
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+from fixtures import APP_DIR, fixture, load_app, working_copy
+from run import environment, summary
+
+# Quantity every stressed product starts with, more than all processes can consume
+STOCK = 1000000.0
+
+# Run in every worker process: waits for the go on stdin, then posts the requests and prints what was consumed
+WORKER_SCRIPT = '''
+import json, random, sys, time
+import main
+product_ids = json.loads(sys.argv[1])
+requests, seed = int(sys.argv[2]), sys.argv[3]
+rng = random.Random(seed)
+client = main.app.test_client()
+consumed = {}
+statuses = {}
+samples = []
+print('ready', flush=True)
+sys.stdin.readline()
+for _ in range(requests):
+    # Quarters are exact in binary, the sums do not drift
+    items = [{'product_id': product_id, 'amount': rng.randint(1, 8) / 4}
+             for product_id in rng.sample(product_ids, rng.randint(1, len(product_ids)))]
+    started = time.perf_counter()
+    response = client.post('/consume', json=items)
+    samples.append(time.perf_counter() - started)
+    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    if response.status_code == 200:
+        for item in response.get_json()['items']:
+            consumed[item['product_id']] = consumed.get(item['product_id'], 0) + item['consumed']
+print(json.dumps({'consumed': consumed, 'statuses': statuses, 'samples': samples}), flush=True)
+'''
+
+def check_log(c, product_ids, first_log_id):
+    # The problems in the ConsumptionLog written since first_log_id, per product the entries have to chain
+    problems = []
+    for product_id in product_ids:
+        c.execute('''SELECT log_id, consumed, quantity_after FROM ConsumptionLog
+                     WHERE product_id = ? AND log_id >= ? ORDER BY log_id''', (product_id, first_log_id))
+        quantity = STOCK
+        for log_id, consumed, quantity_after in c.fetchall():
+            if abs(quantity - consumed - quantity_after) > 1e-6:
+                problems.append(f'product {product_id}, log {log_id}: {quantity} - {consumed} != {quantity_after}')
+            quantity = quantity_after
+    return problems
+
+@click.command()
+@click.option('--processes', type=int, default=4, show_default=True, help='Worker processes posting at the same time.')
+@click.option('--requests', type=int, default=200, show_default=True, help='Requests per process.')
+@click.option('--products', type=int, default=3, show_default=True, help='Products all requests consume from.')
+@click.option('--invoices', type=int, default=1000, show_default=True, help='Invoices in the fixture database.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+def main_command(processes, requests, products, invoices, output):
+    """Consume the same products from several processes at once and check that no update got lost."""
+    main, db = load_app()
+    path = working_copy(fixture(invoices), 'consume.db')
+    db.configure(path)
+    main.migrate_database()
+    conn = db.get_db()
+    c = conn.cursor()
+    c.execute('SELECT product_id FROM InventoryLevels ORDER BY product_id LIMIT ?', (products,))
+    product_ids = [row[0] for row in c.fetchall()]
+    with conn:
+        c.executemany('UPDATE InventoryLevels SET quantity = ? WHERE product_id = ?', [(STOCK, product_id) for product_id in product_ids])
+    c.execute('SELECT coalesce(max(log_id), 0) + 1 FROM ConsumptionLog')
+    first_log_id, = c.fetchone()
+
+    env = dict(os.environ, DATABASE=path)
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, json.dumps(product_ids), str(requests), f'consume-{i}'],
+                                cwd=APP_DIR, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+               for i in range(processes)]
+    for worker in workers:
+        if worker.stdout.readline().strip() != 'ready':
+            raise RuntimeError('A worker did not start')
+    started = time.perf_counter()
+    for worker in workers:
+        worker.stdin.write('go\n')
+        worker.stdin.flush()
+    reports = [json.loads(worker.communicate()[0]) for worker in workers]
+    elapsed = time.perf_counter() - started
+
+    problems = []
+    statuses = {}
+    consumed = {product_id: 0 for product_id in product_ids}
+    samples = []
+    for report in reports:
+        for status, count in report['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+        for product_id, amount in report['consumed'].items():
+            consumed[int(product_id)] += amount
+        samples += report['samples']
+    if set(statuses) != {'200'}:
+        problems.append(f'Responses by status: {statuses}')
+
+    c.execute(f"SELECT product_id, quantity FROM InventoryLevels WHERE product_id IN ({', '.join('?' * len(product_ids))})",
+              product_ids)
+    for product_id, quantity in c.fetchall():
+        if abs(STOCK - quantity - consumed[product_id]) > 1e-6:
+            problems.append(f'product {product_id}: stock went down by {STOCK - quantity}, the responses consumed {consumed[product_id]}')
+    problems += check_log(c, product_ids, first_log_id)
+    db.close_db()
+
+    result = {'name': 'consume', 'size': processes, **summary(samples), 'requests_per_second': len(samples) / elapsed}
+    options = {'processes': processes, 'requests': requests, 'products': products}
+    json.dump({**environment(), 'sizes': [processes], 'options': options, 'results': [result], 'problems': problems},
+              output, indent=2)
+    output.write('\n')
+    click.echo(f"{len(samples)} requests from {processes} processes, {result['requests_per_second']:.0f}/s, "
+               f"median {result['median'] * 1000:.2f}ms  p95 {result['p95'] * 1000:.2f}ms", err=True)
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        sys.exit(1)
+    click.echo('No lost updates', err=True)
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,124 @@
+# Ingest latency while reports run: write_to_database per receipt with nothing else going on, with report clients
+# reading the database itself and with report clients reading the report snapshot while it is refreshed.
+#   python benchmarks/contention.py --invoices 10000 --reporters 2 --output contention.json
+# The report clients are processes of their own, like uWSGI workers, and request REPORT_PATHS over and over. On a
+# machine with few CPUs they take CPU time from the ingest whatever they read, --nice runs them (and the refresh) at a
+# lower priority so the difference between the scenarios is the one of the database.
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import click
+
+from fixtures import APP_DIR, fixture, load_app, remove_database, working_copy
+from run import environment, summary, timed
+import ebons
+
+REPORT_PATHS = (
+    '/reports/spend',
+    '/reports/spend?group=supplier',
+    '/reports/spend?group=week&date_from=2023-01-01',
+    '/prices?date_from=2024-01-01',
+    '/export/invoice_details.csv',
+    '/export/price_history.csv',
+)
+
+# Serves REPORT_PATHS (the arguments) until it is terminated, then prints how many reports it served
+REPORTER_SCRIPT = '''
+import itertools, signal, sys
+import main
+client = main.app.test_client()
+served = 0
+def stop(signum, frame):
+    print(served, flush=True)
+    sys.exit(0)
+signal.signal(signal.SIGTERM, stop)
+print('ready', flush=True)
+for path in itertools.cycle(sys.argv[1:]):
+    client.get(path, headers={'Accept': 'application/json'}).get_data()
+    served += 1
+'''
+
+# scenario -> REPORT_SNAPSHOT_INTERVAL of the report clients, None runs no report clients
+SCENARIOS = {
+    'idle': None,
+    'live': '0',
+    'snapshot': 'refresh',
+}
+
+def run_scenario(main, db, path, scenario, reporters, receipts, refresh_interval, nice):
+    # Returns the write times of receipts and the reports served per second meanwhile
+    db.configure(path)
+    main.migrate_database()
+    remove_database(db.report_path())
+    interval = SCENARIOS[scenario]
+    env = dict(os.environ, DATABASE=path, REPORT_REFRESHER='0',
+               REPORT_SNAPSHOT_INTERVAL=str(refresh_interval) if interval == 'refresh' else '0')
+    preexec_fn = (lambda: os.nice(nice)) if nice else None
+    processes = []
+    if interval == 'refresh':
+        main.refresh_report_snapshot()
+        processes.append(subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'main', 'refresh-reports', '--loop'],
+                                          cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, preexec_fn=preexec_fn))
+    reporter_processes = []
+    if interval is not None:
+        for _ in range(reporters):
+            reporter_processes.append(subprocess.Popen([sys.executable, '-c', REPORTER_SCRIPT, *REPORT_PATHS], cwd=APP_DIR,
+                                                       env=env, stdout=subprocess.PIPE, text=True, preexec_fn=preexec_fn))
+        for process in reporter_processes:
+            if process.stdout.readline().strip() != 'ready':
+                raise RuntimeError('A report client did not start')
+
+    started = time.perf_counter()
+    try:
+        samples = timed(lambda parsed: main.write_to_database(parsed[1], 'benchmark.pdf', parsed[0], parsed[2], []), receipts)
+    finally:
+        elapsed = time.perf_counter() - started
+        served = 0
+        for process in processes + reporter_processes:
+            process.terminate()
+        for process in reporter_processes:
+            served += int(process.stdout.read().strip() or 0)
+        for process in processes + reporter_processes:
+            process.wait()
+        db.close_db()
+    return samples, served / elapsed
+
+@click.command()
+@click.option('--invoices', type=int, default=10000, show_default=True, help='Invoices in the fixture database.')
+@click.option('--receipts', type=int, default=200, show_default=True, help='Receipts written per scenario.')
+@click.option('--reporters', type=int, default=2, show_default=True, help='Report client processes.')
+@click.option('--refresh-interval', type=float, default=5, show_default=True, help='REPORT_SNAPSHOT_INTERVAL of the snapshot scenario.')
+@click.option('--nice', type=int, default=0, show_default=True, help='Niceness of the report clients and the refresh.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+@click.option('--threshold', type=float,
+              help='Exit with status 1 if the median write with the snapshot is more than this many percent slower than idle.')
+def main_command(invoices, receipts, reporters, refresh_interval, nice, output, threshold):
+    """Measure the ingest latency without reports, with reports on the database and with reports on the snapshot."""
+    main, db = load_app()
+    source = fixture(invoices)
+    results = []
+    for scenario in SCENARIOS:
+        # The same receipts in every scenario, each written to a fresh copy of the fixture
+        rng = random.Random(f'contention-{invoices}')
+        parsed = [ebons.receipt(rng)[1] for _ in range(receipts)]
+        path = working_copy(source, f'contention-{scenario}.db')
+        samples, reports_per_second = run_scenario(main, db, path, scenario, reporters, parsed, refresh_interval, nice)
+        result = {'name': f'ingest_{scenario}', 'size': invoices, **summary(samples), 'reports_per_second': reports_per_second}
+        results.append(result)
+        click.echo(f"{result['name']:18} median {result['median'] * 1000:8.3f}ms  p95 {result['p95'] * 1000:8.3f}ms  "
+                   f"max {result['max'] * 1000:8.3f}ms  {reports_per_second:6.1f} reports/s", err=True)
+    options = {'receipts': receipts, 'reporters': reporters, 'refresh_interval': refresh_interval, 'nice': nice}
+    json.dump({**environment(), 'sizes': [invoices], 'options': options, 'results': results}, output, indent=2)
+    output.write('\n')
+
+    idle, live, snapshot = results
+    if threshold is not None and (snapshot['median'] - idle['median']) / idle['median'] * 100 > threshold:
+        click.echo(f"Ingest with reports on the snapshot is more than {threshold:g}% slower than idle", err=True)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,120 @@
+# Synthetic REWE eBons for the benchmarks: receipt text as the parser sees it, the same receipt as a PDF and as the
+# parsed data write_to_database takes. Everything is derived from a random.Random, the same seed gives the same receipts.
+import datetime
+from decimal import Decimal
+
+GOODS = ['VOLLMILCH 3,8', 'H-MILCH 1,5', 'BANANEN', 'AEPFEL ELSTAR', 'TOMATEN', 'GURKE', 'PAPRIKA ROT', 'KAROTTEN',
+         'KARTOFFELN FK', 'ZWIEBELN', 'JOGHURT NATUR', 'QUARK 20%', 'BUTTER', 'KAESE GOUDA', 'EMMENTALER', 'EIER 10ER',
+         'ROGGENBROT', 'TOASTBROT', 'BROETCHEN', 'SPAGHETTI', 'REIS', 'MEHL 405', 'ZUCKER', 'KAFFEE', 'TEE', 'SCHOKOLADE',
+         'MINERALWASSER', 'APFELSAFT', 'COLA', 'BIER', 'HAEHNCHENBRUST', 'HACKFLEISCH', 'LACHS', 'SALAMI', 'KOCHSCHINKEN',
+         'OLIVENOEL', 'TOMATEN PASSIERT', 'MUESLI', 'CHIPS', 'SPUELMITTEL']
+BRANDS = ['', 'BIO ', 'REWE BIO ', 'JA! ', 'REWE BESTE WAHL ']
+# Sold by weight, the item line is followed by "0,856 kg x 2,29 EUR/kg"
+WEIGHED = ('BANANEN', 'AEPFEL ELSTAR', 'TOMATEN', 'PAPRIKA ROT', 'KAROTTEN', 'KARTOFFELN FK', 'ZWIEBELN',
+           'HAEHNCHENBRUST', 'HACKFLEISCH', 'LACHS')
+CITIES = ['Berlin', 'Hamburg', 'Muenchen', 'Koeln', 'Frankfurt', 'Stuttgart', 'Leipzig', 'Dresden']
+STREETS = ['Hauptstr.', 'Bahnhofstr.', 'Schillerstr.', 'Goethestr.', 'Lindenallee', 'Marktplatz', 'Am Ring']
+
+LINES_PER_PAGE = 60
+
+def product_names():
+    return [brand + goods for goods in GOODS for brand in BRANDS]
+
+def markets(rng, count):
+    # (company name, street, zip code, city) of count different markets
+    result = []
+    for i in range(count):
+        street = f'{rng.choice(STREETS)} {rng.randint(1, 200)}'
+        result.append(('REWE Markt GmbH', street, f'{rng.randint(10000, 99999):05d}', rng.choice(CITIES)))
+    return result
+
+def cents(value):
+    return f'{value // 100},{value % 100:02d}'
+
+def receipt(rng, market=None, date=None, items=None, names=None):
+    # Returns (text, parsed) of one eBon. parsed is (company_info, items, date) as extract_data returns it with the
+    # market lookup offline, so it can be written without parsing the text first.
+    names = names or product_names()
+    company_name, street, zip_code, city = market or markets(rng, 1)[0]
+    date = date or datetime.date(2023, 1, 1) + datetime.timedelta(days=rng.randrange(3 * 365))
+    lines = [company_name, street, f'{zip_code} {city}', 'UID Nr.: DE812706034', 'EUR']
+    parsed_items = []
+    for _ in range(items if items is not None else rng.choice([rng.randint(1, 15), rng.randint(10, 40), rng.randint(30, 120)])):
+        name = rng.choice(names)
+        kind = rng.random()
+        if name.endswith(WEIGHED) and kind < 0.8:
+            # Weighed goods: "BANANEN 1,99 B" and "0,856 kg x 2,29 EUR/kg"
+            grams = rng.randint(100, 3000)
+            unit_price = rng.randint(99, 1999)
+            total = round(grams * unit_price / 1000)
+            lines.append(f'{name} {cents(total)} B')
+            lines.append(f'{grams // 1000},{grams % 1000:03d} kg x {cents(unit_price)} EUR/kg')
+            item = (name, total, Decimal(f'{grams // 1000}.{grams % 1000:03d}'), 'kg', Decimal(cents(unit_price).replace(',', '.')))
+        elif kind < 0.15:
+            # Multi-buy on one line: "MINERALWASSER x6 3,54 B", the unit price is derived by the parser
+            count = rng.randint(2, 12)
+            total = rng.randint(20, 300) * count
+            lines.append(f'{name} x{count} {cents(total)} B')
+            unit_price = Decimal(str(round(total / 100 / count, 2)))
+            item = (name, total, Decimal(count), 'Stk', unit_price)
+        elif kind < 0.35:
+            # Several pieces: "JOGHURT NATUR 1,98 B" and "2 Stk x 0,99"
+            count = rng.randint(2, 8)
+            unit_price = rng.randint(19, 999)
+            total = count * unit_price
+            lines.append(f'{name} {cents(total)} B')
+            lines.append(f'{count} Stk x {cents(unit_price)}')
+            item = (name, total, Decimal(count), 'Stk', Decimal(cents(unit_price).replace(',', '.')))
+        else:
+            total = rng.randint(19, 2999)
+            lines.append(f'{name} {cents(total)} {rng.choice("AB")}')
+            item = (name, total, Decimal(1), 'Stk', Decimal(cents(total).replace(',', '.')))
+        parsed_items.append(item)
+
+    total = sum(item[1] for item in parsed_items)
+    lines += ['-' * 38, f'SUMME EUR {cents(total)}', f'Geg. EC-Cash EUR {cents(total)}', '',
+              f'Datum: {date:%d.%m.%Y} Uhrzeit: {rng.randint(7, 21):02d}:{rng.randint(0, 59):02d}:00',
+              f'Bon-Nr.: {rng.randint(1000, 9999)}', f'Markt: {rng.randint(1000, 9999)}', 'Vielen Dank fuer Ihren Einkauf']
+
+    company_info = {'CompanyName': company_name, 'street': street, 'zip_code': zip_code, 'city': city}
+    items_data = [{'name': name, 'total_price': Decimal(cents(total).replace(',', '.')), 'quantity': quantity,
+                   'unit': unit, 'unit_price': unit_price}
+                  for name, total, quantity, unit, unit_price in parsed_items]
+    return '\n'.join(lines), (company_info, items_data, f'{date:%d.%m.%Y}')
+
+def pages(text):
+    # Long receipts are split into pages like the eBon PDFs of the REWE app
+    lines = text.split('\n')
+    return [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)]
+
+def pdf_bytes(text):
+    # A minimal PDF with the receipt lines in a monospaced font, one page per LINES_PER_PAGE lines
+    def escape(line):
+        return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    page_lines = pages(text)
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>',
+    }
+    kids = []
+    for i, lines in enumerate(page_lines):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        kids.append(f'{page_id} 0 R')
+        stream = ''.join(f'BT /F1 9 Tf 10 {800 - 12 * j} Td ({escape(line)}) Tj ET\n'
+                         for j, line in enumerate(lines)).encode('cp1252')
+        objects[page_id] = (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 250 842] /Contents {content_id} 0 R '
+                            f'/Resources << /Font << /F1 3 0 R >> >> >>').encode()
+        objects[content_id] = b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'endstream'
+    objects[2] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'.encode()
+
+    pdf = b'%PDF-1.4\n'
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(pdf)
+        pdf += b'%d 0 obj\n' % object_id + objects[object_id] + b'\nendobj\n'
+    xref = len(pdf)
+    size = max(objects) + 1
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % size + b''.join(b'%010d 00000 n \n' % offsets[i] for i in range(1, size))
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref)
+    return pdf
@@ -0,0 +1,95 @@
+# Builds inventory databases with years of synthetic invoices for the benchmarks.
+#   python benchmarks/fixtures.py --invoices 10000 --years 5 inventory.db
+# Built fixtures are kept in FIXTURE_DIR and reused as long as the schema version is the same.
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'app')
+FIXTURE_DIR = os.environ.get('BENCHMARK_FIXTURE_DIR', os.path.join(tempfile.gettempdir(), 'inventory-benchmarks'))
+
+# Invoices per transaction while building
+FIXTURE_BATCH_SIZE = 500
+
+sys.path.insert(0, BENCHMARK_DIR)
+import ebons
+
+def load_app():
+    # Imports the application without touching a real database, the market search or the job worker
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    os.environ.setdefault('DATABASE', os.path.join(FIXTURE_DIR, 'scratch.db'))
+    os.environ.setdefault('MARKET_LOOKUP', 'offline')
+    os.environ.setdefault('JOB_WORKER', '0')
+    os.environ.setdefault('METRICS_DIR', os.path.join(FIXTURE_DIR, 'metrics'))
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    import db
+    import main
+    return main, db
+
+def build_fixture(path, invoices, years=5, seed=0, market_count=40, end=datetime.date(2025, 12, 31)):
+    # Writes `invoices` receipts spread evenly over `years` years up to `end`, oldest first like a real history
+    main, db = load_app()
+    remove_database(path)
+    db.configure(path)
+    main.migrate_database()
+    rng = random.Random(seed)
+    markets = ebons.markets(rng, market_count)
+    names = ebons.product_names()
+    days = years * 365
+    start = end - datetime.timedelta(days=days - 1)
+
+    conn = db.get_db()
+    for batch_start in range(0, invoices, FIXTURE_BATCH_SIZE):
+        with conn:
+            db.begin_immediate(conn)
+            c = conn.cursor()
+            for i in range(batch_start, min(batch_start + FIXTURE_BATCH_SIZE, invoices)):
+                date = start + datetime.timedelta(days=i * days // invoices)
+                _, (company_info, items, receipt_date) = ebons.receipt(rng, rng.choice(markets), date, names=names)
+                main.write_invoice(c, items, company_info, receipt_date)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.close_db()
+    return path
+
+def fixture(invoices, years=5, seed=0):
+    # Path of a fixture with the given contents, built on first use
+    main, db = load_app()
+    path = os.path.join(FIXTURE_DIR, f'inventory-{invoices}-{years}y-{seed}-v{main.SCHEMA_VERSION}.db')
+    if not os.path.exists(path):
+        build_fixture(path + '.tmp', invoices, years, seed)
+        os.replace(path + '.tmp', path)
+    return path
+
+def working_copy(path, name):
+    # Benchmarks that write get a copy, the fixture itself stays as it was built
+    copy = os.path.join(FIXTURE_DIR, name)
+    remove_database(copy)
+    shutil.copyfile(path, copy)
+    return copy
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+@click.command()
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--invoices', type=int, default=10000, show_default=True)
+@click.option('--years', type=int, default=5, show_default=True, help='The invoices are spread over this many years.')
+@click.option('--seed', type=int, default=0, show_default=True)
+def main_command(path, invoices, years, seed):
+    """Build an inventory database with synthetic invoices."""
+    started = time.perf_counter()
+    build_fixture(path, invoices, years, seed)
+    click.echo(f"{invoices} invoices written to {path} in {time.perf_counter() - started:.1f}s")
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,88 @@
+# Import time and memory of a web worker that only serves the listings, measured in fresh interpreters.
+#   python benchmarks/imports.py --budget-ms 300 --output imports.json
+# Fails if importing the application takes longer than the budget or loads one of HEAVY_MODULES, which belong to
+# the ingestion and are imported where they are used.
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+import click
+
+from fixtures import APP_DIR, FIXTURE_DIR, load_app
+from run import environment, summary
+
+HEAVY_MODULES = ('pdfplumber', 'pdfminer', 'PIL', 'cryptography', 'requests', 'urllib3', 'tabulate', 'multiprocessing')
+
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+# Run in the worker process: the memory after the import and after serving the listings, and the loaded modules
+WORKER_SCRIPT = '''
+import json, sys
+def rss():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS')) / 1024
+import main
+after_import = rss()
+client = main.app.test_client()
+for path in ('/items', '/invoices', '/invoice_details/1'):
+    client.get(path)
+print(json.dumps({'after_import': after_import, 'after_listings': rss(), 'modules': sorted(sys.modules)}))
+'''
+
+def worker_environment():
+    load_app()
+    env = dict(os.environ)
+    env.update(DATABASE=os.path.join(FIXTURE_DIR, 'imports.db'), MARKET_LOOKUP='offline', JOB_WORKER='0')
+    return env
+
+def import_time(env):
+    # Cumulative import time of main in seconds, from python -X importtime
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=APP_DIR, env=env,
+                             capture_output=True, text=True, check=True)
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match and match.group(4) == 'main' and match.group(3) == ' ':
+            return int(match.group(2)) / 1e6
+    raise RuntimeError(f'No import time of main in:\n{process.stderr}')
+
+def worker_memory(env):
+    process = subprocess.run([sys.executable, '-c', WORKER_SCRIPT], cwd=APP_DIR, env=env, capture_output=True,
+                             text=True, check=True)
+    return json.loads(process.stdout.splitlines()[-1])
+
+@click.command()
+@click.option('--runs', type=int, default=5, show_default=True, help='Fresh interpreters to measure.')
+@click.option('--budget-ms', type=float, default=300, show_default=True, help='Allowed median import time of main.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+def main_command(runs, budget_ms, output):
+    """Measure the import time and memory of a listing-only worker and check them against the budget."""
+    env = worker_environment()
+    samples = [import_time(env) for _ in range(runs)]
+    memory = [worker_memory(env) for _ in range(runs)]
+    heavy = sorted({module.split('.')[0] for module in memory[0]['modules']} & set(HEAVY_MODULES))
+    result = {'name': 'import_main', 'size': 0, **summary(samples)}
+    rss = {
+        'after_import_mb': statistics.median(sample['after_import'] for sample in memory),
+        'after_listings_mb': statistics.median(sample['after_listings'] for sample in memory),
+    }
+    json.dump({**environment(), 'results': [result], 'rss': rss, 'heavy_modules': heavy}, output, indent=2)
+    output.write('\n')
+
+    click.echo(f"import main: median {result['median'] * 1000:.0f}ms (budget {budget_ms:.0f}ms), "
+               f"RSS {rss['after_import_mb']:.1f} MB after the import, {rss['after_listings_mb']:.1f} MB after the listings",
+               err=True)
+    failed = False
+    if heavy:
+        click.echo(f"Loaded by a listing-only worker: {', '.join(heavy)}", err=True)
+        failed = True
+    if result['median'] * 1000 > budget_ms:
+        click.echo("Import time over budget", err=True)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()
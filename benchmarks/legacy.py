@@ -0,0 +1,85 @@
+# Code paths of the application as they were before they were rewritten, kept as the reference the rewrites are
+# checked and measured against. Not used by the application.
+import os
+import re
+import tempfile
+
+import pdfplumber
+
+def match_company_street_city(text):
+    pattern = r'^(.*)\n(\w.*\s\d+)\n(.*?)$'
+    match = re.search(pattern, text, re.MULTILINE)
+    if match:
+        line1, line2, line3 = match.groups()
+        return line1, line2, line3
+    else:
+        return None
+
+def extract_data(text):
+    # extract_data before the single pass parser, without the market search. The defaults process_pdf_file filled in
+    # afterwards are applied here, so the result is what was written to the database.
+    lines = text.split('\n')
+    items = []
+    current_item = None
+    company_name = None
+    street = None
+    zip_code = ''
+    city = None
+    date = None
+
+    company_match = match_company_street_city(text)
+    date_match = re.search(r'\b(?:0[1-9]|[12]\d|3[01])\.(?:0[1-9]|1[0-2])\.\d{4}\b', text)
+
+    if date_match:
+        date = date_match.group()
+    if company_match:
+        company_name, street, city = company_match
+
+    if city:
+        city_parts = city.split(' ', 1)
+        if len(city_parts) == 2:
+            zip_code, city = city_parts
+
+    for line in lines:
+        if re.match(r'^-{3,}$', line.strip()) or re.search(r'\bTotal\b', line, re.IGNORECASE):
+            break
+        if current_item:
+            quantity_match = re.search(r'(\d+(?:,\d+)? (?:kg|Stk)) x (\d+,\d+)', line)
+            if quantity_match:
+                quantity_data = quantity_match.group(1).split()
+                current_item['quantity'] = quantity_data[0]
+                current_item['unit'] = quantity_data[1]
+                current_item['unit_price'] = quantity_match.group(2)
+                continue
+        item_match = re.match(r'(.*) (\d+,\d+)', line)
+        if item_match:
+            current_item = {'name': re.sub(r'\s+x.*', '', item_match.group(1).strip()), 'total_price': item_match.group(2)}
+            items.append(current_item)
+        quantity_match = re.search(r'x(\d+)\s+(\d+)', line)
+        if quantity_match:
+            current_item['quantity'] = quantity_match.group(1)
+            current_item['unit_price'] = str(round(float(current_item['total_price'].replace(',', '.')) / float(quantity_match.group(1).replace(',', '.')) , 2)).replace('.', ',')
+            current_item['unit'] = 'Stk'
+
+    for item in items:
+        if 'quantity' not in item:
+            item['quantity'] = '1'
+            item['unit'] = 'Stk'
+            item['unit_price'] = item['total_price']
+
+    return {'CompanyName': company_name, 'street': street, 'zip_code': zip_code, 'city': city}, items, date
+
+def process_pdf_file(pdf_bytes):
+    # process_pdf_file before the text was extracted in memory, without writing to the database: the upload was
+    # saved to a file, pdfplumber opened it with its defaults and the text of every page was appended to the last.
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_bytes)
+        with pdfplumber.open(path) as pdf:
+            text = ""
+            for page in pdf.pages:
+                text += page.extract_text()
+            return extract_data(text)
+    finally:
+        os.remove(path)
@@ -0,0 +1,109 @@
+# The receipt parser against a golden corpus: parse_receipt has to return what the parser before the single pass
+# rewrite returned (legacy.extract_data, which also wrote the expected results), and how long both take per receipt.
+#   python benchmarks/parser.py check
+#   python benchmarks/parser.py bench --rounds 5 --output parser.json
+#   python benchmarks/parser.py corpus
+# corpus writes the corpus anew from ebons.py and HANDWRITTEN, it is checked in and only changes with the generator.
+import json
+import os
+import random
+import sys
+from decimal import Decimal
+
+import click
+
+from fixtures import BENCHMARK_DIR, load_app
+from run import environment, summary, timed
+import ebons
+import legacy
+
+CORPUS = os.path.join(BENCHMARK_DIR, 'corpus', 'receipts.jsonl')
+CORPUS_SIZE = 200
+
+# Receipts the generator does not write: other end markers, lines after the total, names with an x, no market header
+HANDWRITTEN = {
+    'total_line': 'REWE Markt GmbH\nHauptstr. 12\n10115 Berlin\nEUR\nBUTTER 2,29 B\nCOLA x2 1,98 B\nTotal 4,27\n'
+                  'Datum: 03.02.2024\nGeg. BAR 10,00',
+    'lines_after_dashes': 'REWE Markt GmbH\nAm Ring 7\n50667 Koeln\nBANANEN 1,99 B\n0,856 kg x 2,29 EUR/kg\n'
+                          '----------------------\nSUMME EUR 1,99\nGeg. EC-Cash EUR 1,99\nMWST 0,13\nDatum: 28.02.2023',
+    'names_with_x': 'REWE Markt GmbH\nLindenallee 3\n04109 Leipzig\nDuplo x-tra 1,99 A\nMAXI BOX 2,49 B\n'
+                    'JOGHURT NATUR 1,98 B\n2 Stk x 0,99\nSPEZI x3 2,37 B\n-----\nDatum: 31.12.2025',
+    'no_header': 'EUR\nKAFFEE 5,99 A\nTEE 1,49 A\n---\n12.06.2024 10:11',
+    'date_in_header': '01.07.2023\nREWE Markt GmbH\nGoethestr. 200\n80331 Muenchen\nMEHL 405 0,79 A\n---',
+}
+
+def corpus_receipts():
+    # (name, text) of every receipt in the corpus
+    yield from HANDWRITTEN.items()
+    rng = random.Random('parser-corpus')
+    markets = ebons.markets(rng, 20)
+    for i in range(CORPUS_SIZE):
+        text, _ = ebons.receipt(rng, rng.choice(markets), items=rng.randint(1, 40))
+        yield f'generated_{i}', text
+
+def decimal(value):
+    return Decimal(str(value).replace(',', '.'))
+
+def normalized(company_info, items, date):
+    # Parser results compared by value: the old parser had comma strings, the new one Decimals and a Unit enum
+    return company_info, date, [(item['name'], decimal(item['total_price']), decimal(item['quantity']),
+                                 getattr(item['unit'], 'value', item['unit']), decimal(item['unit_price']))
+                                for item in items]
+
+def load_corpus():
+    with open(CORPUS, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+@click.group()
+def main_command():
+    """Check and measure the receipt parser against the golden corpus."""
+
+@main_command.command()
+def corpus():
+    """Write the corpus anew, the expected results come from the old parser."""
+    os.makedirs(os.path.dirname(CORPUS), exist_ok=True)
+    with open(CORPUS, 'w', encoding='utf-8') as f:
+        for name, text in corpus_receipts():
+            company_info, items, date = legacy.extract_data(text)
+            f.write(json.dumps({'name': name, 'text': text,
+                                'expected': {'company_info': company_info, 'items': items, 'date': date}},
+                               ensure_ascii=False) + '\n')
+    click.echo(f"{len(HANDWRITTEN) + CORPUS_SIZE} receipts written to {CORPUS}")
+
+@main_command.command()
+def check():
+    """Fail if parse_receipt differs from the expected result of any receipt in the corpus."""
+    main, db = load_app()
+    failures = 0
+    receipts = load_corpus()
+    for receipt in receipts:
+        expected = normalized(**receipt['expected'])
+        for parser in (legacy.extract_data, main.parse_receipt):
+            if normalized(*parser(receipt['text'])) != expected:
+                failures += 1
+                click.echo(f"{receipt['name']}: {parser.__module__}.{parser.__name__} differs:\n"
+                           f"  expected {expected}\n  got      {normalized(*parser(receipt['text']))}", err=True)
+    click.echo(f"{len(receipts)} receipts, {failures} differences", err=True)
+    if failures:
+        sys.exit(1)
+
+@main_command.command()
+@click.option('--rounds', type=int, default=5, show_default=True, help='Times every receipt is parsed.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+def bench(rounds, output):
+    """Time per receipt of the old and the new parser."""
+    main, db = load_app()
+    texts = [receipt['text'] for receipt in load_corpus()] * rounds
+    results = []
+    for name, parser in (('parse_legacy', legacy.extract_data), ('parse_receipt', main.parse_receipt)):
+        result = {'name': name, 'size': len(texts) // rounds, **summary(timed(parser, texts))}
+        results.append(result)
+        click.echo(f"{name:14} median {result['median'] * 1e6:7.1f}us  p95 {result['p95'] * 1e6:7.1f}us  "
+                   f"({result['samples']} samples)", err=True)
+    click.echo(f"parse_receipt takes {results[1]['median'] / results[0]['median'] * 100:.0f}% of the old parser's median",
+               err=True)
+    json.dump({**environment(), 'options': {'rounds': rounds}, 'results': results}, output, indent=2)
+    output.write('\n')
+
+if __name__ == '__main__':
+    main_command()
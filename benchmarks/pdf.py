@@ -0,0 +1,64 @@
+# Parse time and peak memory of long multi-page eBon PDFs: the old path (the upload saved to a file, pdfplumber,
+# the page texts appended to each other, legacy.process_pdf_file) against parse_pdf on the bytes in memory.
+#   python benchmarks/pdf.py --pdfs 10 --items 300 --output pdf.json
+# The peak memory is measured with tracemalloc in a pass of its own, tracing slows the parsing down.
+import io
+import json
+import random
+import sys
+import tracemalloc
+
+import click
+
+from fixtures import load_app
+from run import environment, summary, timed
+import ebons
+import legacy
+
+def peak_memory(function, arguments):
+    # The highest peak of the Python heap over the calls
+    peaks = []
+    for argument in arguments:
+        tracemalloc.start()
+        try:
+            function(argument)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return max(peaks)
+
+@click.command()
+@click.option('--pdfs', type=int, default=10, show_default=True, help='eBon PDFs parsed per round.')
+@click.option('--items', type=int, default=300, show_default=True, help='Items per eBon, 300 items are about 8 pages.')
+@click.option('--rounds', type=int, default=3, show_default=True, help='Times every PDF is parsed.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+@click.option('--threshold', type=float,
+              help='Exit with status 1 if the median of parse_pdf is more than this many percent of the old path.')
+def main_command(pdfs, items, rounds, output, threshold):
+    """Measure the parse time and peak memory of long eBons, old path against parse_pdf."""
+    main, db = load_app()
+    rng = random.Random(f'pdf-{items}')
+    documents = [ebons.pdf_bytes(ebons.receipt(rng, items=items)[0]) for _ in range(pdfs)]
+    pages = len(ebons.pages(ebons.receipt(random.Random(0), items=items)[0]))
+
+    results = []
+    for name, parse in (('pdf_legacy', legacy.process_pdf_file), ('parse_pdf', lambda document: main.parse_pdf(io.BytesIO(document)))):
+        # The old path glues the last line of a page to the first of the next one and loses items there
+        found = sum(len(parse(document)[1]) for document in documents)
+        result = {'name': name, 'size': items, **summary(timed(parse, documents * rounds)),
+                  'peak_memory': peak_memory(parse, documents), 'items_found': found}
+        results.append(result)
+        click.echo(f"{name:10} median {result['median'] * 1000:8.1f}ms  p95 {result['p95'] * 1000:8.1f}ms  "
+                   f"peak {result['peak_memory'] / 2 ** 20:6.1f}MiB  {found} of {pdfs * items} items", err=True)
+    legacy_result, result = results
+    change = result['median'] / legacy_result['median'] * 100
+    click.echo(f"parse_pdf takes {change:.0f}% of the time and {result['peak_memory'] / legacy_result['peak_memory'] * 100:.0f}% "
+               f"of the memory of the old path on {pages} page eBons", err=True)
+    json.dump({**environment(), 'options': {'pdfs': pdfs, 'items': items, 'rounds': rounds, 'pages': pages}, 'results': results},
+              output, indent=2)
+    output.write('\n')
+    if threshold is not None and change > threshold:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,88 @@
+# The views and hot queries against a fixture database of about 1M invoice items: every query of
+# main.QUERY_PLAN_CHECKS has to search and not scan, and how long they and the queries that read a whole table take.
+#   python benchmarks/queries.py --invoices 28000 --output queries.json
+# Exits with status 1 if a query plan scans, or with --budget-ms if the median of a hot query is over the budget.
+import json
+import sys
+
+import click
+
+from fixtures import fixture, load_app
+from run import environment, summary, timed
+
+# Queries that read a whole table (or a page of one) on purpose, run as the application runs them
+def full_reads(main, c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'view' ORDER BY name")
+    reads = [(f'all of {name}', f'SELECT * FROM {name}', ()) for name, in c.fetchall()]
+    for dataset, (query, date_sql, supplier_sql, order) in main.EXPORTS.items():
+        reads.append((f'export {dataset}', f'{query} ORDER BY {order}', ()))
+    # The first page of every sort of the listings walks an index until it has the page
+    for listing, query, sort_columns, id_sql, direction in (
+            ('items', main.ITEM_LIST_QUERY, main.ITEM_SORT_COLUMNS, 'product_id', 'asc'),
+            ('invoices', main.INVOICE_LIST_QUERY, main.INVOICE_SORT_COLUMNS, 'i.invoice_id', 'desc')):
+        for sort in sort_columns:
+            reads.append((f'first {listing} page by {sort}',
+                          *main.page_query(query, [], [], sort_columns, sort, direction, main.PAGE_SIZE, id_sql)))
+    reads += [
+        ('price overview', f'''SELECT {main.PRICE_OVERVIEW_COLUMNS} FROM PriceStats AS ps
+                               JOIN Products p ON p.product_id = ps.product_id ORDER BY p.name COLLATE NOCASE''', ()),
+        ('top suppliers by revenue', 'SELECT * FROM View_TopSuppliersByRevenue LIMIT 10', ()),
+        ('suppliers with most invoices', 'SELECT * FROM View_SuppliersWithMostInvoices LIMIT 10', ()),
+    ]
+    return reads
+
+@click.command()
+@click.option('--invoices', type=int, default=28000, show_default=True,
+              help='Invoices in the fixture database, the default has about 1M invoice items.')
+@click.option('--repeat', type=int, default=200, show_default=True, help='Runs of every hot query.')
+@click.option('--rounds', type=int, default=3, show_default=True, help='Runs of every query that reads a whole table.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+@click.option('--budget-ms', type=float, help='Exit with status 1 if the median of a hot query takes longer.')
+def main_command(invoices, repeat, rounds, output, budget_ms):
+    """Check the query plans of the views and hot queries and time them on a large database."""
+    main, db = load_app()
+    path = fixture(invoices)
+    db.configure(path)
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT count(*) FROM InvoiceItems')
+    items, = c.fetchone()
+    click.echo(f"{path}: {invoices} invoices, {items} invoice items", err=True)
+
+    failures = main.check_query_plans(conn)
+    for name, details, scans in failures:
+        click.echo(f"{name}: scan ({', '.join(scans)})", err=True)
+        for detail in details:
+            click.echo(f"    {detail}", err=True)
+
+    def run(query, params):
+        c.execute(query, params)
+        c.fetchall()
+
+    results = []
+    slow = []
+    for kind, queries, runs in (('hot', main.QUERY_PLAN_CHECKS, repeat), ('full', full_reads(main, c), rounds)):
+        for name, query, params in queries:
+            run(query, params)
+            result = {'name': name, 'kind': kind, 'size': items,
+                      **summary(timed(lambda _: run(query, params), range(runs)))}
+            results.append(result)
+            if kind == 'hot' and budget_ms is not None and result['median'] * 1000 > budget_ms:
+                slow.append(result)
+            click.echo(f"{kind:4} {name:40} median {result['median'] * 1000:10.3f}ms  p95 {result['p95'] * 1000:10.3f}ms",
+                       err=True)
+    conn.close()
+
+    options = {'invoices': invoices, 'repeat': repeat, 'rounds': rounds}
+    json.dump({**environment(), 'sizes': [items], 'options': options, 'results': results}, output, indent=2)
+    output.write('\n')
+
+    if failures:
+        click.echo(f"{len(failures)} of {len(main.QUERY_PLAN_CHECKS)} query plans scan", err=True)
+    for result in slow:
+        click.echo(f"{result['name']} takes {result['median'] * 1000:.3f}ms, the budget is {budget_ms:g}ms", err=True)
+    if failures or slow:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()
@@ -0,0 +1,174 @@
+# Benchmark harness: parsing, ingestion and the listing routes against fixture databases of several sizes.
+#   python benchmarks/run.py --sizes 1000,10000 --output results.json
+#   python benchmarks/run.py --output new.json --baseline results.json
+# The results are JSON (one entry per benchmark and database size, times in seconds), so runs of different commits
+# can be compared with --baseline.
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+from fixtures import BENCHMARK_DIR, fixture, load_app, working_copy
+import ebons
+
+def timed(function, arguments):
+    # Calls function once per argument and returns the time of every call
+    samples = []
+    for argument in arguments:
+        started = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def summary(samples):
+    ordered = sorted(samples)
+    return {
+        'samples': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'min': ordered[0],
+        'max': ordered[-1],
+        'total': sum(ordered),
+    }
+
+def bench_extract_data(main, client, rng, options):
+    texts = [ebons.receipt(rng)[0] for _ in range(options['receipts'])]
+    return timed(main.extract_data, texts)
+
+def bench_process_pdf_file(main, client, rng, options):
+    pdfs = [ebons.pdf_bytes(ebons.receipt(rng)[0]) for _ in range(options['pdfs'])]
+    return timed(main.process_pdf_file, pdfs)
+
+def bench_write_to_database(main, client, rng, options):
+    receipts = [ebons.receipt(rng)[1] for _ in range(options['receipts'])]
+    return timed(lambda parsed: main.write_to_database(parsed[1], 'benchmark.pdf', parsed[0], parsed[2], []), receipts)
+
+def route(path_for, revalidate=False):
+    # A benchmark that requests path_for(rng, invoice ids) as a browser would, after a few warm up requests.
+    # The page cache is emptied before every request, so the page is rendered each time. With revalidate the
+    # browser has the current page already and asks with its ETag.
+    def bench(main, client, rng, options):
+        c = main.get_db().cursor()
+        c.execute('SELECT invoice_id FROM Invoices')
+        invoice_ids = [row[0] for row in c.fetchall()]
+        paths = [path_for(rng, invoice_ids) for _ in range(options['requests'])]
+        etags = {}
+
+        def get(path):
+            headers = {'Accept': 'text/html'}
+            if revalidate:
+                if path not in etags:
+                    etags[path] = client.get(path, headers=headers).headers['ETag']
+                headers['If-None-Match'] = etags[path]
+            else:
+                main.page_cache.clear()
+            response = client.get(path, headers=headers)
+            if response.status_code != (304 if revalidate else 200):
+                raise RuntimeError(f'GET {path}: {response.status_code}')
+            response.get_data()
+
+        for path in paths[:3]:
+            get(path)
+        return timed(get, paths)
+    return bench
+
+# Write benchmarks run last, the read benchmarks see the fixture as it was built
+BENCHMARKS = {
+    'extract_data': bench_extract_data,
+    'route_items': route(lambda rng, ids: '/items'),
+    'route_items_sorted': route(lambda rng, ids: '/items?sort=unit_price&dir=desc'),
+    'route_invoices': route(lambda rng, ids: '/invoices'),
+    'route_invoices_sorted': route(lambda rng, ids: '/invoices?sort=total_amount&dir=desc'),
+    'route_invoice_details': route(lambda rng, ids: f'/invoice_details/{rng.choice(ids)}'),
+    'route_items_not_modified': route(lambda rng, ids: '/items', revalidate=True),
+    'write_to_database': bench_write_to_database,
+    'process_pdf_file': bench_process_pdf_file,
+}
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARK_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def run_benchmarks(sizes, names, options):
+    main, db = load_app()
+    results = []
+    for size in sizes:
+        path = working_copy(fixture(size), f'run-{size}.db')
+        db.configure(path)
+        main.migrate_database()
+        client = main.app.test_client()
+        for name in names:
+            # Every benchmark gets its own generator, adding or removing one does not change the others' inputs
+            rng = random.Random(f'{name}-{size}')
+            samples = BENCHMARKS[name](main, client, rng, options)
+            result = {'name': name, 'size': size, **summary(samples)}
+            results.append(result)
+            click.echo(f"{name:24} {size:>8} invoices  median {result['median'] * 1000:9.3f}ms  "
+                       f"p95 {result['p95'] * 1000:9.3f}ms  ({result['samples']} samples)", err=True)
+        db.close_db()
+    return results
+
+def compare(baseline, results, threshold):
+    # Prints the change of the median per benchmark and returns the benchmarks that got slower than threshold percent
+    before = {(result['name'], result['size']): result for result in baseline['results']}
+    regressions = []
+    click.echo(f"Compared with {baseline.get('commit') or 'baseline'} ({baseline.get('created')})", err=True)
+    for result in results:
+        old = before.get((result['name'], result['size']))
+        if old is None:
+            continue
+        change = (result['median'] - old['median']) / old['median'] * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(result)
+            flag = '  SLOWER'
+        click.echo(f"{result['name']:24} {result['size']:>8}  {old['median'] * 1000:9.3f}ms -> "
+                   f"{result['median'] * 1000:9.3f}ms  {change:+6.1f}%{flag}", err=True)
+    return regressions
+
+@click.command()
+@click.option('--sizes', default='1000,10000', show_default=True, help='Invoices in the fixture databases, comma separated.')
+@click.option('--only', 'only', multiple=True, type=click.Choice(list(BENCHMARKS)), help='Run only these benchmarks.')
+@click.option('--receipts', type=int, default=100, show_default=True, help='Receipts for extract_data and write_to_database.')
+@click.option('--pdfs', type=int, default=20, show_default=True, help='PDFs for process_pdf_file.')
+@click.option('--requests', type=int, default=50, show_default=True, help='Requests per route.')
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='Where the JSON results go.')
+@click.option('--baseline', type=click.File('r'), help='Results of an earlier run to compare with.')
+@click.option('--threshold', type=float, default=20, show_default=True,
+              help='With --baseline, exit with status 1 if a median got slower by more than this many percent.')
+def main_command(sizes, only, receipts, pdfs, requests, output, baseline, threshold):
+    """Run the benchmarks and write the results as JSON."""
+    sizes = [int(size) for size in sizes.split(',')]
+    names = [name for name in BENCHMARKS if not only or name in only]
+    options = {'receipts': receipts, 'pdfs': pdfs, 'requests': requests}
+    results = run_benchmarks(sizes, names, options)
+    json.dump({**environment(), 'sizes': sizes, 'options': options, 'results': results}, output, indent=2)
+    output.write('\n')
+    if baseline is not None and compare(json.load(baseline), results, threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_command()